@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Measure the throughput of ActionField.numericalize over all the action sequences of a
+# treebank, against the former per-action implementation and a lookup of only the distinct
+# actions found with np.unique. Run from the project directory:
+#
+#     python benchmarks/bench_action_field.py [--corpus FILE]
+#
+# Without a corpus, random trees of the size of the WSJ training sections are used.
+import argparse
+import itertools
+import random
+import time
+
+from torchtext.data import Field
+import numpy as np
+
+from bench_oracle import make_tree
+from rnng.actions import NT
+from rnng.corpus import read_trees
+from rnng.fields import ActionField
+from rnng.oracle import DiscOracle
+
+
+class OldActionField(ActionField):
+    def numericalize(self, arr, **kwargs):
+        lengths = None
+        if isinstance(arr, tuple):
+            arr, lengths = arr
+        arr = [[self._old_actionstr2id(s) for s in ex] for ex in arr]
+        if lengths is not None:
+            arr = (arr, lengths)
+        old_use_vocab = self.use_vocab
+        self.use_vocab = False
+        arr = Field.numericalize(self, arr, **kwargs)
+        self.use_vocab = old_use_vocab
+        return arr
+
+    def _old_actionstr2id(self, s):
+        if s in self.vocab.stoi:
+            return self.vocab.stoi[s]
+        action = NT(self.nonterm_field.unk_token)
+        assert action in self.vocab.stoi
+        return self.vocab.stoi[action]
+
+
+class UniqueActionField(ActionField):
+    def get_action_ids(self, arr):
+        table, unk_id = self._get_action_table()
+        flat = np.array(list(itertools.chain.from_iterable(arr)), dtype=str)
+        uniques, inverse = np.unique(flat, return_inverse=True)
+        unique_ids = np.array([table.get(s, unk_id) for s in uniques], dtype=np.int64)
+        return unique_ids[inverse.reshape(-1)].reshape(len(arr), len(arr[0]) if arr else 0)
+
+
+def make_field(cls, nonterms):
+    nonterm_field = Field(pad_token=None)
+    nonterm_field.build_vocab([nonterms])
+    field = cls(nonterm_field, include_lengths=True)
+    field.build_vocab()
+    return field
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark action numericalization.')
+    parser.add_argument('--corpus', metavar='FILE', help='treebank to get the actions from')
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('--num-trees', type=int, default=39832)
+    parser.add_argument('--num-words', type=int, default=24)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    if args.corpus is None:
+        rng = random.Random(args.seed)
+        trees = (make_tree(rng, args.num_words) for _ in range(args.num_trees))
+    else:
+        trees = read_trees(args.corpus, encoding=args.encoding)
+    seqs = [DiscOracle.from_tree(tree).actions for tree in trees]
+    num_actions = sum(len(seq) for seq in seqs)
+    nonterms = sorted({a for seq in seqs for a in seq if a.startswith('NT(')})
+    # Leave one nonterminal out so the unknown NT fallback is exercised too
+    nonterms = [a[3:-1] for a in nonterms[1:]]
+
+    old_field = make_field(OldActionField, nonterms)
+    new_field = make_field(ActionField, nonterms)
+    unique_field = make_field(UniqueActionField, nonterms)
+    batches = [new_field.pad(seqs[i:i + args.batch_size])
+               for i in range(0, len(seqs), args.batch_size)]
+    for batch in batches[:10]:
+        old_tensor, _ = old_field.numericalize(batch, device=-1)
+        new_tensor, _ = new_field.numericalize(batch, device=-1)
+        unique_tensor, _ = unique_field.numericalize(batch, device=-1)
+        assert old_tensor.data.tolist() == new_tensor.data.tolist()
+        assert unique_tensor.data.tolist() == new_tensor.data.tolist()
+
+    print(f'{len(seqs)} sentences, {num_actions} actions, batches of {args.batch_size}')
+    for name, field in [('old', old_field), ('new', new_field), ('unique', unique_field)]:
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for batch in batches:
+                field.numericalize(batch, device=-1)
+            best = min(best, time.perf_counter() - start)
+        print(f'{name}: {best:.3f}s | {num_actions / best / 1e6:.2f}M actions/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Measure the training throughput of DiscRNNG, running forward and backward over batches of
+# random trees with the scheduled batch forward pass against the step by step one used for
+# single sentences. Run from the project directory:
+#
+#     python benchmarks/bench_forward.py
+import argparse
+import random
+import time
+
+from torch.autograd import Variable
+import torch
+
+from bench_oracle import make_tree
+from rnng.actions import get_nonterm, is_nt
+from rnng.models import DiscRNNG
+from rnng.oracle import DiscOracle
+
+
+def make_batch(rng, args, nt2id):
+    oracles = [DiscOracle.from_tree(make_tree(rng, rng.randint(1, 2 * args.num_words)))
+               for _ in range(args.batch_size)]
+    word_lengths = [len(o.words) for o in oracles]
+    action_lengths = [len(o.actions) for o in oracles]
+    words = torch.LongTensor(max(word_lengths), len(oracles)).zero_()
+    actions = torch.LongTensor(max(action_lengths), len(oracles)).zero_()
+    for i, oracle in enumerate(oracles):
+        for j in range(word_lengths[i]):
+            words[j, i] = rng.randrange(args.num_vocab)
+        for j, a in enumerate(oracle.actions):
+            actions[j, i] = nt2id[get_nonterm(a)] + 2 if is_nt(a) else int(a == 'SHIFT')
+    return Variable(words), Variable(actions), word_lengths, action_lengths
+
+
+def run_batched(parser, words, actions, word_lengths, action_lengths):
+    llh = parser(words, words, actions, word_lengths=word_lengths, action_lengths=action_lengths)
+    llh.sum().backward()
+
+
+def run_per_sentence(parser, words, actions, word_lengths, action_lengths):
+    llh = 0.
+    for i, (n, m) in enumerate(zip(word_lengths, action_lengths)):
+        llh += parser(words[:n, i], words[:n, i], actions[:m, i])
+    llh.sum().backward()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the training forward pass.')
+    parser.add_argument('--num-batches', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-words', type=int, default=24)
+    parser.add_argument('--num-vocab', type=int, default=1000)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+    nt2id = {nt: i for i, nt in enumerate(['S', 'NP', 'VP', 'PP'])}
+    model = DiscRNNG(args.num_vocab, args.num_vocab, len(nt2id), num_layers=args.num_layers)
+    batches = [make_batch(rng, args, nt2id) for _ in range(args.num_batches)]
+    num_sents = args.num_batches * args.batch_size
+
+    print(f'{args.num_batches} batches of {args.batch_size} sentences, '
+          f'{args.num_layers} layers')
+    for name, run in [('per sentence', run_per_sentence), ('batched', run_batched)]:
+        start = time.perf_counter()
+        for batch in batches:
+            model.zero_grad()
+            run(model, *batch)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>12}: {elapsed:.3f}s | {num_sents / elapsed:.2f} samples/sec')
+
+
+if __name__ == '__main__':
+    main()
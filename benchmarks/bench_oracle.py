@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Compare oracle extraction and tree reconstruction against the former recursive,
+# list-copying implementation. Run from the project directory:
+#
+#     python benchmarks/bench_oracle.py
+import argparse
+import random
+import timeit
+
+from nltk.tree import Tree
+
+from rnng.actions import NT, REDUCE, get_nonterm, is_nt
+from rnng.oracle import DiscOracle
+
+
+def old_get_actions(tree):
+    if len(tree) == 1 and not isinstance(tree[0], Tree):
+        return [DiscOracle.get_action_at_pos_node(tree)]
+
+    actions = [NT(tree.label())]
+    for child in tree:
+        actions.extend(old_get_actions(child))
+    actions.append(REDUCE)
+    return actions
+
+
+def old_from_tree(tree):
+    actions = old_get_actions(tree)
+    words, pos_tags = zip(*tree.pos())
+    return DiscOracle(actions, list(pos_tags), list(words))
+
+
+def old_to_tree(oracle):
+    stack = []
+    pos_tags = list(reversed(oracle.pos_tags))
+    words = list(reversed(oracle.words))
+    for a in oracle.actions:
+        if is_nt(a):
+            stack.append(get_nonterm(a))
+        elif a == REDUCE:
+            children = []
+            while stack and isinstance(stack[-1], Tree):
+                children.append(stack.pop())
+            parent = stack.pop()
+            stack.append(Tree(parent, list(reversed(children))))
+        else:
+            stack.append(Tree(pos_tags.pop(), [words.pop()]))
+    return stack[0]
+
+
+def make_tree(rng, num_words, max_children=4):
+    # A random tree over num_words words whose constituents have at most max_children
+    nodes = [Tree('NN', [f'w{i}']) for i in range(num_words)]
+    while len(nodes) > 1:
+        i = rng.randrange(len(nodes))
+        n = rng.randint(2, max_children)
+        nodes[i:i + n] = [Tree(rng.choice(['NP', 'VP', 'PP', 'S']), nodes[i:i + n])]
+    return Tree('S', nodes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark oracle extraction.')
+    parser.add_argument('--num-trees', type=int, default=1000)
+    parser.add_argument('--num-words', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    trees = [make_tree(rng, args.num_words) for _ in range(args.num_trees)]
+    oracles = [DiscOracle.from_tree(tree) for tree in trees]
+    assert all(old_from_tree(t).actions == o.actions for t, o in zip(trees, oracles))
+    assert all(old_to_tree(o) == o.to_tree() for o in oracles)
+
+    cases = [
+        ('from_tree', lambda: [old_from_tree(t) for t in trees],
+         lambda: [DiscOracle.from_tree(t) for t in trees]),
+        ('encode', lambda: [old_from_tree(t) for t in trees],
+         lambda: [DiscOracle.encode(t, {}, {}) for t in trees]),
+        ('to_tree', lambda: [old_to_tree(o) for o in oracles],
+         lambda: [o.to_tree() for o in oracles]),
+        ('access', lambda: [(o.actions, o.pos_tags, o.words) for o in oracles],
+         lambda: [(o.actions_view, o.pos_tags_view, o.words_view) for o in oracles]),
+    ]
+    print(f'{args.num_trees} trees of {args.num_words} words, best of {args.repeat}')
+    for name, old, new in cases:
+        old_time = min(timeit.repeat(old, number=1, repeat=args.repeat))
+        new_time = min(timeit.repeat(new, number=1, repeat=args.repeat))
+        print(f'{name:>10}: old {old_time * 1000:8.2f}ms | new {new_time * 1000:8.2f}ms '
+              f'| speedup {old_time / new_time:.2f}x')
+
+    depth = 5000
+    deep = Tree.fromstring('(X ' * depth + '(NN a)' + ')' * depth)
+    try:
+        old_from_tree(deep)
+        print(f'old from_tree handles a tree of depth {depth}')
+    except RecursionError:
+        print(f'old from_tree fails on a tree of depth {depth}')
+    DiscOracle.from_tree(deep).to_tree()
+    print(f'new from_tree and to_tree handle a tree of depth {depth}')
+
+
+if __name__ == '__main__':
+    main()
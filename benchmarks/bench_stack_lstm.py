@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Measure the latency of single pushes onto a stack LSTM with nn.LSTM against the fused
+# LSTM, with and without TorchScript, and when evaluating, against the stack LSTM that
+# keeps its history in preallocated tensors. Run from the project directory:
+#
+#     python benchmarks/bench_stack_lstm.py
+import argparse
+import time
+
+from torch.autograd import Variable
+import torch
+
+from rnng.models import FusedLSTM, PreallocatedStackLSTM, StackLSTM
+
+
+def time_pushes(lstm, inputs, depth):
+    # Push inputs one at a time, popping everything back every depth pushes
+    start = time.perf_counter()
+    for i in range(inputs.size(0)):
+        lstm.push(inputs[i])
+        if len(lstm) == depth:
+            while len(lstm):
+                lstm.pop()
+    return time.perf_counter() - start
+
+
+def time_node_pushes(lstm, inputs, depth):
+    start = time.perf_counter()
+    node = lstm.root_node()
+    for i in range(inputs.size(0)):
+        node = lstm.push_nodes([node], inputs[i:i + 1], [None])[0]
+        if node.size == depth:
+            node = lstm.root_node()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stack LSTM pushes.')
+    parser.add_argument('--num-pushes', type=int, default=2000)
+    parser.add_argument('--input-size', type=int, default=128)
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    inputs = Variable(torch.randn(args.num_pushes, args.input_size))
+    # LSTMs are nn.LSTM if use_jit is None, fused otherwise
+    cases = [('nn.LSTM', None), ('fused', False)]
+    if hasattr(torch, 'jit'):
+        cases.append(('fused+jit', True))
+
+    reference = StackLSTM(args.input_size, args.hidden_size, num_layers=args.num_layers)
+    print(f'{args.num_pushes} pushes, input size {args.input_size}, hidden size '
+          f'{args.hidden_size}, {args.num_layers} layers, best of {args.repeat}')
+    for name, use_jit in cases:
+        lstm = StackLSTM(args.input_size, args.hidden_size, num_layers=args.num_layers)
+        lstm.load_state_dict(reference.state_dict())
+        if use_jit is not None:
+            lstm.lstm = FusedLSTM.from_lstm(lstm.lstm, use_jit=use_jit)
+        # Same outputs as the reference, and a warm up for TorchScript
+        for i in range(args.depth):
+            lstm.push(inputs[i])
+            reference.push(inputs[i])
+            assert (lstm.top - reference.top).abs().max().data.tolist() < 1e-5
+        while len(reference):
+            reference.pop()
+            lstm.pop()
+
+        for method, run in [('push', time_pushes), ('push_nodes', time_node_pushes)]:
+            best = min(run(lstm, inputs, args.depth) for _ in range(args.repeat))
+            print(f'{name:>10} {method:>10}: {best / args.num_pushes * 1e6:8.1f}us per push')
+
+    print('When evaluating:')
+    reference.eval()
+    eval_cases = [
+        ('nn.LSTM', StackLSTM, None),
+        ('fused', StackLSTM, FusedLSTM),
+        ('prealloc', PreallocatedStackLSTM, None),
+    ]
+    for name, cls, lstm_class in eval_cases:
+        lstm = cls(args.input_size, args.hidden_size, num_layers=args.num_layers)
+        lstm.load_state_dict(reference.state_dict())
+        if lstm_class is not None:
+            lstm.lstm = lstm_class.from_lstm(lstm.lstm)
+        lstm.eval()
+        for i in range(args.depth):
+            lstm.push(inputs[i])
+            reference.push(inputs[i])
+            assert (lstm.top - reference.top).abs().max().data.tolist() < 1e-5
+        while len(reference):
+            reference.pop()
+            lstm.pop()
+
+        best = min(time_pushes(lstm, inputs, args.depth) for _ in range(args.repeat))
+        print(f'{name:>10} {"push":>10}: {best / args.num_pushes * 1e6:8.1f}us per push')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,5 +12,6 @@ setup(name='pytorch-rnng',
       install_requires=[
           'dill',
           'nltk >=3, <4',
+          'numpy',
           'torchtext >=0.2, <0.3',
       ])
@@ -1,4 +1,6 @@
-from rnng.typing import Action, NTLabel, Word
+from typing import Sequence
+
+from rnng.typing import Action, ActionCode, NTLabel, Word
 
 
 REDUCE: Action = 'REDUCE'
@@ -31,3 +33,38 @@ def is_nt(action: Action) -> bool:
 
 def is_gen(action: Action) -> bool:
     return action.startswith('GEN')
+
+
+# Actions can also be encoded as integers, with the type tag in the lowest bits and the
+# id of the argument, i.e. a nonterminal or a word, in the rest
+REDUCE_TAG = 0
+SHIFT_TAG = 1
+NT_TAG = 2
+GEN_TAG = 3
+TAG_BITS = 2
+
+
+def encode_action(tag: int, arg_id: int = 0) -> ActionCode:
+    return (arg_id << TAG_BITS) | tag
+
+
+def get_tag(code: ActionCode) -> int:
+    return code & ((1 << TAG_BITS) - 1)
+
+
+def get_arg_id(code: ActionCode) -> int:
+    return code >> TAG_BITS
+
+
+def decode_action(code: ActionCode,
+                  nonterms: Sequence[NTLabel] = (),
+                  words: Sequence[Word] = ()) -> Action:
+    # nonterms and words map argument ids back to their strings
+    tag = get_tag(code)
+    if tag == REDUCE_TAG:
+        return REDUCE
+    if tag == SHIFT_TAG:
+        return SHIFT
+    if tag == NT_TAG:
+        return NT(nonterms[get_arg_id(code)])
+    return GEN(words[get_arg_id(code)])
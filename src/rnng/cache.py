@@ -0,0 +1,30 @@
+from typing import Sequence, Tuple
+import hashlib
+import json
+
+from torchtext.data import Field
+
+
+# Bump this whenever the format of the cached files changes
+CACHE_VERSION = 1
+
+
+def get_cache_key(corpus: str,
+                  fields: Sequence[Tuple[str, Field]],
+                  encoding: str = 'utf-8') -> str:
+    # The key changes whenever the corpus content or anything that changes how the
+    # examples are preprocessed does
+    digest = hashlib.sha1()
+    with open(corpus, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    config = dict(
+        version=CACHE_VERSION,
+        encoding=encoding,
+        fields=[
+            [name, type(field).__name__, field.sequential, field.lower]
+            for name, field in fields
+        ],
+    )
+    digest.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
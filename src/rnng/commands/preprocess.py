@@ -0,0 +1,43 @@
+import argparse
+import os
+
+from rnng.fields import make_fields
+from rnng.preprocess import preprocess_corpus
+
+
+def make_parser(subparsers=None) -> argparse.ArgumentParser:
+    description = 'Preprocess corpora into the cache used for training, in parallel.'
+    if subparsers is None:
+        parser = argparse.ArgumentParser(description=description)
+    else:
+        parser = subparsers.add_parser('preprocess', description=description)
+
+    parser.add_argument(
+        'corpora', nargs='+', metavar='FILE', help='path to corpora to preprocess')
+    parser.add_argument(
+        '-c', '--cache-dir', required=True, metavar='DIR',
+        help='directory to cache the preprocessed corpora in')
+    parser.add_argument(
+        '--encoding', default='utf-8', help='file encoding to use (default: utf-8)')
+    parser.add_argument(
+        '--no-lower', action='store_false', dest='lower',
+        help='whether not to lowercase the words')
+    parser.add_argument(
+        '-j', '--num-workers', type=int, default=os.cpu_count(), metavar='NUMBER',
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=1000, metavar='NUMBER',
+        help='number of trees sent to a worker at once (default: 1000)')
+    parser.set_defaults(func=main)
+
+    return parser
+
+
+def main(args: argparse.Namespace) -> None:
+    # Must match the fields of the trainer for it to find the cache
+    fields = make_fields(lower=args.lower)
+    for corpus in args.corpora:
+        cache_path = preprocess_corpus(
+            corpus, fields, args.cache_dir, encoding=args.encoding,
+            num_workers=args.num_workers, chunk_size=args.chunk_size)
+        print(f'{corpus}: {cache_path}')
@@ -55,16 +55,33 @@ def make_parser(subparsers=None) -> argparse.ArgumentParser:
     parser.add_argument(
         '--learning-rate', type=float, default=0.001, metavar='NUMBER',
         help='learning rate (default: 0.001)')
+    parser.add_argument(
+        '--batch-size', type=int, default=1, metavar='NUMBER',
+        help='number of sentences in a training batch (default: 1)')
     parser.add_argument(
         '--max-epochs', type=int, default=20, metavar='NUMBER',
         help='maximum number of epochs to train (default: 20)')
     parser.add_argument(
-        '--evalb', metavar='FILE', help='evalb executable file (default: evalb)')
+        '--evalb', metavar='FILE',
+        help='evalb executable file (default: score brackets in-process)')
     parser.add_argument(
         '--evalb-params', metavar='FILE', help='evalb params file')
     parser.add_argument(
         '--log-interval', type=int, default=10, metavar='NUMBER',
         help='print logs every this number of iterations (default: 10)')
+    parser.add_argument(
+        '--train-f1-interval', type=int, default=0, metavar='NUMBER',
+        help=('decode a training batch for the running F1 every this number of iterations '
+              '(default: 0 for loss only)'))
+    parser.add_argument(
+        '--cache-dir', metavar='DIR',
+        help='directory to cache the preprocessed corpora in (default: no caching)')
+    parser.add_argument(
+        '--streaming', action='store_true',
+        help='read the corpora anew every epoch instead of loading them in memory')
+    parser.add_argument(
+        '--shuffle-buffer-size', type=int, default=10000, metavar='NUMBER',
+        help='number of examples to shuffle at once when streaming (default: 10000)')
     parser.add_argument(
         '--seed', type=int, default=25122017, help='random seed (default: 25122017)')
     parser.add_argument(
@@ -0,0 +1,76 @@
+from typing import Iterable, Iterator, Optional, TypeVar
+from typing import List  # noqa
+import random
+import re
+
+from nltk.tree import Tree
+
+
+T = TypeVar('T')
+
+
+def read_trees(path: str, encoding: str = 'utf-8') -> Iterator[Tree]:
+    # Read bracketed trees one at a time, so only a single tree is in memory at any point.
+    # Trees are normalized like nltk's BracketParseCorpusReader does.
+    with open(path, encoding=encoding) as f:
+        for sexpr in iter_sexprs(f):
+            yield parse_tree(sexpr)
+
+
+def iter_sexprs(lines: Iterable[str]) -> Iterator[str]:
+    depth = 0
+    parts = []  # type: List[str]
+    for lineno, line in enumerate(lines, start=1):
+        start = 0
+        for match in re.finditer(r'[()]', line):
+            if match.group() == '(':
+                if depth == 0:
+                    start = match.start()
+                depth += 1
+            else:
+                depth -= 1
+                if depth < 0:
+                    raise ValueError(f'unbalanced closing parenthesis at line {lineno}')
+                if depth == 0:
+                    parts.append(line[start:match.end()])
+                    yield ''.join(parts)
+                    parts = []
+        if depth > 0:
+            parts.append(line[start:])
+    if depth > 0:
+        raise ValueError('unexpected end of file inside a tree')
+
+
+def parse_tree(sexpr: str) -> Tree:
+    # Replace leaves of the form (!), (,), with (! !), (, ,)
+    sexpr = re.sub(r'\((.)\)', r'(\1 \1)', sexpr)
+    # Replace leaves of the form (tag word root) with (tag word)
+    sexpr = re.sub(r'\(([^\s()]+) ([^\s()]+) [^\s()]+\)', r'(\1 \2)', sexpr)
+    tree = Tree.fromstring(sexpr)
+    # Strip the empty root node of PTB-style trees
+    if tree.label() == '' and len(tree) == 1:
+        tree = tree[0]
+    return tree
+
+
+def shuffle_buffer(iterable: Iterable[T],
+                   buffer_size: int,
+                   rng: Optional[random.Random] = None) -> Iterator[T]:
+    # Shuffle approximately while keeping at most buffer_size items in memory. Each item
+    # is yielded in place of a random item of a full buffer.
+    if buffer_size <= 0:
+        raise ValueError(f'nonpositive buffer size: {buffer_size}')
+    # Without an rng, use the global one so random.seed applies
+    randrange, shuffle = (random.randrange, random.shuffle) if rng is None \
+        else (rng.randrange, rng.shuffle)
+
+    buffer = []  # type: List[T]
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    shuffle(buffer)
+    yield from buffer
@@ -0,0 +1,110 @@
+from array import array
+from collections import Counter
+from typing import Iterable, List, Sequence
+from typing import Dict  # noqa
+import json
+import os
+import shutil
+import tempfile
+
+from torchtext.data import Example
+import numpy as np
+
+
+class ArrayDataset(object):
+    # A dataset whose examples are stored as flat int32 arrays of symbol ids, one per
+    # attribute, with the offset of every example in a separate int64 array. The arrays
+    # can be memory-mapped from disk, so a corpus needs next to no memory to load.
+    def __init__(self,
+                 names: Sequence[str],
+                 arrays: Dict[str, np.ndarray],
+                 offsets: Dict[str, np.ndarray],
+                 symbols: Dict[str, List[str]]) -> None:
+        if not names:
+            raise ValueError('expected at least one attribute name')
+        for name in names:
+            if name not in arrays or name not in offsets or name not in symbols:
+                raise ValueError(f'missing arrays or symbols of {name}')
+        if len({offsets[name].shape[0] for name in names}) != 1:
+            raise ValueError('expected all attributes to have the same number of examples')
+
+        self.names = list(names)
+        self.arrays = arrays
+        self.offsets = offsets
+        self.symbols = symbols
+
+    @classmethod
+    def from_examples(cls, examples: Iterable[Example], names: Sequence[str]) -> 'ArrayDataset':
+        # Examples are consumed one at a time, so they can be created lazily, and their ids
+        # are collected in compact arrays rather than lists
+        symbol2id = {name: {} for name in names}  # type: Dict[str, Dict[str, int]]
+        ids = {name: array('i') for name in names}
+        offsets = {name: array('q', [0]) for name in names}
+        for ex in examples:
+            for name in names:
+                s2i = symbol2id[name]
+                values = getattr(ex, name)
+                ids[name].extend(s2i.setdefault(v, len(s2i)) for v in values)
+                offsets[name].append(offsets[name][-1] + len(values))
+        return cls(
+            names,
+            {name: np.array(ids[name], dtype=np.int32) for name in names},
+            {name: np.array(offsets[name], dtype=np.int64) for name in names},
+            {name: list(symbol2id[name]) for name in names},
+        )
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'ArrayDataset':
+        with open(os.path.join(path, 'symbols.json'), encoding='utf-8') as f:
+            symbols = json.load(f)
+        names = list(symbols)
+        mmap_mode = 'r' if mmap else None
+        arrays = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in names
+        }
+        offsets = {
+            name: np.load(os.path.join(path, f'{name}.offsets.npy'), mmap_mode=mmap_mode)
+            for name in names
+        }
+        return cls(names, arrays, offsets, symbols)
+
+    def save(self, path: str) -> None:
+        # Write everything to a temporary directory first so no partial dataset is visible
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=parent)
+        try:
+            for name in self.names:
+                np.save(os.path.join(tmpdir, f'{name}.npy'), self.arrays[name])
+                np.save(os.path.join(tmpdir, f'{name}.offsets.npy'), self.offsets[name])
+            with open(os.path.join(tmpdir, 'symbols.json'), 'w', encoding='utf-8') as f:
+                json.dump({name: self.symbols[name] for name in self.names}, f)
+            # mkdtemp makes the directory private to its owner, but a cache may be shared,
+            # so give it the mode any other new directory would get
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpdir, 0o777 & ~umask)
+            os.rename(tmpdir, path)
+        except BaseException:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            # Another process may have saved the same dataset in the meantime
+            if not os.path.isdir(path):
+                raise
+
+    def get(self, name: str, index: int) -> np.ndarray:
+        # Symbol ids of the attribute of the example at the given index
+        offsets = self.offsets[name]
+        return self.arrays[name][offsets[index]:offsets[index + 1]]
+
+    def get_symbols(self, name: str, index: int) -> List[str]:
+        symbols = self.symbols[name]
+        return [symbols[i] for i in self.get(name, index).tolist()]
+
+    def count(self, name: str) -> Counter:
+        # Frequency of every symbol of the attribute over all examples
+        freqs = np.bincount(self.arrays[name], minlength=len(self.symbols[name]))
+        return Counter(dict(zip(self.symbols[name], freqs.tolist())))
+
+    def __len__(self) -> int:
+        return self.offsets[self.names[0]].shape[0] - 1
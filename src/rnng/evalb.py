@@ -0,0 +1,263 @@
+from collections import Counter
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Sequence
+from typing import Set, Tuple
+import logging
+import re
+
+from nltk.tree import Tree
+
+
+Bracket = Tuple[str, int, int]
+
+logger = logging.getLogger(__name__)
+
+
+class EvalbError(Exception):
+    pass
+
+
+class EvalbParams(NamedTuple):
+    # Same options and defaults as evalb when run without a parameter file
+    max_error: int = 10
+    cutoff_len: int = 40
+    labeled: bool = True
+    delete_labels: FrozenSet[str] = frozenset()
+    delete_labels_for_length: FrozenSet[str] = frozenset()
+    equal_labels: Mapping[str, str] = MappingProxyType({})
+
+    @classmethod
+    def from_file(cls, path: str) -> 'EvalbParams':
+        # Read an evalb parameter file such as COLLINS.prm
+        defaults = cls()
+        max_error = defaults.max_error
+        cutoff_len = defaults.cutoff_len
+        labeled = defaults.labeled
+        delete_labels = set()  # type: Set[str]
+        delete_labels_for_length = set()  # type: Set[str]
+        equal_labels = {}  # type: Dict[str, str]
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                # Like evalb, skip blank and comment lines
+                if not fields or fields[0].startswith('#'):
+                    continue
+                key, values = fields[0], fields[1:]
+                if key == 'MAX_ERROR':
+                    max_error = int(values[0])
+                elif key == 'CUTOFF_LEN':
+                    cutoff_len = int(values[0])
+                elif key == 'LABELED':
+                    labeled = bool(int(values[0]))
+                elif key == 'DELETE_LABEL':
+                    delete_labels.add(values[0])
+                elif key == 'DELETE_LABEL_FOR_LENGTH':
+                    delete_labels_for_length.add(values[0])
+                elif key == 'EQ_LABEL':
+                    # All labels in the line are scored as the first one
+                    for label in values[1:]:
+                        equal_labels[label] = values[0]
+                elif key != 'DEBUG':
+                    # evalb ignores unknown keys too
+                    logger.warning('ignoring unknown evalb parameter: %s', key)
+        return cls(
+            max_error=max_error, cutoff_len=cutoff_len, labeled=labeled,
+            delete_labels=frozenset(delete_labels),
+            delete_labels_for_length=frozenset(delete_labels_for_length),
+            equal_labels=MappingProxyType(equal_labels))
+
+    def __reduce__(self):
+        # Mapping proxies cannot be pickled, so the equal labels are pickled as a dict
+        return _make_evalb_params, (tuple(self._replace(equal_labels=dict(self.equal_labels))),)
+
+
+def _make_evalb_params(fields: tuple) -> EvalbParams:
+    params = EvalbParams(*fields)
+    return params._replace(equal_labels=MappingProxyType(dict(params.equal_labels)))
+
+
+class ParsedSentence(NamedTuple):
+    words: List[str]
+    tags: List[str]
+    # Spans are over word positions before deleting any word
+    brackets: Counter
+
+
+def normalize_label(label: str, params: EvalbParams) -> str:
+    # Strip function tags and indices, e.g. NP-SBJ-1 and NP=2 become NP, like evalb does
+    if not label.startswith('-'):
+        label = re.split(r'[-=]', label)[0]
+    return params.equal_labels.get(label, label)
+
+
+def parse_sentence(tree: Tree, params: Optional[EvalbParams] = None) -> ParsedSentence:
+    # tree must have preterminals, which are not counted as brackets
+    if params is None:
+        params = EvalbParams()
+
+    words, tags = [], []  # type: List[str], List[str]
+    brackets = Counter()  # type: Counter
+
+    def visit(node: Tree) -> None:
+        if not isinstance(node, Tree):
+            raise ValueError(f'expected a tree with preterminals, found bare leaf {node!r}')
+        if len(node) == 1 and not isinstance(node[0], Tree):
+            words.append(node[0])
+            tags.append(node.label())
+            return
+        start = len(words)
+        for child in node:
+            visit(child)
+        if node.label() not in params.delete_labels:
+            label = normalize_label(node.label(), params) if params.labeled else ''
+            brackets[(label, start, len(words))] += 1
+
+    visit(tree)
+    return ParsedSentence(words, tags, brackets)
+
+
+def delete_words(brackets: Counter, keep: Sequence[bool]) -> Counter:
+    # Remap spans to word positions after deleting the words not kept, dropping the
+    # brackets left with no words
+    offsets = [0]
+    for k in keep:
+        offsets.append(offsets[-1] + int(k))
+    result = Counter()  # type: Counter
+    for (label, start, end), count in brackets.items():
+        if offsets[start] < offsets[end]:
+            result[(label, offsets[start], offsets[end])] += count
+    return result
+
+
+def count_crossing(gold_brackets: Iterable[Bracket], test_brackets: Iterable[Bracket]) -> int:
+    # Number of test brackets crossing at least one gold bracket
+    gold_spans = {(start, end) for _, start, end in gold_brackets}
+    count = 0
+    for _, start, end in test_brackets:
+        if any(s < start < e < end or start < s < end < e for s, e in gold_spans):
+            count += 1
+    return count
+
+
+class EvalbScorer(object):
+    # Scores labeled brackets like evalb, keeping running counts so adding a sentence only
+    # costs the work for that sentence. The counts are kept both over all sentences and
+    # over the sentences not longer than the cutoff length.
+    def __init__(self, params: Optional[EvalbParams] = None) -> None:
+        if params is None:
+            params = EvalbParams()
+        self.params = params
+        self.counts = Counter()  # type: Counter
+        self.counts_cutoff = Counter()  # type: Counter
+
+    def reset(self) -> None:
+        self.counts.clear()
+        self.counts_cutoff.clear()
+
+    def add(self, gold: Tree, test: Tree) -> None:
+        gold_sent = parse_sentence(gold, self.params)
+        test_sent = parse_sentence(test, self.params)
+        if gold_sent.words != test_sent.words:
+            self.add_error()
+            return
+
+        # Like evalb, the gold POS tags decide which words are deleted in both trees
+        keep = [tag not in self.params.delete_labels for tag in gold_sent.tags]
+        num_correct_tags = sum(
+            1 for k, gt, tt in zip(keep, gold_sent.tags, test_sent.tags)
+            if k and normalize_label(gt, self.params) == normalize_label(tt, self.params)
+        )
+        length = sum(
+            1 for tag in gold_sent.tags if tag not in self.params.delete_labels_for_length)
+        self.add_brackets(
+            delete_words(gold_sent.brackets, keep), delete_words(test_sent.brackets, keep),
+            length=length, num_words=sum(keep), num_correct_tags=num_correct_tags)
+
+    def add_brackets(self,
+                     gold_brackets: Iterable[Bracket],
+                     test_brackets: Iterable[Bracket],
+                     length: int = 0,
+                     num_words: int = 0,
+                     num_correct_tags: int = 0) -> None:
+        gold_counter = Counter(gold_brackets)
+        test_counter = Counter(test_brackets)
+        num_matched = sum((gold_counter & test_counter).values())
+        num_gold = sum(gold_counter.values())
+        num_test = sum(test_counter.values())
+        num_crossing = count_crossing(gold_counter.elements(), test_counter.elements())
+        counts = Counter(
+            num_sentences=1,
+            num_matched=num_matched,
+            num_gold=num_gold,
+            num_test=num_test,
+            num_crossing=num_crossing,
+            num_complete_match=int(num_matched == num_gold == num_test),
+            num_no_crossing=int(num_crossing == 0),
+            num_words=num_words,
+            num_correct_tags=num_correct_tags,
+        )
+        self.counts.update(counts)
+        if length <= self.params.cutoff_len:
+            self.counts_cutoff.update(counts)
+
+    def merge(self, other: 'EvalbScorer') -> None:
+        # Add the counts of another scorer, e.g. one run by another worker process
+        if other.params != self.params:
+            raise ValueError('cannot merge scorers with different parameters')
+        self.counts.update(other.counts)
+        self.counts_cutoff.update(other.counts_cutoff)
+
+    def add_error(self) -> None:
+        self.counts['num_errors'] += 1
+        if self.counts['num_errors'] > self.params.max_error:
+            raise EvalbError(f'too many errors: {self.counts["num_errors"]}')
+
+    @property
+    def recall(self) -> float:
+        return get_recall(self.counts)
+
+    @property
+    def precision(self) -> float:
+        return get_precision(self.counts)
+
+    @property
+    def f1(self) -> float:
+        return get_f1(self.counts)
+
+    @property
+    def f1_cutoff(self) -> float:
+        return get_f1(self.counts_cutoff)
+
+    @property
+    def complete_match(self) -> float:
+        return _percent(self.counts['num_complete_match'], self.counts['num_sentences'])
+
+    @property
+    def tagging_accuracy(self) -> float:
+        return _percent(self.counts['num_correct_tags'], self.counts['num_words'])
+
+
+class F1Meter(EvalbScorer):
+    # Torchnet-style meter of the bracketing F1. Only the bracket counts are kept, so the
+    # value is computed in constant time and meters are cheap to pickle and merge.
+    def value(self) -> float:
+        return self.f1
+
+
+def get_recall(counts: Counter) -> float:
+    return _percent(counts['num_matched'], counts['num_gold'])
+
+
+def get_precision(counts: Counter) -> float:
+    return _percent(counts['num_matched'], counts['num_test'])
+
+
+def get_f1(counts: Counter) -> float:
+    recall, precision = get_recall(counts), get_precision(counts)
+    if recall + precision == 0.:
+        return 0.
+    return 2. * recall * precision / (recall + precision)
+
+
+def _percent(numerator: int, denominator: int) -> float:
+    return 100. * numerator / denominator if denominator else 0.
@@ -1,8 +1,11 @@
 from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+import itertools
 
 from torch.autograd import Variable
 from torchtext.data import Field
 from torchtext.vocab import Vocab
+import numpy as np
 
 from rnng.actions import NT, REDUCE, SHIFT
 
@@ -21,17 +24,60 @@ class ActionField(Field):
         self.vocab = Vocab(Counter(), specials=specials)
 
     def numericalize(self, arr, **kwargs) -> Variable:
-        arr = [[self._actionstr2id(s) for s in ex] for ex in arr]
+        lengths = None
+        if isinstance(arr, tuple):
+            arr, lengths = arr
+        # Only the lookup is vectorized, torchtext makes the tensor (postprocessing and
+        # tensor type included) with the vocabulary lookup disabled
+        arr = self.get_action_ids(arr).tolist()
+        if lengths is not None:
+            arr = (arr, lengths)
         old_use_vocab = self.use_vocab  # type: ignore
         self.use_vocab = False
-        arr = super().numericalize(arr, **kwargs)
-        self.use_vocab = old_use_vocab
-        return arr
-
-    def _actionstr2id(self, s: str) -> int:
-        if s in self.vocab.stoi:
-            return self.vocab.stoi[s]
-        # must be an unknown NT action, so we map it to NT(<unk>)
-        action = NT(self.nonterm_field.unk_token)
-        assert action in self.vocab.stoi
-        return self.vocab.stoi[action]
+        try:
+            return super().numericalize(arr, **kwargs)
+        finally:
+            self.use_vocab = old_use_vocab
+
+    def get_action_ids(self, arr: Sequence[Sequence[Optional[str]]]) -> np.ndarray:
+        # Look up a batch of equally long (i.e. padded) action sequences all at once.
+        # Padding (if any) is mapped to NT(<unk>) like any unknown NT action, it is masked
+        # out by the lengths anyway.
+        # The lookups run in C through map and dict.get. Finding the distinct actions with
+        # np.unique first is slower, as making an array of the strings alone costs as much.
+        table, unk_id = self._get_action_table()
+        flat = list(itertools.chain.from_iterable(arr))
+        ids = np.fromiter(
+            map(table.get, flat, itertools.repeat(unk_id)), dtype=np.int64, count=len(flat))
+        return ids.reshape(len(arr), len(arr[0]) if arr else 0)
+
+    def _get_action_table(self) -> Tuple[Dict[Optional[str], int], int]:
+        # Cached along with the vocabulary it is made from, so a new vocabulary gets a new
+        # table. Fields pickled before the table existed get one too. Its keys are typed as
+        # optional since padding is looked up in it as well.
+        cached = getattr(self, '_action_table', None)
+        if cached is None or cached[0] is not self.vocab:
+            # Any unknown action must be an unknown NT action, so it is mapped to NT(<unk>)
+            unk_action = NT(self.nonterm_field.unk_token)
+            assert unk_action in self.vocab.stoi
+            cached = (self.vocab, dict(self.vocab.stoi), self.vocab.stoi[unk_action])
+            self._action_table = cached
+        return cached[1], cached[2]
+
+
+def get_token_ids(field: Field, tokens: Sequence[Optional[str]]) -> List[int]:
+    # Map tokens to their ids in the vocabulary of the field, like numericalize does
+    if isinstance(field, ActionField):
+        return field.get_action_ids([tokens])[0].tolist()
+    return [field.vocab.stoi[s] for s in tokens]
+
+
+def make_fields(lower: bool = True) -> List[Tuple[str, Field]]:
+    # Fields of the examples made from discriminative oracles, in the order of make_example
+    words = Field(pad_token='<pad>', lower=lower, include_lengths=True)
+    pos_tags = Field(pad_token='<pad>')
+    nonterms = Field(pad_token=None)
+    actions = ActionField(nonterms, include_lengths=True)
+    return [
+        ('actions', actions), ('nonterms', nonterms), ('pos_tags', pos_tags), ('words', words),
+    ]
@@ -1,11 +1,135 @@
-from typing import Optional
+from typing import Callable, Iterable, Iterator as IteratorType, Optional, Sequence, Tuple
+import itertools
+import math
+import random
 
-from torchtext.data import Dataset, Iterator
+from torch.autograd import Variable
+from torchtext.data import Batch, Dataset, Example, Field, Iterator
+import numpy as np
+import torch
+
+from rnng.corpus import shuffle_buffer
+from rnng.dataset import ArrayDataset
+from rnng.fields import get_token_ids
 
 
 class SimpleIterator(Iterator):
     def __init__(self,
                  dataset: Dataset,
                  train: bool = True,
+                 device: Optional[int] = None,
+                 batch_size: int = 1) -> None:
+        super().__init__(
+            dataset, batch_size, train=train, repeat=False, sort=False, device=device)
+
+
+class ArrayIterator(object):
+    # Iterates over batches of an ArrayDataset, producing the same batches a SimpleIterator
+    # would for the equivalent torchtext dataset
+    def __init__(self,
+                 dataset: ArrayDataset,
+                 fields: Sequence[Tuple[str, Field]],
+                 batch_size: int = 1,
+                 train: bool = True,
                  device: Optional[int] = None) -> None:
-        super().__init__(dataset, 1, train=train, repeat=False, sort=False, device=device)
+        if batch_size <= 0:
+            raise ValueError(f'nonpositive batch size: {batch_size}')
+        for name, _ in fields:
+            if name not in dataset.names:
+                raise ValueError(f'dataset has no attribute named {name}')
+
+        self.dataset = dataset
+        self.fields = list(fields)
+        self.batch_size = batch_size
+        self.train = train
+        self.device = device
+        self._lookups = None  # type: Optional[dict]
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self) -> IteratorType[Batch]:
+        if self._lookups is None:
+            self._lookups = self._make_lookups()
+        if self.train:
+            # Seeded from the random module so training runs are reproducible
+            rng = np.random.RandomState(random.getrandbits(32))
+            order = rng.permutation(len(self.dataset))
+        else:
+            order = np.arange(len(self.dataset))
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size].tolist()
+            yield self._make_batch(indices)
+
+    def _make_lookups(self) -> dict:
+        # Map the symbol ids of the dataset to the vocabulary ids of the fields, with the
+        # padding id at the end
+        lookups = {}
+        for name, field in self.fields:
+            tokens = list(self.dataset.symbols[name]) + [field.pad_token]
+            lookups[name] = np.array(get_token_ids(field, tokens), dtype=np.int64)
+        return lookups
+
+    def _make_batch(self, indices: Sequence[int]) -> Batch:
+        assert self._lookups is not None
+        data = {}
+        for name, field in self.fields:
+            lookup = self._lookups[name]
+            seqs = [self.dataset.get(name, i) for i in indices]
+            lengths = [len(seq) for seq in seqs]
+            # (seq_length, batch_size)
+            arr = np.full((max(lengths), len(seqs)), lookup[-1], dtype=np.int64)
+            for j, seq in enumerate(seqs):
+                arr[:len(seq), j] = lookup[seq]
+            tensor = torch.from_numpy(arr)
+            if self.device != -1:
+                tensor = tensor.cuda(self.device)
+            var = Variable(tensor, volatile=not self.train)
+            data[name] = (var, torch.LongTensor(lengths)) if field.include_lengths else var
+        return Batch.fromvars(self.dataset, len(indices), train=self.train, **data)
+
+
+class StreamingIterator(object):
+    # Iterates over batches of examples created lazily by make_examples, which is called
+    # again for every epoch. Training examples are shuffled with a bounded buffer, so at
+    # most buffer_size examples are in memory at once.
+    def __init__(self,
+                 make_examples: Callable[[], Iterable[Example]],
+                 fields: Sequence[Tuple[str, Field]],
+                 batch_size: int = 1,
+                 train: bool = True,
+                 device: Optional[int] = None,
+                 buffer_size: int = 10000) -> None:
+        if batch_size <= 0:
+            raise ValueError(f'nonpositive batch size: {batch_size}')
+        if buffer_size <= 0:
+            raise ValueError(f'nonpositive buffer size: {buffer_size}')
+
+        self.make_examples = make_examples
+        self.fields = list(fields)
+        self.batch_size = batch_size
+        self.train = train
+        self.device = device
+        self.buffer_size = buffer_size
+        # Batches hold a reference to a dataset to get the fields from
+        self.dataset = Dataset([], self.fields)
+        self._num_batches = None  # type: Optional[int]
+
+    def __len__(self) -> int:
+        # Only known once a whole epoch has been read
+        if self._num_batches is None:
+            raise TypeError('length is unknown until the first epoch is done')
+        return self._num_batches
+
+    def __iter__(self) -> IteratorType[Batch]:
+        examples = iter(self.make_examples())
+        if self.train:
+            examples = shuffle_buffer(examples, self.buffer_size)
+        num_batches = 0
+        while True:
+            minibatch = list(itertools.islice(examples, self.batch_size))
+            if not minibatch:
+                break
+            num_batches += 1
+            yield Batch(minibatch, self.dataset, device=self.device, train=self.train)
+        self._num_batches = num_batches
@@ -1,14 +1,27 @@
-from typing import List, NamedTuple, Optional, Sequence, Sized, Tuple, Union, cast
+from typing import Any, List, NamedTuple, Optional, Sequence, Sized, Tuple, Union, cast
 from typing import Dict  # noqa
+import heapq
+import itertools
 
 from nltk.tree import Tree
 from torch.autograd import Variable
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
 
-from rnng.typing import WordId, NTId, ActionId
+from rnng.typing import WordId, ActionId
+
+
+# Lengths and stack operations may be given as a list or as a tensor of the batch
+IntSequence = Union[Sequence[int], torch.LongTensor]
+
+
+def to_int_list(values: IntSequence) -> List[int]:
+    if isinstance(values, (list, tuple)):
+        return list(values)
+    return cast(torch.LongTensor, values).tolist()
 
 
 class EmptyStackError(Exception):
@@ -16,6 +29,175 @@ class EmptyStackError(Exception):
         super().__init__('stack is already empty')
 
 
+def fused_lstm_step(inputs: torch.Tensor,
+                    hidden: torch.Tensor,
+                    cell: torch.Tensor,
+                    weight: torch.Tensor,
+                    bias: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Annotated with tensors rather than variables for TorchScript to compile it
+    # inputs: (batch_size, input_size)
+    # hidden, cell: (batch_size, hidden_size)
+    # weight: (4 * hidden_size, input_size + hidden_size), bias: (4 * hidden_size,)
+    # The gates are ordered as in nn.LSTM: input, forget, cell, and output
+    gates = torch.mm(torch.cat([inputs, hidden], 1), weight.t()) + bias
+    i, f, g, o = gates.chunk(4, 1)
+    cell = torch.sigmoid(f) * cell + torch.sigmoid(i) * torch.tanh(g)
+    hidden = torch.sigmoid(o) * torch.tanh(cell)
+    return hidden, cell
+
+
+_scripted_lstm_step = None
+
+
+def get_lstm_step(use_jit: bool = False):
+    # TorchScript compiles the step once, where it is available
+    global _scripted_lstm_step
+    if not use_jit or not hasattr(torch, 'jit'):
+        return fused_lstm_step
+    if _scripted_lstm_step is None:
+        _scripted_lstm_step = torch.jit.script(fused_lstm_step)
+    return _scripted_lstm_step
+
+
+class FusedLSTM(nn.Module):
+    # A replacement for nn.LSTM that computes all the gates of a layer with a single matrix
+    # multiplication over the concatenated input and hidden state. It avoids the overhead of
+    # the generic RNN implementation, which dominates the single steps of stack LSTMs. Pass
+    # it as lstm_class, with functools.partial to set use_jit.
+    def __init__(self,
+                 input_size: int,
+                 hidden_size: int,
+                 num_layers: int = 1,
+                 dropout: float = 0.,
+                 use_jit: bool = False) -> None:
+        if input_size <= 0:
+            raise ValueError(f'nonpositive input size: {input_size}')
+        if hidden_size <= 0:
+            raise ValueError(f'nonpositive hidden size: {hidden_size}')
+        if num_layers <= 0:
+            raise ValueError(f'nonpositive number of layers: {num_layers}')
+        if dropout < 0. or dropout >= 1.:
+            raise ValueError(f'invalid dropout rate: {dropout}')
+
+        super().__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.use_jit = use_jit
+        for k in range(num_layers):
+            layer_input_size = input_size if k == 0 else hidden_size
+            setattr(self, f'weight_l{k}', nn.Parameter(
+                torch.Tensor(4 * hidden_size, layer_input_size + hidden_size)))
+            setattr(self, f'bias_l{k}', nn.Parameter(torch.Tensor(4 * hidden_size)))
+
+        self.reset_parameters()
+
+    def reset_parameters(self) -> None:
+        # Same as nn.LSTM
+        bound = 1. / self.hidden_size ** 0.5
+        for param in self.parameters():
+            init.uniform(param, -bound, bound)
+
+    @classmethod
+    def from_lstm(cls, lstm: nn.LSTM, use_jit: bool = False) -> 'FusedLSTM':
+        # A fused LSTM computing the same function as the given unidirectional LSTM
+        fused = cls(lstm.input_size, lstm.hidden_size, num_layers=lstm.num_layers,
+                    dropout=lstm.dropout, use_jit=use_jit)
+        for k in range(lstm.num_layers):
+            weight = torch.cat([
+                getattr(lstm, f'weight_ih_l{k}').data, getattr(lstm, f'weight_hh_l{k}').data
+            ], 1)
+            getattr(fused, f'weight_l{k}').data.copy_(weight)
+            bias = getattr(fused, f'bias_l{k}').data.zero_()
+            if lstm.bias:
+                bias.add_(getattr(lstm, f'bias_ih_l{k}').data)
+                bias.add_(getattr(lstm, f'bias_hh_l{k}').data)
+        return fused
+
+    def forward(self,
+                inputs: Union[Variable, PackedSequence],
+                states: Optional[Tuple[Variable, Variable]] = None,
+                ) -> Tuple[Union[Variable, PackedSequence], Tuple[Variable, Variable]]:
+        # inputs: (seq_length, batch_size, input_size) or a packed sequence of those
+        # states: (num_layers, batch_size, hidden_size) each
+        # Returns the outputs of the last layer like the inputs, and the states after the
+        # last step of every sequence
+        if isinstance(inputs, PackedSequence):
+            data = inputs.data
+            batch_sizes = [int(n) for n in inputs.batch_sizes]
+        else:
+            data = inputs.view(-1, self.input_size)
+            batch_sizes = [inputs.size(1)] * inputs.size(0)
+        if data.size(1) != self.input_size:
+            raise ValueError(f'expected input size of {self.input_size}, got {data.size(1)}')
+        # Packed sequences may be reordered to be longest first
+        sorted_indices = getattr(inputs, 'sorted_indices', None)
+        unsorted_indices = getattr(inputs, 'unsorted_indices', None)
+
+        batch_size = batch_sizes[0]
+        if states is None:
+            zeros = Variable(data.data.new(self.num_layers, batch_size, self.hidden_size).zero_())
+            states = (zeros, zeros)
+        elif sorted_indices is not None:
+            states = (states[0].index_select(1, sorted_indices),
+                      states[1].index_select(1, sorted_indices))
+        hiddens = [states[0][k] for k in range(self.num_layers)]
+        cells = [states[1][k] for k in range(self.num_layers)]
+        weights = [getattr(self, f'weight_l{k}') for k in range(self.num_layers)]
+        biases = [getattr(self, f'bias_l{k}') for k in range(self.num_layers)]
+        step = get_lstm_step(self.use_jit)
+
+        outputs = []
+        # States of the sequences that ended, the later ones first
+        final_states = []  # type: List[Tuple[List[Variable], List[Variable]]]
+        offset = 0
+        for n in batch_sizes:
+            if n < hiddens[0].size(0):
+                final_states.append(([h[n:] for h in hiddens], [c[n:] for c in cells]))
+                hiddens = [h[:n] for h in hiddens]
+                cells = [c[:n] for c in cells]
+            x = data[offset:offset + n]
+            offset += n
+            for k in range(self.num_layers):
+                hiddens[k], cells[k] = step(x, hiddens[k], cells[k], weights[k], biases[k])
+                x = hiddens[k]
+                if k < self.num_layers - 1:
+                    x = F.dropout(x, p=self.dropout, training=self.training)
+            outputs.append(x)
+        final_states.append((hiddens, cells))
+        final_states.reverse()
+
+        # shape: (num_layers, batch_size, hidden_size)
+        h_n = torch.stack([
+            torch.cat([h[k] for h, _ in final_states]) for k in range(self.num_layers)])
+        c_n = torch.stack([
+            torch.cat([c[k] for _, c in final_states]) for k in range(self.num_layers)])
+        if unsorted_indices is not None:
+            h_n = h_n.index_select(1, unsorted_indices)
+            c_n = c_n.index_select(1, unsorted_indices)
+        if isinstance(inputs, PackedSequence):
+            return type(inputs)(torch.cat(outputs), *inputs[1:]), (h_n, c_n)
+        return torch.stack(outputs), (h_n, c_n)
+
+    def __repr__(self) -> str:
+        res = ('{}(input_size={input_size}, hidden_size={hidden_size}, '
+               'num_layers={num_layers}, dropout={dropout}, use_jit={use_jit})')
+        return res.format(self.__class__.__name__, **self.__dict__)
+
+
+class StackNode(NamedTuple):
+    # A node of a persistent stack LSTM. Pushing creates a new node pointing to its parent
+    # and popping returns the parent, so stacks that share a prefix share its nodes and
+    # LSTM states instead of copying them. Nodes without states can be popped to but not
+    # pushed onto.
+    value: Any
+    states: Optional[Tuple[Variable, Variable]]
+    output: Optional[Variable]
+    parent: Optional['StackNode']
+    size: int
+
+
 class StackLSTM(nn.Module, Sized):
     BATCH_SIZE = 1
     SEQ_LEN = 1
@@ -91,6 +273,112 @@ class StackLSTM(nn.Module, Sized):
         # outputs: hidden_size
         return self._outputs_hist[-1].squeeze() if self._outputs_hist else None
 
+    def root_node(self) -> StackNode:
+        return StackNode(None, (self.h0, self.c0), None, None, 0)
+
+    def push_nodes(self,
+                   nodes: Sequence[StackNode],
+                   inputs: Variable,
+                   values: Sequence[Any]) -> List[StackNode]:
+        # inputs: (num_nodes, input_size)
+        # Push inputs[i] on top of nodes[i] for every i with a single LSTM call
+        if inputs.size() != (len(nodes), self.input_size):
+            raise ValueError(
+                f'expected input to have size ({len(nodes)}, {self.input_size}), '
+                f'got {tuple(inputs.size())}'
+            )
+        if len(values) != len(nodes):
+            raise ValueError(f'expected {len(nodes)} values, got {len(values)}')
+        if any(node.states is None for node in nodes):
+            raise ValueError('cannot push onto a node without states')
+        states = [node.states for node in nodes if node.states is not None]
+
+        # (num_layers, num_nodes, hidden_size)
+        prev_h = torch.cat([h for h, _ in states], dim=1)
+        prev_c = torch.cat([c for _, c in states], dim=1)
+        # Set seq_len to 1
+        outputs, (next_h, next_c) = self.lstm(inputs.unsqueeze(0), (prev_h, prev_c))
+        return [
+            StackNode(value, (next_h[:, i:i + 1], next_c[:, i:i + 1]), outputs[0, i], node,
+                      node.size + 1)
+            for i, (node, value) in enumerate(zip(nodes, values))
+        ]
+
+    def push_sequence(self,
+                      node: StackNode,
+                      inputs: Variable,
+                      values: Sequence[Any]) -> List[StackNode]:
+        # inputs: (seq_length, input_size)
+        # Push the inputs on top of the node one after another with a single LSTM call. The
+        # LSTM only gives the states after the last input, so that is the only new node that
+        # can be pushed onto.
+        if inputs.dim() != 2 or inputs.size(1) != self.input_size:
+            raise ValueError(
+                f'expected input to have size (seq_length, {self.input_size}), '
+                f'got {tuple(inputs.size())}'
+            )
+        if len(values) != inputs.size(0):
+            raise ValueError(f'expected {inputs.size(0)} values, got {len(values)}')
+        if node.states is None:
+            raise ValueError('cannot push onto a node without states')
+
+        # Set batch_size to 1
+        outputs, states = self.lstm(inputs.unsqueeze(1), node.states)
+        nodes = []
+        for i, value in enumerate(values):
+            node = StackNode(value, states if i == len(values) - 1 else None, outputs[i, 0],
+                             node, node.size + 1)
+            nodes.append(node)
+        return nodes
+
+    def push_tree(self, parents: Sequence[int], inputs: Variable) -> Variable:
+        # inputs: (num_nodes, input_size)
+        # Push inputs[i] on top of the node of inputs[parents[i]], or onto an empty stack if
+        # parents[i] is negative, and return the outputs of all nodes. Parents come before
+        # their children. Nodes at the same depth are pushed with one LSTM call, so there are
+        # as many calls as the tree is deep.
+        if inputs.size() != (len(parents), self.input_size):
+            raise ValueError(
+                f'expected input to have size ({len(parents)}, {self.input_size}), '
+                f'got {tuple(inputs.size())}'
+            )
+        if any(p >= i for i, p in enumerate(parents)):
+            raise ValueError('parents must come before their children')
+        if not parents:
+            return Variable(self.h0.data.new())
+
+        depths = []  # type: List[int]
+        for p in parents:
+            depths.append(0 if p < 0 else depths[p] + 1)
+        levels = [[] for _ in range(max(depths) + 1)]  # type: List[List[int]]
+        # Column of every node in the states of its level
+        columns = []
+        for i, d in enumerate(depths):
+            columns.append(len(levels[d]))
+            levels[d].append(i)
+
+        size = (self.num_layers, len(levels[0]), self.hidden_size)
+        states = (self.h0.expand(*size).contiguous(), self.c0.expand(*size).contiguous())
+        level_outputs = []
+        for d, level in enumerate(levels):
+            if d > 0:
+                # States of the parents in the previous level: (num_layers, len(level), hidden_size)
+                index = Variable(self.h0.data.new([columns[parents[i]] for i in level]).long())
+                states = (states[0].index_select(1, index), states[1].index_select(1, index))
+            index = Variable(self.h0.data.new(level).long())
+            # Set seq_len to 1
+            outputs, states = self.lstm(inputs.index_select(0, index).unsqueeze(0), states)
+            level_outputs.append(outputs.squeeze(0))
+
+        # Back to the order of the inputs
+        offsets = [0]
+        for level in levels:
+            offsets.append(offsets[-1] + len(level))
+        rows = [offsets[d] + c for d, c in zip(depths, columns)]
+        # (num_nodes, hidden_size)
+        return torch.cat(level_outputs).index_select(
+            0, Variable(self.h0.data.new(rows).long()))
+
     def __repr__(self) -> str:
         res = ('{}(input_size={input_size}, hidden_size={hidden_size}, '
                'num_layers={num_layers}, dropout={dropout})')
@@ -100,6 +388,473 @@ class StackLSTM(nn.Module, Sized):
         return len(self._outputs_hist)
 
 
+class PreallocatedStackLSTM(StackLSTM):
+    # A StackLSTM that keeps its history in (capacity, num_layers, hidden_size) state and
+    # (capacity, hidden_size) output tensors instead of lists, with the size as the top
+    # pointer. Row k holds the states and output after k + 1 pushes, and the tensors double
+    # in capacity when full. Rows are written out of place, so the history stays in the
+    # autograd graph in both modes, and the states returned by push and pop are not views
+    # of it. Popping only moves the pointer.
+    INITIAL_CAPACITY = 16
+
+    def __init__(self,
+                 input_size: int,
+                 hidden_size: int,
+                 num_layers: int = 1,
+                 dropout: float = 0.,
+                 lstm_class=None) -> None:
+        super().__init__(
+            input_size, hidden_size, num_layers=num_layers, dropout=dropout,
+            lstm_class=lstm_class)
+        self._size = 0
+        self._hiddens = None  # type: Optional[Variable]
+        self._cells = None  # type: Optional[Variable]
+        self._outputs = None  # type: Optional[Variable]
+        # Row k is the index to write row k of the history with
+        self._rows = None  # type: Optional[Variable]
+
+    def forward(self, inputs: Variable) -> Tuple[Variable, Variable]:
+        if inputs.size() != (self.input_size,):
+            raise ValueError(
+                f'expected input to have size ({self.input_size},), got {tuple(inputs.size())}'
+            )
+
+        # Set seq_len and batch_size to 1
+        inputs = inputs.view(self.SEQ_LEN, self.BATCH_SIZE, inputs.numel())
+        next_outputs, next_states = self.lstm(inputs, self._get_states(self._size))
+        self._ensure_capacity(self._size + 1)
+        assert self._hiddens is not None and self._cells is not None
+        assert self._outputs is not None and self._rows is not None
+        row = self._rows[self._size:self._size + 1]
+        size = (1, self.num_layers, self.hidden_size)
+        self._hiddens = self._hiddens.index_copy(0, row, next_states[0].view(*size))
+        self._cells = self._cells.index_copy(0, row, next_states[1].view(*size))
+        self._outputs = self._outputs.index_copy(0, row, next_outputs.view(1, -1))
+        self._size += 1
+        return next_states
+
+    def pop(self) -> Tuple[Variable, Variable]:
+        if not self._size:
+            raise EmptyStackError()
+        states = self._get_states(self._size)
+        self._size -= 1
+        return states
+
+    @property
+    def top(self) -> Variable:
+        # outputs: hidden_size
+        if not self._size:
+            return None
+        assert self._outputs is not None
+        return self._outputs[self._size - 1].clone()
+
+    def __len__(self):
+        return self._size
+
+    def _get_states(self, size: int) -> Tuple[Variable, Variable]:
+        # States after size pushes: (num_layers, 1, hidden_size) each. They are copied out
+        # so that neither the caller nor the LSTM holds on to the whole history.
+        if not size:
+            return self.h0, self.c0
+        assert self._hiddens is not None and self._cells is not None
+        return (self._hiddens[size - 1].unsqueeze(1).clone(),
+                self._cells[size - 1].unsqueeze(1).clone())
+
+    def _ensure_capacity(self, capacity: int) -> None:
+        old_capacity = 0 if self._rows is None else self._rows.size(0)
+        if capacity <= old_capacity:
+            return
+
+        new_capacity = max(old_capacity, self.INITIAL_CAPACITY)
+        while new_capacity < capacity:
+            new_capacity *= 2
+        extra = new_capacity - old_capacity
+        new_states = Variable(self.h0.data.new(extra, self.num_layers, self.hidden_size).zero_())
+        new_outputs = Variable(self.h0.data.new(extra, self.hidden_size).zero_())
+        if self._hiddens is None or self._cells is None or self._outputs is None:
+            self._hiddens, self._cells, self._outputs = new_states, new_states, new_outputs
+        else:
+            self._hiddens = torch.cat([self._hiddens, new_states])
+            self._cells = torch.cat([self._cells, new_states])
+            self._outputs = torch.cat([self._outputs, new_outputs])
+        self._rows = Variable(torch.arange(0, new_capacity).type_as(self.h0.data).long())
+
+
+class BatchedStep(NamedTuple):
+    # States and outputs of the stacks pushed onto by one LSTM call of a BatchedStackLSTM
+    hiddens: Variable
+    cells: Variable
+    outputs: Variable
+
+
+class BatchedStackLSTM(nn.Module):
+    # Operations on a single stack; a negative number -n pops n elements at once
+    PUSH = 1
+    NOOP = 0
+    POP = -1
+
+    def __init__(self,
+                 input_size: int,
+                 hidden_size: int,
+                 num_layers: int = 1,
+                 dropout: float = 0.,
+                 lstm_class=None) -> None:
+        if input_size <= 0:
+            raise ValueError(f'nonpositive input size: {input_size}')
+        if hidden_size <= 0:
+            raise ValueError(f'nonpositive hidden size: {hidden_size}')
+        if num_layers <= 0:
+            raise ValueError(f'nonpositive number of layers: {num_layers}')
+        if dropout < 0. or dropout >= 1.:
+            raise ValueError(f'invalid dropout rate: {dropout}')
+
+        if lstm_class is None:
+            lstm_class = nn.LSTM
+
+        super().__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.lstm = lstm_class(input_size, hidden_size, num_layers=num_layers, dropout=dropout)
+        self.h0 = nn.Parameter(torch.Tensor(num_layers, 1, hidden_size))
+        self.c0 = nn.Parameter(torch.Tensor(num_layers, 1, hidden_size))
+        self._init_stacks()
+
+        self.reset_parameters()
+
+    def _init_stacks(self) -> None:
+        self._steps = []  # type: List[BatchedStep]
+        self._stacks = []  # type: List[List[Tuple[int, int]]]
+
+    def reset_parameters(self) -> None:
+        for name, param in self.lstm.named_parameters():
+            if name.startswith('weight'):
+                init.orthogonal(param)
+            else:
+                assert name.startswith('bias')
+                init.constant(param, 0.)
+        init.constant(self.h0, 0.)
+        init.constant(self.c0, 0.)
+
+    @classmethod
+    def from_stack_lstm(cls, stack_lstm: StackLSTM) -> 'BatchedStackLSTM':
+        # The returned module shares its LSTM and initial states with the given stack LSTM,
+        # so it is made without running the constructor, which would make an LSTM of its own
+        batched = cls.__new__(cls)
+        nn.Module.__init__(batched)
+        batched.input_size = stack_lstm.input_size
+        batched.hidden_size = stack_lstm.hidden_size
+        batched.num_layers = stack_lstm.num_layers
+        batched.dropout = stack_lstm.dropout
+        batched.lstm = stack_lstm.lstm
+        batched.h0 = stack_lstm.h0
+        batched.c0 = stack_lstm.c0
+        batched._init_stacks()
+        return batched
+
+    @property
+    def batch_size(self) -> int:
+        return len(self._stacks)
+
+    @property
+    def lengths(self) -> List[int]:
+        return [len(stack) - 1 for stack in self._stacks]
+
+    def reset(self, batch_size: int) -> None:
+        if batch_size <= 0:
+            raise ValueError(f'nonpositive batch size: {batch_size}')
+
+        # Every LSTM call is a step whose states and outputs are kept as they are, and a
+        # stack is the list of (step, column) of its elements, bottom first. Step 0 holds
+        # the initial states and the zero output of an empty stack. Pushing appends a step
+        # and popping truncates the lists, so nothing is ever written in place.
+        zeros = Variable(self._new(1, self.hidden_size).zero_())
+        self._steps = [BatchedStep(self.h0, self.c0, zeros)]
+        self._stacks = [[(0, 0)] for _ in range(batch_size)]
+
+    def forward(self, inputs: Variable, ops: IntSequence) -> Variable:
+        # inputs: (batch_size, input_size)
+        # ops: (batch_size,)
+        if not self._stacks:
+            raise RuntimeError('stacks are not initialized, call reset() first')
+        if inputs.size() != (self.batch_size, self.input_size):
+            raise ValueError(
+                f'expected input to have size ({self.batch_size}, {self.input_size}), '
+                f'got {tuple(inputs.size())}'
+            )
+        ops = self._check_ops(ops)
+
+        # Pops and no-ops only truncate the stacks, all pushes share a single LSTM call
+        push_ids = []
+        for i, op in enumerate(ops):
+            if op == self.PUSH:
+                push_ids.append(i)
+            elif op < 0:
+                del self._stacks[i][op:]
+        if push_ids:
+            self._push(inputs, push_ids)
+        return self.top
+
+    def push(self, *args, **kwargs):
+        return self(*args, **kwargs)
+
+    def pop(self, num_pops: IntSequence) -> Variable:
+        if not self._stacks:
+            raise RuntimeError('stacks are not initialized, call reset() first')
+        num_pops = to_int_list(num_pops)
+        if any(n < 0 for n in num_pops):
+            raise ValueError('number of pops must be nonnegative')
+        ops = self._check_ops([-n for n in num_pops])
+        for i, op in enumerate(ops):
+            if op < 0:
+                del self._stacks[i][op:]
+        return self.top
+
+    def select(self, indices: Sequence[int]) -> None:
+        # Keep only the stacks at the given indices, in that order
+        if not indices:
+            raise ValueError('cannot select an empty set of stacks')
+        if any(i < 0 or i >= self.batch_size for i in indices):
+            raise IndexError('stack index out of range')
+        self._stacks = [list(self._stacks[i]) for i in indices]
+
+    @property
+    def top(self) -> Optional[Variable]:
+        # outputs: (batch_size, hidden_size)
+        # the top of an empty stack is a zero vector
+        if not self._stacks:
+            return None
+        outputs, = self._gather([stack[-1] for stack in self._stacks], ['outputs'])
+        return outputs
+
+    def _push(self, inputs: Variable, push_ids: List[int]) -> None:
+        # (num_layers, num_push, hidden_size) each
+        prev_h, prev_c = self._gather(
+            [self._stacks[i][-1] for i in push_ids], ['hiddens', 'cells'])
+        if len(push_ids) < self.batch_size:
+            inputs = inputs.index_select(0, Variable(self._new(push_ids).long()))
+        # Set seq_len to 1
+        outputs, (next_h, next_c) = self.lstm(inputs.unsqueeze(0), (prev_h, prev_c))
+        step = len(self._steps)
+        self._steps.append(BatchedStep(next_h, next_c, outputs.squeeze(0)))
+        for k, i in enumerate(push_ids):
+            self._stacks[i].append((step, k))
+
+    def _gather(self, elements: Sequence[Tuple[int, int]], names: Sequence[str]) -> List[Variable]:
+        # The given fields of the given (step, column) elements, concatenating the steps
+        # they come from and selecting their columns, or as is if they are a whole step
+        steps = sorted({step for step, _ in elements})
+        offsets = {}  # type: Dict[int, int]
+        num_columns = 0
+        for step in steps:
+            offsets[step] = num_columns
+            num_columns += self._steps[step].outputs.size(0)
+        columns = [offsets[step] + column for step, column in elements]
+        index = None
+        if columns != list(range(num_columns)):
+            index = Variable(self._new(columns).long())
+
+        results = []
+        for name in names:
+            # Columns are in the batch dimension, which is the second one of the states
+            dim = 0 if name == 'outputs' else 1
+            tensors = [getattr(self._steps[step], name) for step in steps]
+            tensor = tensors[0] if len(tensors) == 1 else torch.cat(tensors, dim=dim)
+            results.append(tensor if index is None else tensor.index_select(dim, index))
+        return results
+
+    def _check_ops(self, ops: IntSequence) -> List[int]:
+        ops = to_int_list(ops)
+        if len(ops) != self.batch_size:
+            raise ValueError(f'expected {self.batch_size} operations, got {len(ops)}')
+        if any(op > self.PUSH for op in ops):
+            raise ValueError('can only push one element at a time')
+        if any(len(self._stacks[i]) - 1 + op < 0 for i, op in enumerate(ops) if op < 0):
+            raise EmptyStackError()
+        return list(ops)
+
+    def _new(self, *args, **kwargs) -> torch.FloatTensor:
+        return self.h0.data.new(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        res = ('{}(input_size={input_size}, hidden_size={hidden_size}, '
+               'num_layers={num_layers}, dropout={dropout})')
+        return res.format(self.__class__.__name__, **self.__dict__)
+
+
+class PrecomputedStackLSTM(nn.Module):
+    # A batch of stack LSTMs whose inputs are all known up front, so every stack holds a
+    # prefix of its inputs. They are encoded with a single sequence LSTM call on reset, and
+    # pushing or popping just moves pointers.
+    def __init__(self,
+                 input_size: int,
+                 hidden_size: int,
+                 num_layers: int = 1,
+                 dropout: float = 0.,
+                 lstm_class=None) -> None:
+        if input_size <= 0:
+            raise ValueError(f'nonpositive input size: {input_size}')
+        if hidden_size <= 0:
+            raise ValueError(f'nonpositive hidden size: {hidden_size}')
+        if num_layers <= 0:
+            raise ValueError(f'nonpositive number of layers: {num_layers}')
+        if dropout < 0. or dropout >= 1.:
+            raise ValueError(f'invalid dropout rate: {dropout}')
+
+        if lstm_class is None:
+            lstm_class = nn.LSTM
+
+        super().__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.lstm = lstm_class(input_size, hidden_size, num_layers=num_layers, dropout=dropout)
+        self.h0 = nn.Parameter(torch.Tensor(num_layers, 1, hidden_size))
+        self.c0 = nn.Parameter(torch.Tensor(num_layers, 1, hidden_size))
+        self._init_stacks()
+
+        self.reset_parameters()
+
+    def _init_stacks(self) -> None:
+        self._pointers = []  # type: List[int]
+        self._outputs = None  # type: Optional[Variable]
+        self._seq_length = 0
+
+    def reset_parameters(self) -> None:
+        for name, param in self.lstm.named_parameters():
+            if name.startswith('weight'):
+                init.orthogonal(param)
+            else:
+                assert name.startswith('bias')
+                init.constant(param, 0.)
+        init.constant(self.h0, 0.)
+        init.constant(self.c0, 0.)
+
+    @classmethod
+    def from_stack_lstm(cls, stack_lstm: StackLSTM) -> 'PrecomputedStackLSTM':
+        # The returned module shares its LSTM and initial states with the given stack LSTM,
+        # so it is made without running the constructor, which would make an LSTM of its own
+        buffer = cls.__new__(cls)
+        nn.Module.__init__(buffer)
+        buffer.input_size = stack_lstm.input_size
+        buffer.hidden_size = stack_lstm.hidden_size
+        buffer.num_layers = stack_lstm.num_layers
+        buffer.dropout = stack_lstm.dropout
+        buffer.lstm = stack_lstm.lstm
+        buffer.h0 = stack_lstm.h0
+        buffer.c0 = stack_lstm.c0
+        buffer._init_stacks()
+        return buffer
+
+    @property
+    def batch_size(self) -> int:
+        return len(self._pointers)
+
+    @property
+    def lengths(self) -> List[int]:
+        return list(self._pointers)
+
+    def reset(self, inputs: Variable, lengths: Sequence[int]) -> Variable:
+        # inputs: (seq_length, batch_size, input_size)
+        # lengths: (batch_size,)
+        # Stack i starts with inputs[:lengths[i], i] and can only push the inputs after those
+        if inputs.dim() != 3 or inputs.size(2) != self.input_size:
+            raise ValueError(
+                f'expected input to have size (seq_length, batch_size, {self.input_size}), '
+                f'got {tuple(inputs.size())}'
+            )
+        if len(lengths) != inputs.size(1):
+            raise ValueError(f'expected {inputs.size(1)} lengths, got {len(lengths)}')
+        if any(n < 0 or n > inputs.size(0) for n in lengths):
+            raise ValueError(f'lengths must be between 0 and {inputs.size(0)}')
+
+        batch_size = inputs.size(1)
+        size = (self.num_layers, batch_size, self.hidden_size)
+        # (seq_length, batch_size, hidden_size)
+        outputs, _ = self.lstm(inputs, (self.h0.expand(*size).contiguous(),
+                                        self.c0.expand(*size).contiguous()))
+        # Row depth * batch_size + i holds the top of stack i at that depth, where the top
+        # of an empty stack (depth 0) is a zero vector
+        zeros = Variable(self._new(batch_size, self.hidden_size).zero_())
+        self._outputs = torch.cat([zeros, outputs.view(-1, self.hidden_size)])
+        self._pointers = list(lengths)
+        self._seq_length = inputs.size(0)
+        return self.top
+
+    def push(self, num_pushes: IntSequence) -> Variable:
+        if not self._pointers:
+            raise RuntimeError('stacks are not initialized, call reset() first')
+        num_pushes = to_int_list(num_pushes)
+        if len(num_pushes) != self.batch_size:
+            raise ValueError(
+                f'expected {self.batch_size} number of pushes, got {len(num_pushes)}')
+        if any(n < 0 for n in num_pushes):
+            raise ValueError('number of pushes must be nonnegative')
+        if any(p + n > self._seq_length for n, p in zip(num_pushes, self._pointers)):
+            raise ValueError('cannot push past the end of the inputs')
+        self._pointers = [p + n for p, n in zip(self._pointers, num_pushes)]
+        return self.top
+
+    def pop(self, num_pops: IntSequence) -> Variable:
+        if not self._pointers:
+            raise RuntimeError('stacks are not initialized, call reset() first')
+        num_pops = to_int_list(num_pops)
+        if len(num_pops) != self.batch_size:
+            raise ValueError(f'expected {self.batch_size} number of pops, got {len(num_pops)}')
+        if any(n < 0 for n in num_pops):
+            raise ValueError('number of pops must be nonnegative')
+        if any(n > p for n, p in zip(num_pops, self._pointers)):
+            raise EmptyStackError()
+        self._pointers = [p - n for p, n in zip(self._pointers, num_pops)]
+        return self.top
+
+    def select(self, indices: Sequence[int]) -> None:
+        # Keep only the stacks at the given indices, in that order
+        if not indices:
+            raise ValueError('cannot select an empty set of stacks')
+        if any(i < 0 or i >= self.batch_size for i in indices):
+            raise IndexError('stack index out of range')
+
+        assert self._outputs is not None
+        index = Variable(self._new(list(indices)).long())
+        self._outputs = self._outputs.view(-1, self.batch_size, self.hidden_size) \
+            .index_select(1, index).view(-1, self.hidden_size)
+        self._pointers = [self._pointers[i] for i in indices]
+
+    @property
+    def top(self) -> Optional[Variable]:
+        # outputs: (batch_size, hidden_size)
+        if not self._pointers:
+            return None
+        return self.get_tops(self._pointers, range(self.batch_size))
+
+    def get_tops(self, depths: Sequence[int], indices: Sequence[int]) -> Variable:
+        # outputs: (len(depths), hidden_size)
+        # Top of stack indices[k] when it holds depths[k] inputs, whatever it holds now
+        if not self._pointers:
+            raise RuntimeError('stacks are not initialized, call reset() first')
+        if len(depths) != len(indices):
+            raise ValueError(f'expected {len(indices)} depths, got {len(depths)}')
+        if any(d < 0 or d > self._seq_length for d in depths):
+            raise ValueError(f'depths must be between 0 and {self._seq_length}')
+        if any(i < 0 or i >= self.batch_size for i in indices):
+            raise IndexError('stack index out of range')
+
+        assert self._outputs is not None
+        rows = [d * self.batch_size + i for d, i in zip(depths, indices)]
+        return self._outputs.index_select(0, Variable(self._new(rows).long()))
+
+    def _new(self, *args, **kwargs) -> torch.FloatTensor:
+        return self.h0.data.new(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        res = ('{}(input_size={input_size}, hidden_size={hidden_size}, '
+               'num_layers={num_layers}, dropout={dropout})')
+        return res.format(self.__class__.__name__, **self.__dict__)
+
+
 def log_softmax(inputs: Variable, restrictions: Optional[torch.LongTensor] = None) -> Variable:
     if restrictions is None:
         return F.log_softmax(inputs)
@@ -119,6 +874,61 @@ class StackElement(NamedTuple):
     is_open_nt: bool
 
 
+class ParserState(NamedTuple):
+    # An immutable parser configuration. The stack, buffer, and history are persistent
+    # stack LSTM nodes, so applying an action to a state creates a new state that shares
+    # everything else with the old one and forking a state is O(1).
+    stack: StackNode
+    buffer: StackNode
+    history: StackNode
+    num_open_nt: int
+
+    @property
+    def finished(self) -> bool:
+        # The guards are at the bottom of the stack and the buffer
+        return self.stack.size == 2 and not self.stack.value.is_open_nt \
+            and self.buffer.size == 1
+
+    @property
+    def tos_is_open_nt(self) -> bool:
+        return self.stack.size > 1 and self.stack.value.is_open_nt
+
+    @property
+    def action_ids(self) -> List[ActionId]:
+        action_ids = []
+        node = self.history
+        while node.size > 1:
+            action_ids.append(node.value)
+            node = cast(StackNode, node.parent)
+        action_ids.reverse()
+        return action_ids
+
+
+class Hypothesis(NamedTuple):
+    state: ParserState
+    score: float
+
+
+class OracleSchedule(NamedTuple):
+    # What the gold actions of a batch do to the encoders, worked out before running any of
+    # them. Embeddings are referred to by their row in a table of the words, the NTs, the
+    # stack guard, and then the compositions in the order they are made.
+    # For every step to score: its sentence, gold action, legal actions, the node on top
+    # of the stack, and the number of elements in the buffer and the history
+    sent_ids: List[int]
+    action_ids: List[ActionId]
+    legal_actions: List[Tuple[bool, bool, bool]]
+    stack_tops: List[int]
+    buffer_depths: List[int]
+    history_depths: List[int]
+    # For every stack node: the node it is pushed onto (-1 for none) and its input
+    node_parents: List[int]
+    node_inputs: List[int]
+    # For every composition: the open NT, its children, and its height in the tree
+    compositions: List[Tuple[int, List[int]]]
+    composition_levels: List[int]
+
+
 class DiscRNNG(nn.Module):
     MAX_OPEN_NT = 100
     REDUCE_ID = 0
@@ -136,7 +946,14 @@ class DiscRNNG(nn.Module):
                  hidden_size: int = 128,
                  num_layers: int = 2,
                  dropout: float = 0.,
+                 lstm_class=None,
+                 stack_lstm_class=None,
                  ) -> None:
+        if lstm_class is None:
+            lstm_class = nn.LSTM
+        if stack_lstm_class is None:
+            stack_lstm_class = StackLSTM
+
         super().__init__()
         self.num_words = num_words
         self.num_pos = num_pos
@@ -150,11 +967,14 @@ class DiscRNNG(nn.Module):
         self.num_layers = num_layers
         self.dropout = dropout
 
-        # Parser states
-        self._stack = []  # type: List[StackElement]
-        self._buffer = []  # type: List[WordId]
-        self._history = []  # type: List[ActionId]
-        self._num_open_nt = 0
+        # Parser state
+        self._state = None  # type: Optional[ParserState]
+
+        # Parser states of a batch of sentences
+        self._batch_stacks = []  # type: List[List[StackElement]]
+        self._batch_buffers = []  # type: List[List[int]]
+        self._batch_num_open_nt = []  # type: List[int]
+        self._batch_words = []  # type: List[List[WordId]]
 
         # Embeddings
         self.word_embedding = nn.Embedding(self.num_words, self.word_embedding_size)
@@ -163,24 +983,39 @@ class DiscRNNG(nn.Module):
         self.action_embedding = nn.Embedding(self.num_actions, self.action_embedding_size)
 
         # Parser state encoders
-        self.stack_encoder = StackLSTM(
-            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=self.dropout
+        self.stack_encoder = stack_lstm_class(
+            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=self.dropout,
+            lstm_class=lstm_class
         )
         self.stack_guard = nn.Parameter(torch.Tensor(self.input_size))
-        self.buffer_encoder = StackLSTM(
-            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=self.dropout
+        self.buffer_encoder = stack_lstm_class(
+            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=self.dropout,
+            lstm_class=lstm_class
         )
         self.buffer_guard = nn.Parameter(torch.Tensor(self.input_size))
-        self.history_encoder = StackLSTM(
-            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=self.dropout
+        self.history_encoder = stack_lstm_class(
+            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=self.dropout,
+            lstm_class=lstm_class
         )
         self.history_guard = nn.Parameter(torch.Tensor(self.input_size))
+        # Batched views of the encoders above, sharing their parameters. They are kept in
+        # plain dicts so they don't show up in the state dict twice. Buffers only ever
+        # pop, and histories only ever push the gold actions when training, so both are
+        # encoded all at once.
+        self._batch_encoders = {
+            'stack': BatchedStackLSTM.from_stack_lstm(self.stack_encoder),
+            'history': BatchedStackLSTM.from_stack_lstm(self.history_encoder),
+        }  # type: Dict[str, BatchedStackLSTM]
+        self._precomputed_encoders = {
+            'buffer': PrecomputedStackLSTM.from_stack_lstm(self.buffer_encoder),
+            'gold_history': PrecomputedStackLSTM.from_stack_lstm(self.history_encoder),
+        }  # type: Dict[str, PrecomputedStackLSTM]
 
         # Compositions
-        self.fwd_composer = nn.LSTM(
+        self.fwd_composer = lstm_class(
             self.input_size, self.input_size, num_layers=self.num_layers, dropout=self.dropout
         )
-        self.bwd_composer = nn.LSTM(
+        self.bwd_composer = lstm_class(
             self.input_size, self.input_size, num_layers=self.num_layers, dropout=self.dropout
         )
 
@@ -209,9 +1044,14 @@ class DiscRNNG(nn.Module):
         self.summary2actionlogprobs = nn.Linear(self.hidden_size, self.num_actions)
 
         # Final embeddings
-        self._word_emb = {}  # type: Dict[WordId, Variable]
-        self._nt_emb = {}  # type: Dict[NTId, Variable]
-        self._action_emb = {}  # type: Dict[ActionId, Variable]
+        self._batch_word_emb = None  # type: Optional[Variable]
+        self._batch_nt_emb = None  # type: Optional[Variable]
+        self._batch_action_emb = None  # type: Optional[Variable]
+
+        # Additive masks of the illegal actions, made on first use
+        self._legal_action_masks = None  # type: Optional[torch.FloatTensor]
+        # Projected NT and action embeddings, reused across sentences when evaluating
+        self._projection_cache = None  # type: Optional[Tuple[Variable, Variable]]
 
         self.reset_parameters()
 
@@ -221,8 +1061,7 @@ class DiscRNNG(nn.Module):
 
     @property
     def finished(self) -> bool:
-        return len(self._stack) == 1 and not self._stack[0].is_open_nt \
-            and len(self._buffer) == 0
+        return self._state is not None and self._state.finished
 
     def reset_parameters(self) -> None:
         # Embeddings
@@ -263,245 +1102,816 @@ class DiscRNNG(nn.Module):
             guard = getattr(self, f'{name}_guard')
             init.constant(guard, 0.)
 
+        self.clear_projection_cache()
+
+    def clear_projection_cache(self) -> None:
+        # Must be called whenever the parameters change outside of this class, e.g. after
+        # an optimizer step
+        self._projection_cache = None
+
+    def train(self, mode: bool = True) -> 'DiscRNNG':
+        if mode != self.training:
+            self.clear_projection_cache()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict: dict, *args, **kwargs):
+        self.clear_projection_cache()
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+    def _apply(self, fn):
+        # Moving the model to another device or type leaves the cached projections behind
+        self.clear_projection_cache()
+        return super()._apply(fn)
+
     def forward(self,
                 words: Variable,
                 pos_tags: Variable,
-                actions: Variable) -> Variable:
-        if words.dim() != 1:
-            raise ValueError(f'expected words to have dimension of 1, got {words.dim()}')
+                actions: Variable,
+                word_lengths: Optional[Sequence[int]] = None,
+                action_lengths: Optional[Sequence[int]] = None) -> Variable:
+        # words: (seq_length,) or (seq_length, batch_size)
+        # pos_tags: (seq_length,) or (seq_length, batch_size)
+        # actions: (action_seq_length,) or (action_seq_length, batch_size)
+        if words.dim() not in (1, 2):
+            raise ValueError(f'expected words to have dimension of 1 or 2, got {words.dim()}')
         if words.size() != pos_tags.size():
             raise ValueError('expected POS tags to have size equal to words')
-        if actions is not None and actions.dim() != 1:
-            raise ValueError(f'expected actions to have dimension of 1, got {actions.dim()}')
-
-        self._start(words, pos_tags, actions=actions)
+        if actions is not None and actions.dim() != words.dim():
+            raise ValueError(
+                f'expected actions to have dimension of {words.dim()}, got {actions.dim()}')
+
+        if words.dim() == 2:
+            if actions.size(1) != words.size(1):
+                raise ValueError('expected actions to have batch size equal to words')
+            return self._forward_batch(
+                words, pos_tags, actions, word_lengths=word_lengths,
+                action_lengths=action_lengths)
+
+        self._state = self._start_state(words, pos_tags)
+        assert self._batch_action_emb is not None
+        # The history only ever pushes the gold actions, so it is encoded with one LSTM call
+        action_ids = actions.data.tolist()
+        histories = self.history_encoder.push_sequence(
+            self._state.history, self._batch_action_emb.index_select(0, actions), action_ids)
         llh = 0.
-        for action in actions:
-            log_probs = self._compute_action_log_probs()
-            llh += log_probs[action]
-            action_id = action.data[0]
-            if action_id == self.SHIFT_ID:
-                if self._check_shift():
-                    self._shift()
-                else:
-                    break
-            elif action_id == self.REDUCE_ID:
-                if self._check_reduce():
-                    self._reduce()
-                else:
-                    break
-            else:
-                if self._check_push_nt():
-                    self._push_nt(self._get_nt(action_id))
-                else:
-                    break
-            self._append_history(action_id)
+        for action_id, history in zip(action_ids, histories):
+            log_probs = self._score_states([self._state])
+            llh += log_probs[0, action_id:action_id + 1]
+            legal_actions = self._get_state_legal_actions(self._state)
+            if not legal_actions[min(action_id, self.SHIFT_ID + 1)]:
+                break
+            self._state = self._apply_actions([self._state], [action_id], histories=[history])[0]
         return llh
 
     def decode(self, words: Variable, pos_tags: Variable) -> Tuple[List[ActionId], Tree]:
-        self._start(words, pos_tags)
-        while not self.finished:
-            log_probs = self._compute_action_log_probs()
-            max_action_id = torch.max(log_probs, dim=0)[1].data[0]
-            if max_action_id == self.SHIFT_ID:
-                if self._check_shift():
-                    self._shift()
-                else:
-                    raise RuntimeError('most probable action is an illegal one')
-            elif max_action_id == self.REDUCE_ID:
-                if self._check_reduce():
-                    self._reduce()
-                else:
-                    raise RuntimeError('most probable action is an illegal one')
-            else:
-                if self._check_push_nt():
-                    self._push_nt(self._get_nt(max_action_id))
-                else:
-                    raise RuntimeError('most probable action is an illegal one')
-            self._append_history(max_action_id)
-        return list(self._history), self._stack[0].subtree
-
-    def _start(self,
-               words: Variable,
-               pos_tags: Variable,
-               actions: Optional[Variable] = None) -> None:
-        # words: (seq_length,)
-        # pos_tags: (seq_length,)
-        # actions: (action_seq_length,)
+        self._state = self._start_state(words, pos_tags)
+        while not self._state.finished:
+            # Illegal actions have zero probability, so the most probable one is legal
+            max_action_id = self._get_best_actions(
+                self._concat_state_outputs([self._state]),
+                [self._get_state_legal_actions(self._state)])[0]
+            self._state = self._apply_actions([self._state], [max_action_id])[0]
+        return self._state.action_ids, self._state.stack.value.subtree
+
+    def decode_batch(self,
+                     words: Variable,
+                     pos_tags: Variable,
+                     lengths: Optional[Sequence[int]] = None,
+                     ) -> List[Tuple[List[ActionId], Tree]]:
+        # words: (seq_length, batch_size)
+        # pos_tags: (seq_length, batch_size)
+        if words.dim() != 2:
+            raise ValueError(f'expected words to have dimension of 2, got {words.dim()}')
+        if words.size() != pos_tags.size():
+            raise ValueError('expected POS tags to have size equal to words')
 
-        assert words.dim() == 1
+        batch_size = words.size(1)
+        lengths = self._get_lengths(words, lengths)
+        self._start_batch(words, pos_tags, lengths)
+        histories = [[] for _ in range(batch_size)]  # type: List[List[ActionId]]
+        results = [None] * batch_size  # type: List[Optional[Tuple[List[ActionId], Tree]]]
+        # Sentence index of every parser still in the batch
+        active_ids = list(range(batch_size))
+        while active_ids:
+            legal_actions = [self._get_batch_legal_actions(i) for i in range(len(active_ids))]
+            max_action_ids = self._get_best_actions(self._concat_batch_outputs(), legal_actions)
+            self._apply_batch_actions(dict(enumerate(max_action_ids)))
+
+            keep = []
+            for i, action_id in enumerate(max_action_ids):
+                sent_id = active_ids[i]
+                histories[sent_id].append(action_id)
+                if self._is_batch_finished(i):
+                    results[sent_id] = (histories[sent_id], self._batch_stacks[i][0].subtree)
+                else:
+                    keep.append(i)
+            # Retire finished sentences so the next steps only compute the remaining ones
+            if len(keep) < len(active_ids):
+                active_ids = [active_ids[i] for i in keep]
+                if keep:
+                    self._select_batch(keep)
+        return cast(List[Tuple[List[ActionId], Tree]], results)
+
+    def decode_beam(self,
+                    words: Variable,
+                    pos_tags: Variable,
+                    beam_size: int = 10,
+                    word_beam_size: Optional[int] = None,
+                    ) -> Tuple[List[ActionId], Tree]:
+        # Beam search over actions, or word-synchronous beam search (Stern et al., 2017) if
+        # word_beam_size is given, where beam_size bounds the beam of hypotheses between two
+        # SHIFTs and word_beam_size bounds the hypotheses that move on to the next word.
+        if words.dim() != 1:
+            raise ValueError(f'expected words to have dimension of 1, got {words.dim()}')
+        if words.size() != pos_tags.size():
+            raise ValueError('expected POS tags to have size equal to words')
+        if beam_size <= 0:
+            raise ValueError(f'nonpositive beam size: {beam_size}')
+        if word_beam_size is not None and word_beam_size <= 0:
+            raise ValueError(f'nonpositive word beam size: {word_beam_size}')
+
+        initial = Hypothesis(self._start_state(words, pos_tags), 0.)
+        if word_beam_size is None:
+            finished = self._action_beam_search(initial, beam_size)
+        else:
+            finished = self._word_beam_search(initial, beam_size, word_beam_size)
+        if not finished:
+            raise RuntimeError('beam search did not find any complete parse')
+
+        best = max(finished, key=lambda h: h.score).state
+        return best.action_ids, best.stack.value.subtree
+
+    def _compose_batch(self,
+                       table: Variable,
+                       open_nts: Sequence[int],
+                       children: Sequence[Sequence[int]]) -> Variable:
+        # table: (num_rows, input_size)
+        # Compose the open NT open_nts[k] with its children children[k] for every k, where
+        # both are given as rows of the table. Each direction is a single call on packed
+        # sequences, longest first as packing requires.
+        assert len(open_nts) == len(children)
+        assert all(len(c) > 0 for c in children)
+
+        num_composed = len(open_nts)
+        order = sorted(range(num_composed), key=lambda k: len(children[k]), reverse=True)
+        lengths = [len(children[k]) + 1 for k in order]
+        # Row t * num_composed + j of the forward inputs is the open NT of the j-th longest
+        # composition if t is 0, and its t-th child otherwise. Padding repeats the open NT.
+        rows = [
+            children[k][t - 1] if 0 < t < n else open_nts[k]
+            for t in range(lengths[0]) for k, n in zip(order, lengths)
+        ]
+        # shape: (max_length, num_composed, input_size)
+        fwd_input = table.index_select(0, Variable(self._new(rows).long())) \
+            .view(lengths[0], num_composed, -1)
+        # The backward inputs are the forward ones with the children reversed in time
+        rows = [
+            (n - t if 0 < t < n else 0) * num_composed + j
+            for t in range(lengths[0]) for j, n in enumerate(lengths)
+        ]
+        bwd_input = fwd_input.view(-1, self.input_size) \
+            .index_select(0, Variable(self._new(rows).long())) \
+            .view(lengths[0], num_composed, -1)
+
+        # The last hidden states of packed sequences are those at their own last step
+        _, (fwd_h, _) = self.fwd_composer(pack_padded_sequence(fwd_input, lengths))
+        _, (bwd_h, _) = self.bwd_composer(pack_padded_sequence(bwd_input, lengths))
+        # shape: (num_composed, input_size)
+        fwd_emb = F.dropout(fwd_h[-1], p=self.dropout, training=self.training)
+        bwd_emb = F.dropout(bwd_h[-1], p=self.dropout, training=self.training)
+        composed = self.fwdbwd2composed(torch.cat([fwd_emb, bwd_emb], dim=1))
+
+        # Back to the given order
+        inverse = [0] * num_composed
+        for j, k in enumerate(order):
+            inverse[k] = j
+        return composed.index_select(0, Variable(self._new(inverse).long()))
+
+    def _compose_elements(self,
+                          open_nts: Sequence[StackElement],
+                          children: Sequence[Sequence[StackElement]]) -> Variable:
+        # Compose open_nts[k] with children[k] for every k with a single _compose_batch call
+        embs = []  # type: List[Variable]
+        open_nt_rows, children_rows = [], []
+        for open_nt, elements in zip(open_nts, children):
+            open_nt_rows.append(len(embs))
+            embs.append(open_nt.emb)
+            children_rows.append(range(len(embs), len(embs) + len(elements)))
+            embs.extend(c.emb for c in elements)
+        # shape: (num_composed, input_size)
+        return self._compose_batch(torch.stack(embs), open_nt_rows, children_rows)
+
+    def _forward_batch(self,
+                       words: Variable,
+                       pos_tags: Variable,
+                       actions: Variable,
+                       word_lengths: Optional[Sequence[int]] = None,
+                       action_lengths: Optional[Sequence[int]] = None) -> Variable:
+        # words: (seq_length, batch_size)
+        # pos_tags: (seq_length, batch_size)
+        # actions: (action_seq_length, batch_size)
+
+        assert words.dim() == 2
         assert words.size() == pos_tags.size()
-        if actions is not None:
-            assert actions.dim() == 1
+        assert actions.dim() == 2
+        assert actions.size(1) == words.size(1)
+
+        batch_size = words.size(1)
+        word_lengths = self._get_lengths(words, word_lengths)
+        action_lengths = self._get_lengths(actions, action_lengths)
+
+        # The gold actions fix every operation on the encoders in advance, so the operations
+        # are worked out first and then run in as few batched calls as their dependencies
+        # allow: compositions by height, stack pushes by depth, and all scores at once
+        self._prepare_batch_embeddings(words, pos_tags)
+        schedule = self._schedule_oracles(
+            [ids[:n] for ids, n in zip(actions.data.t().tolist(), action_lengths)],
+            word_lengths)
+
+        table = torch.cat([
+            self._batch_word_emb, self._batch_nt_emb, self.stack_guard.view(1, -1)])
+        base_size = table.size(0)
+        table, composition_rows = self._compose_levels(
+            table, schedule.compositions, schedule.composition_levels)
+        input_rows = [
+            r if r < base_size else composition_rows[r - base_size]
+            for r in schedule.node_inputs
+        ]
+        stack_outputs = self.stack_encoder.push_tree(
+            schedule.node_parents,
+            table.index_select(0, Variable(self._new(input_rows).long())))
 
-        self._stack = []
-        self._buffer = []
-        self._history = []
-        self._num_open_nt = 0
+        self._reset_batch_buffers(word_lengths)
+        self._reset_batch_gold_histories(actions)
+        concatenated = torch.cat([
+            stack_outputs.index_select(0, Variable(self._new(schedule.stack_tops).long())),
+            self._precomputed_encoders['buffer'].get_tops(
+                schedule.buffer_depths, schedule.sent_ids),
+            self._precomputed_encoders['gold_history'].get_tops(
+                schedule.history_depths, schedule.sent_ids),
+        ], dim=1)
+        # (num_steps, num_actions)
+        log_probs = self._score_actions(concatenated, schedule.legal_actions)
+        step_llh = log_probs.gather(
+            1, Variable(self._new(schedule.action_ids).long()).view(-1, 1)).view(-1)
+        llh = Variable(self._new(batch_size).zero_())
+        return llh.index_add(0, Variable(self._new(schedule.sent_ids).long()), step_llh)
+
+    def _schedule_oracles(self,
+                          action_ids: Sequence[Sequence[ActionId]],
+                          word_lengths: Sequence[int]) -> OracleSchedule:
+        # Simulate the gold actions of every sentence without running the model. Steps are
+        # scored up to and including the first illegal action, which is not applied.
+        assert self._batch_word_emb is not None
+        assert len(action_ids) == len(word_lengths)
+
+        batch_size = len(word_lengths)
+        nt_offset = self._batch_word_emb.size(0)
+        guard_row = nt_offset + self.num_nt
+        schedule = OracleSchedule([], [], [], [], [], [], [], [], [], [])
+
+        def push_node(parent: int, row: int) -> int:
+            schedule.node_parents.append(parent)
+            schedule.node_inputs.append(row)
+            return len(schedule.node_parents) - 1
+
+        for i, (ids, num_words) in enumerate(zip(action_ids, word_lengths)):
+            # Stack elements are (embedding row, is open NT, height) triples and nodes[k] is
+            # the node of the first k elements
+            stack = []  # type: List[Tuple[int, bool, int]]
+            nodes = [push_node(-1, guard_row)]
+            buffer_size = num_words
+            num_open_nt = 0
+            for t, action_id in enumerate(ids):
+                tos_is_open_nt = len(stack) > 0 and stack[-1][1]
+                legal_actions = self._get_legal_actions(buffer_size, num_open_nt, tos_is_open_nt)
+                schedule.sent_ids.append(i)
+                schedule.action_ids.append(action_id)
+                schedule.legal_actions.append(legal_actions)
+                schedule.stack_tops.append(nodes[-1])
+                schedule.buffer_depths.append(buffer_size + 1)
+                schedule.history_depths.append(t + 1)
+                # Legality flags are indexed by action type: REDUCE, SHIFT, then any NT
+                if not legal_actions[min(action_id, self.SHIFT_ID + 1)]:
+                    break
 
-        while len(self.stack_encoder) > 0:
-            self.stack_encoder.pop()
-        while len(self.buffer_encoder) > 0:
-            self.buffer_encoder.pop()
-        while len(self.history_encoder) > 0:
-            self.history_encoder.pop()
+                if action_id == self.SHIFT_ID:
+                    position = num_words - buffer_size
+                    element = (position * batch_size + i, False, 0)
+                    buffer_size -= 1
+                elif action_id == self.REDUCE_ID:
+                    children = []
+                    while not stack[-1][1]:
+                        children.append(stack.pop())
+                        nodes.pop()
+                    children.reverse()
+                    open_nt = stack.pop()
+                    nodes.pop()
+                    level = 1 + max(c[2] for c in children)
+                    schedule.compositions.append((open_nt[0], [c[0] for c in children]))
+                    schedule.composition_levels.append(level)
+                    element = (guard_row + len(schedule.compositions), False, level)
+                    num_open_nt -= 1
+                else:
+                    element = (nt_offset + self._get_nt(action_id), True, 0)
+                    num_open_nt += 1
+                stack.append(element)
+                nodes.append(push_node(nodes[-1], element[0]))
+        return schedule
+
+    def _compose_levels(self,
+                        table: Variable,
+                        compositions: Sequence[Tuple[int, Sequence[int]]],
+                        levels: Sequence[int]) -> Tuple[Variable, List[int]]:
+        # table: (num_rows, input_size)
+        # Compose by height with one call per height, where the children of composition k
+        # are rows of the table or the compositions len(table) + j for j < k. Return the
+        # table with the compositions appended, and the row each of them ended up in.
+        base_size = table.size(0)
+        rows = [0] * len(compositions)
+        for level in range(1, max(levels, default=0) + 1):
+            ids = [k for k, lv in enumerate(levels) if lv == level]
+            for j, k in enumerate(ids):
+                rows[k] = table.size(0) + j
+            composed = self._compose_batch(
+                table,
+                [compositions[k][0] for k in ids],
+                [[r if r < base_size else rows[r - base_size] for r in compositions[k][1]]
+                 for k in ids])
+            table = torch.cat([table, composed])
+        return table, rows
+
+    def _start_batch(self,
+                     words: Variable,
+                     pos_tags: Variable,
+                     word_lengths: Sequence[int]) -> None:
+        # words: (seq_length, batch_size)
+        # pos_tags: (seq_length, batch_size)
+
+        assert words.dim() == 2
+        assert words.size() == pos_tags.size()
+        assert len(word_lengths) == words.size(1)
 
-        # Feed guards as inputs
-        self.stack_encoder.push(self.stack_guard)
-        self.buffer_encoder.push(self.buffer_guard)
-        self.history_encoder.push(self.history_guard)
-
-        # Initialize input buffer and its LSTM encoder
-        self._prepare_embeddings(words, pos_tags, actions=actions)
-        for word_id in reversed(words.data.tolist()):
-            self._buffer.append(word_id)
-            assert word_id in self._word_emb
-            self.buffer_encoder.push(self._word_emb[word_id])
-
-    def _prepare_embeddings(self,
-                            words: Variable,
-                            pos_tags: Variable,
-                            actions: Optional[Variable] = None) -> None:
-        # words: (seq_length,)
-        # pos_tags: (seq_length,)
-        # actions: (action_seq_length,)
+        batch_size = words.size(1)
+        self._batch_stacks = [[] for _ in range(batch_size)]
+        self._batch_buffers = [list(reversed(range(n))) for n in word_lengths]
+        self._batch_num_open_nt = [0] * batch_size
+        self._batch_words = words.data.t().tolist()
 
-        assert words.dim() == 1
+        # Feed guards as inputs
+        for name in 'stack history'.split():
+            encoder = self._batch_encoders[name]
+            encoder.reset(batch_size)
+            guard = getattr(self, f'{name}_guard')
+            encoder.push(
+                guard.view(1, -1).expand(batch_size, self.input_size),
+                [BatchedStackLSTM.PUSH] * batch_size)
+
+        self._prepare_batch_embeddings(words, pos_tags)
+        self._reset_batch_buffers(word_lengths)
+
+    def _reset_batch_buffers(self, word_lengths: Sequence[int]) -> None:
+        # Encode the buffers with a single LSTM call over the guard followed by the words in
+        # reverse, where rows past the end of a sentence are padding
+        assert self._batch_word_emb is not None
+
+        batch_size = len(word_lengths)
+        rows = [
+            max(n - j - 1, 0) * batch_size + i
+            for j in range(max(word_lengths)) for i, n in enumerate(word_lengths)
+        ]
+        inputs = torch.cat([
+            self.buffer_guard.view(1, 1, -1).expand(1, batch_size, self.input_size),
+            self._batch_word_emb.index_select(0, Variable(self._new(rows).long()))
+            .view(-1, batch_size, self.input_size),
+        ])
+        self._precomputed_encoders['buffer'].reset(inputs, [n + 1 for n in word_lengths])
+
+    def _reset_batch_gold_histories(self, actions: Variable) -> None:
+        # actions: (action_seq_length, batch_size)
+        # Likewise encode the guard followed by all the gold actions, of which only the guard
+        # is pushed for now
+        assert self._batch_action_emb is not None
+
+        batch_size = actions.size(1)
+        action_embs = self._batch_action_emb.index_select(0, actions.view(-1))
+        inputs = torch.cat([
+            self.history_guard.view(1, 1, -1).expand(1, batch_size, self.input_size),
+            action_embs.view(-1, batch_size, self.input_size),
+        ])
+        self._precomputed_encoders['gold_history'].reset(inputs, [1] * batch_size)
+
+    def _prepare_batch_embeddings(self, words: Variable, pos_tags: Variable) -> None:
+        # words: (seq_length, batch_size)
+        # pos_tags: (seq_length, batch_size)
+
+        assert words.dim() == 2
         assert words.size() == pos_tags.size()
-        if actions is not None:
-            assert actions.dim() == 1
 
-        if actions is None:
-            actions = Variable(
-                self._new(range(self.num_actions)), volatile=not self.training).long()
+        word_embs = self.word_embedding(words).view(-1, self.word_embedding_size)
+        pos_embs = self.pos_embedding(pos_tags).view(-1, self.pos_embedding_size)
+
+        # Row j * batch_size + i holds the j-th word of the i-th sentence
+        self._batch_word_emb = self.word2encoder(torch.cat([word_embs, pos_embs], dim=1))
+        self._batch_nt_emb, self._batch_action_emb = self._get_projections()
+
+    def _get_projections(self) -> Tuple[Variable, Variable]:
+        # The projected NT and action embeddings only depend on the parameters. Training
+        # needs them in the graph of every batch, but evaluation reuses them until the
+        # cache is cleared.
+        if self.training:
+            return self._project_nts_and_actions()
+        if self._projection_cache is None:
+            self._projection_cache = self._project_nts_and_actions()
+        return self._projection_cache
+
+    def _project_nts_and_actions(self) -> Tuple[Variable, Variable]:
+        actions = Variable(
+            self._new(range(self.num_actions)), volatile=not self.training).long()
         nonterms = Variable(
             self._new(range(self.num_nt)), volatile=not self.training).long()
 
-        word_embs = self.word_embedding(
-            words.view(1, -1)).view(-1, self.word_embedding_size)
-        pos_embs = self.pos_embedding(
-            pos_tags.view(1, -1)).view(-1, self.pos_embedding_size)
         nt_embs = self.nt_embedding(
             nonterms.view(1, -1)).view(-1, self.nt_embedding_size)
         action_embs = self.action_embedding(
             actions.view(1, -1)).view(-1, self.action_embedding_size)
+        # (num_nt, hidden_size), (num_actions, hidden_size)
+        return self.nt2encoder(nt_embs), self.action2encoder(action_embs)
+
+    def _concat_batch_outputs(self) -> Variable:
+        # shape: (batch_size, 3 * hidden_size)
+        return torch.cat([
+            self._batch_encoders['stack'].top,
+            self._precomputed_encoders['buffer'].top,
+            self._batch_encoders['history'].top,
+        ], dim=1)
+
+    def _score_actions(self,
+                       concatenated: Variable,
+                       legal_actions: Sequence[Tuple[bool, bool, bool]]) -> Variable:
+        # (batch_size, num_actions)
+        return F.log_softmax(self._compute_masked_scores(concatenated, legal_actions))
+
+    def _get_best_actions(self,
+                          concatenated: Variable,
+                          legal_actions: Sequence[Tuple[bool, bool, bool]]) -> List[ActionId]:
+        # Softmax keeps the order of the scores, so greedy decoding can skip it
+        scores = self._compute_masked_scores(concatenated, legal_actions)
+        return torch.max(scores, dim=1)[1].data.view(-1).tolist()
+
+    def _compute_masked_scores(self,
+                               concatenated: Variable,
+                               legal_actions: Sequence[Tuple[bool, bool, bool]]) -> Variable:
+        # concatenated: (batch_size, 3 * hidden_size)
+        # legal_actions: whether REDUCE, SHIFT, and NT actions are legal for each parser
+        summary = self.encoders2summary(concatenated)
+        scores = self.summary2actionlogprobs(summary)
+
+        masks = self._get_legal_action_masks()
+        rows = [4 * can_reduce + 2 * can_shift + can_push_nt
+                for can_reduce, can_shift, can_push_nt in legal_actions]
+        # Unnormalized scores where illegal actions score -inf: (batch_size, num_actions)
+        runs = [(row, len(list(group))) for row, group in itertools.groupby(rows)]
+        if len(runs) <= masks.size(0):
+            # Consecutive parsers with the same legal actions get their mask row added by
+            # broadcasting, so no index or addend is made. That covers decoding, where
+            # parsers mostly share their legal actions, and any single parser.
+            pieces, start = [], 0
+            for row, length in runs:
+                pieces.append(scores[start:start + length] + Variable(masks[row:row + 1]))
+                start += length
+            return pieces[0] if len(pieces) == 1 else torch.cat(pieces)
+
+        # Many short runs, as when scoring every step of a batch at once
+        if masks.is_cuda:
+            with torch.cuda.device(masks.get_device()):
+                index = torch.cuda.LongTensor(rows)
+        else:
+            index = torch.LongTensor(rows)
+        return scores + Variable(masks.index_select(0, index))
+
+    def _get_legal_action_masks(self) -> torch.FloatTensor:
+        # Legality only depends on whether REDUCE, SHIFT, and NT actions are legal, so there
+        # are 8 masks. Row 4 * can_reduce + 2 * can_shift + can_push_nt is 0 for the legal
+        # actions and -inf for the others. The masks are made again if the model is moved.
+        param = self.stack_guard.data
+        masks = self._legal_action_masks
+        if masks is None or masks.type() != param.type() \
+                or (param.is_cuda and masks.get_device() != param.get_device()):
+            # shape: (8, num_actions)
+            masks = param.new(8, self.num_actions).zero_()
+            for i in range(8):
+                if not i & 4:
+                    masks[i, self.REDUCE_ID] = -float('inf')
+                if not i & 2:
+                    masks[i, self.SHIFT_ID] = -float('inf')
+                if not i & 1:
+                    masks[i, self.SHIFT_ID + 1:] = -float('inf')
+            self._legal_action_masks = masks
+        return masks
+
+    def _is_batch_finished(self, index: int) -> bool:
+        stack = self._batch_stacks[index]
+        return len(stack) == 1 and not stack[0].is_open_nt \
+            and len(self._batch_buffers[index]) == 0
+
+    def _select_batch(self, indices: Sequence[int]) -> None:
+        # Keep only the parsers at the given indices, in that order
+        assert self._batch_word_emb is not None
+
+        batch_size = len(self._batch_stacks)
+        self._batch_encoders['stack'].select(indices)
+        self._precomputed_encoders['buffer'].select(indices)
+        self._batch_encoders['history'].select(indices)
+        self._batch_stacks = [self._batch_stacks[i] for i in indices]
+        self._batch_buffers = [self._batch_buffers[i] for i in indices]
+        self._batch_num_open_nt = [self._batch_num_open_nt[i] for i in indices]
+        self._batch_words = [self._batch_words[i] for i in indices]
+        emb_size = self._batch_word_emb.size(1)
+        self._batch_word_emb = self._batch_word_emb.view(-1, batch_size, emb_size) \
+            .index_select(1, Variable(self._new(list(indices)).long())).view(-1, emb_size)
+
+    def _get_batch_legal_actions(self, index: int) -> Tuple[bool, bool, bool]:
+        stack = self._batch_stacks[index]
+        tos_is_open_nt = len(stack) > 0 and stack[-1].is_open_nt
+        return self._get_legal_actions(
+            len(self._batch_buffers[index]), self._batch_num_open_nt[index], tos_is_open_nt)
+
+    def _get_legal_actions(self,
+                           buffer_size: int,
+                           num_open_nt: int,
+                           tos_is_open_nt: bool) -> Tuple[bool, bool, bool]:
+        # Whether REDUCE, SHIFT, and NT actions are legal
+        can_reduce = num_open_nt > 0 and not tos_is_open_nt \
+            and not (num_open_nt < 2 and buffer_size > 0)
+        can_shift = buffer_size > 0 and num_open_nt > 0
+        can_push_nt = buffer_size > 0 and num_open_nt < self.MAX_OPEN_NT
+        return can_reduce, can_shift, can_push_nt
+
+    def _apply_batch_actions(self, action_ids: Dict[int, ActionId]) -> None:
+        # action_ids: mapping from sentence index to the (legal) action to take
+        assert self._batch_word_emb is not None and self._batch_nt_emb is not None
+        assert self._batch_action_emb is not None
+        batch_size = len(self._batch_stacks)
+        zero = Variable(self._new(self.input_size).zero_())
+        stack_inputs = [zero] * batch_size
+        stack_ops = [BatchedStackLSTM.NOOP] * batch_size
+        stack_pops = [0] * batch_size
+        buffer_pops = [0] * batch_size
+        history_ops = [BatchedStackLSTM.NOOP] * batch_size
+        history_ids = [0] * batch_size
+
+        elements = {}  # type: Dict[int, StackElement]
+        reductions = []  # type: List[Tuple[int, StackElement, List[StackElement]]]
+        for i, action_id in action_ids.items():
+            stack = self._batch_stacks[i]
+            if action_id == self.SHIFT_ID:
+                position = self._batch_buffers[i].pop()
+                buffer_pops[i] = 1
+                emb = self._batch_word_emb[position * batch_size + i]
+                elements[i] = StackElement(self._batch_words[i][position], emb, False)
+            elif action_id == self.REDUCE_ID:
+                children = []
+                while len(stack) > 0 and not stack[-1].is_open_nt:
+                    children.append(stack.pop())
+                assert len(children) > 0
+                assert len(stack) > 0
+                stack_pops[i] = len(children) + 1
+
+                children.reverse()
+                reductions.append((i, stack.pop(), children))
+                self._batch_num_open_nt[i] -= 1
+            else:
+                nt_id = self._get_nt(action_id)
+                elements[i] = StackElement(Tree(nt_id, []), self._batch_nt_emb[nt_id], True)
+                self._batch_num_open_nt[i] += 1
+            history_ops[i] = BatchedStackLSTM.PUSH
+            history_ids[i] = action_id
+
+        if reductions:
+            # All the reductions of the batch are composed at once
+            composed_embs = self._compose_elements(
+                [open_nt for _, open_nt, _ in reductions],
+                [children for _, _, children in reductions])
+            for k, (i, open_nt, children) in enumerate(reductions):
+                parent_subtree = cast(Tree, open_nt.subtree)
+                parent_subtree.extend(c.subtree for c in children)
+                elements[i] = StackElement(parent_subtree, composed_embs[k], False)
+        for i, element in elements.items():
+            self._batch_stacks[i].append(element)
+            stack_inputs[i] = element.emb
+            stack_ops[i] = BatchedStackLSTM.PUSH
+
+        if any(stack_pops):
+            self._batch_encoders['stack'].pop(stack_pops)
+        if any(buffer_pops):
+            self._precomputed_encoders['buffer'].pop(buffer_pops)
+        if action_ids:
+            self._batch_encoders['stack'].push(torch.stack(stack_inputs), stack_ops)
+            history_inputs = self._batch_action_emb.index_select(
+                0, Variable(self._new(history_ids).long()))
+            self._batch_encoders['history'].push(history_inputs, history_ops)
+
+    def _get_lengths(self, inputs: Variable, lengths: Optional[IntSequence]) -> List[int]:
+        # inputs: (seq_length, batch_size)
+        if lengths is None:
+            return [inputs.size(0)] * inputs.size(1)
+        lengths = to_int_list(lengths)
+        if len(lengths) != inputs.size(1):
+            raise ValueError(f'expected {inputs.size(1)} lengths, got {len(lengths)}')
+        if any(n <= 0 or n > inputs.size(0) for n in lengths):
+            raise ValueError(f'lengths must be between 1 and {inputs.size(0)}')
+        return list(lengths)
+
+    def _start_state(self, words: Variable, pos_tags: Variable) -> ParserState:
+        # words: (seq_length,)
+        # pos_tags: (seq_length,)
 
-        final_word_embs = self.word2encoder(torch.cat([word_embs, pos_embs], dim=1))
-        final_nt_embs = self.nt2encoder(nt_embs)
-        final_action_embs = self.action2encoder(action_embs)
-
-        self._word_emb = dict(zip(words.data.tolist(), final_word_embs))
-        self._nt_emb = dict(zip(nonterms.data.tolist(), final_nt_embs))
-        self._action_emb = dict(zip(actions.data.tolist(), final_action_embs))
+        assert words.dim() == 1
+        assert words.size() == pos_tags.size()
 
-    def _compute_action_log_probs(self) -> Variable:
-        assert self.stack_encoder.top is not None
-        assert self.buffer_encoder.top is not None
-        assert self.history_encoder.top is not None
+        # A single sentence is a batch of one, so row j of the word embeddings is word j
+        self._prepare_batch_embeddings(words.view(-1, 1), pos_tags.view(-1, 1))
+        assert self._batch_word_emb is not None
 
-        concatenated = torch.cat([
-            self.stack_encoder.top, self.buffer_encoder.top, self.history_encoder.top
-        ]).view(1, -1)
-        summary = self.encoders2summary(concatenated)
-        illegal_actions = self._get_illegal_actions()
-        return log_softmax(
-            self.summary2actionlogprobs(summary),
-            restrictions=illegal_actions
-        ).view(-1)
-
-    def _check_push_nt(self) -> bool:
-        return len(self._buffer) > 0 and self._num_open_nt < self.MAX_OPEN_NT
-
-    def _check_shift(self) -> bool:
-        return len(self._buffer) > 0 and self._num_open_nt > 0
-
-    def _check_reduce(self) -> bool:
-        tos_is_open_nt = len(self._stack) > 0 and self._stack[-1].is_open_nt
-        return self._num_open_nt > 0 and not tos_is_open_nt \
-            and not (self._num_open_nt < 2 and len(self._buffer) > 0)
-
-    def _append_history(self, action_id: ActionId) -> None:
-        assert action_id in self._action_emb
-
-        self._history.append(action_id)
-        self.history_encoder.push(self._action_emb[action_id])
-
-    def _push_nt(self, nt_id: NTId) -> None:
-        assert self._check_push_nt()
-        assert nt_id in self._nt_emb
-
-        self._stack.append(
-            StackElement(Tree(nt_id, []), self._nt_emb[nt_id], True))
-        self.stack_encoder.push(self._nt_emb[nt_id])
-        self._num_open_nt += 1
-
-    def _shift(self) -> None:
-        assert self._check_shift()
-        assert len(self._buffer) > 0
-        assert len(self.buffer_encoder) > 0
-        assert self._buffer[-1] in self._word_emb
-
-        word_id = self._buffer.pop()
-        self.buffer_encoder.pop()
-        self._stack.append(StackElement(word_id, self._word_emb[word_id], False))
-        self.stack_encoder.push(self._word_emb[word_id])
-
-    def _reduce(self) -> None:
-        assert self._check_reduce()
-
-        children = []
-        while len(self._stack) > 0 and not self._stack[-1].is_open_nt:
-            children.append(self._stack.pop()[:-1])
-        assert len(children) > 0
-        assert len(self._stack) > 0
-
-        children.reverse()
-        child_subtrees, child_embs = zip(*children)
-        open_nt = self._stack.pop()
-        assert isinstance(open_nt.subtree, Tree)
-        parent_subtree = cast(Tree, open_nt.subtree)
-        parent_subtree.extend(child_subtrees)
-        composed_emb = self._compose(open_nt.emb, child_embs)
-        self._stack.append(StackElement(parent_subtree, composed_emb, False))
-        self._num_open_nt -= 1
-        assert self._num_open_nt >= 0
-
-    def _compose(self, open_nt_emb: Variable, children_embs: Sequence[Variable]) -> Variable:
-        assert open_nt_emb.size() == (self.input_size,)
-        assert all(x.size() == (self.input_size,) for x in children_embs)
-
-        fwd_input = [open_nt_emb]
-        bwd_input = [open_nt_emb]
-        for i in range(len(children_embs)):
-            fwd_input.append(children_embs[i])
-            bwd_input.append(children_embs[-i - 1])
-
-        # (n_children + 1, 1, input_size)
-        fwd_input = torch.stack(fwd_input).unsqueeze(1)
-        bwd_input = torch.stack(bwd_input).unsqueeze(1)
-        # (n_children + 1, 1, input_size)
-        fwd_output, _ = self.fwd_composer(fwd_input)
-        bwd_output, _ = self.bwd_composer(bwd_input)
-        # (input_size,)
-        fwd_emb = F.dropout(fwd_output[-1, 0], p=self.dropout, training=self.training)
-        bwd_emb = F.dropout(bwd_output[-1, 0], p=self.dropout, training=self.training)
-        # (input_size,)
-        return self.fwdbwd2composed(torch.cat([fwd_emb, bwd_emb]).view(1, -1)).view(-1)
-
-    def _get_illegal_actions(self) -> Optional[torch.LongTensor]:
-        illegal_action_ids = [
-            action_id for action_id in range(self.num_actions) if not self._is_legal(action_id)
+        nodes = []
+        for name in 'stack buffer history'.split():
+            encoder = getattr(self, f'{name}_encoder')
+            guard = getattr(self, f'{name}_guard')
+            nodes.extend(encoder.push_nodes([encoder.root_node()], guard.view(1, -1), [None]))
+        stack, buffer, history = nodes
+
+        # Buffer nodes hold the stack elements to shift, pushed in reverse with a single LSTM
+        # call. Embeddings are indexed by position, so repeated words keep their own.
+        word_ids = words.data.tolist()
+        positions = list(reversed(range(len(word_ids))))
+        values = [
+            StackElement(word_ids[i], self._batch_word_emb[i], False) for i in positions
         ]
-        if not illegal_action_ids:
-            return None
-        return self._new(illegal_action_ids).long()
-
-    def _is_legal(self, action_id: int) -> bool:
-        if action_id == self.SHIFT_ID:
-            return self._check_shift()
-        if action_id == self.REDUCE_ID:
-            return self._check_reduce()
-        return self._check_push_nt()
+        inputs = self._batch_word_emb.index_select(0, Variable(self._new(positions).long()))
+        buffer = self.buffer_encoder.push_sequence(buffer, inputs, values)[-1]
+        return ParserState(stack, buffer, history, 0)
+
+    def _get_state_legal_actions(self, state: ParserState) -> Tuple[bool, bool, bool]:
+        return self._get_legal_actions(
+            state.buffer.size - 1, state.num_open_nt, state.tos_is_open_nt)
+
+    def _score_states(self, states: Sequence[ParserState]) -> Variable:
+        # Score the actions of all states with a single pass
+        legal_actions = [self._get_state_legal_actions(state) for state in states]
+        # (num_states, num_actions)
+        return self._score_actions(self._concat_state_outputs(states), legal_actions)
+
+    def _concat_state_outputs(self, states: Sequence[ParserState]) -> Variable:
+        # shape: (num_states, 3 * hidden_size)
+        return torch.cat([
+            torch.stack([state.stack.output for state in states]),
+            torch.stack([state.buffer.output for state in states]),
+            torch.stack([state.history.output for state in states]),
+        ], dim=1)
+
+    def _apply_actions(self,
+                       states: Sequence[ParserState],
+                       action_ids: Sequence[ActionId],
+                       histories: Optional[Sequence[StackNode]] = None) -> List[ParserState]:
+        # Apply the (legal) action_ids[i] to states[i] for every i, pushing to each encoder
+        # with one LSTM call. States are never mutated, and neither are the trees they share.
+        # Histories that already have the actions pushed can be given to skip pushing them.
+        assert len(states) == len(action_ids)
+        assert histories is None or len(histories) == len(states)
+        if not states:
+            return []
+        assert self._batch_nt_emb is not None
+
+        stack_parents, elements = [], []  # type: List[StackNode], List[Optional[StackElement]]
+        buffers, nums_open_nt = [], []
+        reductions = []  # type: List[Tuple[int, StackElement, List[StackElement]]]
+        for state, action_id in zip(states, action_ids):
+            stack, buffer, num_open_nt = state.stack, state.buffer, state.num_open_nt
+            if action_id == self.SHIFT_ID:
+                assert buffer.size > 1
+                element = buffer.value
+                buffer = cast(StackNode, buffer.parent)
+            elif action_id == self.REDUCE_ID:
+                children = []
+                while not stack.value.is_open_nt:
+                    children.append(stack.value)
+                    stack = cast(StackNode, stack.parent)
+                assert children
+                children.reverse()
+                reductions.append((len(elements), stack.value, children))
+                stack = cast(StackNode, stack.parent)
+                element = None
+                num_open_nt -= 1
+            else:
+                nt_id = self._get_nt(action_id)
+                element = StackElement(Tree(nt_id, []), self._batch_nt_emb[nt_id], True)
+                num_open_nt += 1
+            stack_parents.append(stack)
+            elements.append(element)
+            buffers.append(buffer)
+            nums_open_nt.append(num_open_nt)
+
+        if reductions:
+            # All the reductions of the states are composed at once
+            composed_embs = self._compose_elements(
+                [open_nt for _, open_nt, _ in reductions],
+                [children for _, _, children in reductions])
+            for k, (i, open_nt, children) in enumerate(reductions):
+                subtree = Tree(cast(Tree, open_nt.subtree).label(), [c.subtree for c in children])
+                elements[i] = StackElement(subtree, composed_embs[k], False)
+        assert all(e is not None for e in elements)
+        pushed = cast(List[StackElement], elements)
+        stacks = self.stack_encoder.push_nodes(
+            stack_parents, torch.stack([e.emb for e in pushed]), pushed)
+        if histories is None:
+            assert self._batch_action_emb is not None
+            histories = self.history_encoder.push_nodes(
+                [state.history for state in states],
+                self._batch_action_emb.index_select(0, Variable(self._new(action_ids).long())),
+                action_ids)
+        return [
+            ParserState(*args) for args in zip(stacks, buffers, histories, nums_open_nt)
+        ]
+
+    def _action_beam_search(self, initial: Hypothesis, beam_size: int) -> List[Hypothesis]:
+        beam = [initial]
+        finished = []  # type: List[Hypothesis]
+        while beam:
+            candidates = self._get_top_candidates(
+                beam, self._score_hypotheses(beam), beam_size)
+            beam = []
+            for hyp in self._advance_hypotheses(candidates):
+                if hyp.state.finished:
+                    finished.append(hyp)
+                else:
+                    beam.append(hyp)
+            # Scores never increase, so no partial parse can beat the best complete one
+            if finished and beam and \
+                    max(h.score for h in finished) >= max(h.score for h in beam):
+                break
+        return finished
+
+    def _word_beam_search(self,
+                          initial: Hypothesis,
+                          beam_size: int,
+                          word_beam_size: int) -> List[Hypothesis]:
+        beam = [initial]
+        num_words = initial.state.buffer.size - 1
+        for _ in range(num_words + 1):
+            # Candidates that shift the next word, or complete the parse after the last one
+            next_candidates = []  # type: List[Tuple[float, Hypothesis, ActionId]]
+            while beam:
+                scores = self._score_hypotheses(beam)
+                rows = scores.tolist()
+                for i, hyp in enumerate(beam):
+                    next_action_ids = [self.SHIFT_ID]
+                    if hyp.state.num_open_nt == 1 and hyp.state.buffer.size == 1:
+                        next_action_ids.append(self.REDUCE_ID)
+                    for action_id in next_action_ids:
+                        if rows[i][action_id] > -float('inf'):
+                            next_candidates.append((rows[i][action_id], hyp, action_id))
+                        # The rest of the candidates stay at the current word
+                        scores[i, action_id] = -float('inf')
+                next_candidates = heapq.nlargest(
+                    word_beam_size, next_candidates, key=lambda x: x[0])
+                if len(next_candidates) == word_beam_size:
+                    # Hypotheses scoring below the next word's beam can never get into it
+                    threshold = next_candidates[-1][0]
+                    scores.masked_fill_(scores <= threshold, -float('inf'))
+                beam = self._advance_hypotheses(
+                    self._get_top_candidates(beam, scores, beam_size))
+            beam = self._advance_hypotheses(next_candidates)
+        return [h for h in beam if h.state.finished]
+
+    def _score_hypotheses(self, hyps: Sequence[Hypothesis]) -> torch.DoubleTensor:
+        # Score of every hypothesis followed by every action, where illegal actions score
+        # -inf. Summed in double precision like the scores of the hypotheses themselves.
+        log_probs = self._score_states([h.state for h in hyps]).data.double()
+        # (num_hyps, num_actions)
+        return log_probs + log_probs.new([h.score for h in hyps]).unsqueeze(1)
+
+    def _get_top_candidates(self,
+                            hyps: Sequence[Hypothesis],
+                            scores: torch.DoubleTensor,
+                            k: int) -> List[Tuple[float, Hypothesis, ActionId]]:
+        # The k best legal (hypothesis, action) pairs, best first, with a single top-k over
+        # all of them rather than a Python loop over every action of every hypothesis
+        num_actions = scores.size(1)
+        top_scores, top_indices = scores.view(-1).topk(min(k, scores.numel()))
+        candidates = []
+        for score, index in zip(top_scores.tolist(), top_indices.tolist()):
+            if score == -float('inf'):
+                break
+            candidates.append((score, hyps[index // num_actions], index % num_actions))
+        return candidates
+
+    def _advance_hypotheses(
+            self, candidates: Sequence[Tuple[float, Hypothesis, ActionId]]) -> List[Hypothesis]:
+        states = self._apply_actions(
+            [hyp.state for _, hyp, _ in candidates],
+            [action_id for _, _, action_id in candidates])
+        return [Hypothesis(state, score) for state, (score, _, _) in zip(states, candidates)]
 
     def _get_nt(self, action_id: int) -> int:
         assert action_id >= 2
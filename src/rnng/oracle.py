@@ -1,10 +1,11 @@
-from typing import List, Sequence
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 import abc
 
 from nltk.tree import Tree
 
-from rnng.actions import GEN, NT, REDUCE, SHIFT, get_nonterm, get_word, is_gen, is_nt
-from rnng.typing import Action, POSTag, Word
+from rnng.actions import (GEN, GEN_TAG, NT, NT_TAG, REDUCE, REDUCE_TAG, SHIFT, SHIFT_TAG,
+                          encode_action, get_nonterm, get_word, is_gen, is_nt)
+from rnng.typing import Action, ActionCode, NTLabel, POSTag, Word
 
 
 class Oracle(metaclass=abc.ABCMeta):
@@ -23,27 +24,41 @@ class Oracle(metaclass=abc.ABCMeta):
     def words(self) -> List[Word]:
         pass
 
+    # Views are read-only and not copied, unlike the lists returned by the properties above
+    @property
+    def actions_view(self) -> Sequence[Action]:
+        return self.actions
+
+    @property
+    def pos_tags_view(self) -> Sequence[POSTag]:
+        return self.pos_tags
+
+    @property
+    def words_view(self) -> Sequence[Word]:
+        return self.words
+
     def to_tree(self) -> Tree:
-        stack = []
-        pos_tags = list(reversed(self.pos_tags))
-        words = list(reversed(self.words))
-        for a in self.actions:
+        pos_tags, words = self.pos_tags_view, self.words_view
+        stack: List[Union[NTLabel, Tree]] = []
+        # Stack positions of the open nonterminals
+        open_nts: List[int] = []
+        i = 0
+        for a in self.actions_view:
             if is_nt(a):
+                open_nts.append(len(stack))
                 stack.append(get_nonterm(a))
             elif a == REDUCE:
-                children = []
-                while stack and isinstance(stack[-1], Tree):
-                    children.append(stack.pop())
-                if not children or not stack:
+                if not open_nts or open_nts[-1] == len(stack) - 1:
                     raise ValueError(
                         f'invalid {REDUCE} action, please check if the actions are correct')
-                parent = stack.pop()
-                tree = Tree(parent, list(reversed(children)))
-                stack.append(tree)
+                j = open_nts.pop()
+                children = stack[j + 1:]
+                del stack[j + 1:]
+                stack[j] = Tree(stack[j], children)
             else:
-                tree = Tree(pos_tags.pop(), [words.pop()])
-                stack.append(tree)
-        if len(stack) != 1:
+                stack.append(Tree(pos_tags[i], [words[i]]))
+                i += 1
+        if len(stack) != 1 or open_nts:
             raise ValueError('actions do not produce a single parse tree')
         return stack[0]
 
@@ -57,16 +72,62 @@ class Oracle(metaclass=abc.ABCMeta):
     def get_action_at_pos_node(cls, pos_node: Tree) -> Action:
         pass
 
+    @classmethod
+    @abc.abstractmethod
+    def encode_action_at_pos_node(cls, pos_node: Tree, word2id: Dict[Word, int]) -> ActionCode:
+        pass
+
     @classmethod
     def get_actions(cls, tree: Tree) -> List[Action]:
-        if len(tree) == 1 and not isinstance(tree[0], Tree):
-            return [cls.get_action_at_pos_node(tree)]
+        return cls.traverse(tree)[0]
+
+    @classmethod
+    def traverse(cls, tree: Tree) -> Tuple[List[Action], List[Tree]]:
+        # Get the actions and the POS nodes in a single pass, using an explicit stack so
+        # deeply nested trees do not hit the recursion limit
+        actions: List[Action] = []
+        pos_nodes: List[Tree] = []
+        stack: List[Optional[Tree]] = [tree]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                actions.append(REDUCE)
+            elif len(node) == 1 and not isinstance(node[0], Tree):
+                actions.append(cls.get_action_at_pos_node(node))
+                pos_nodes.append(node)
+            else:
+                actions.append(NT(node.label()))
+                # None marks where the REDUCE of this node goes
+                stack.append(None)
+                stack.extend(reversed(node))
+        return actions, pos_nodes
 
-        actions: List[Action] = [NT(tree.label())]
-        for child in tree:
-            actions.extend(cls.get_actions(child))
-        actions.append(REDUCE)
-        return actions
+    @classmethod
+    def encode(cls,
+               tree: Tree,
+               nonterm2id: Dict[NTLabel, int],
+               word2id: Dict[Word, int]) -> Tuple[List[ActionCode], List[Tree]]:
+        # Like traverse, but the actions are encoded as integers so no strings are made.
+        # Argument ids come from the given tables, which are extended with unseen labels
+        # and words.
+        reduce_code, nt_tag = encode_action(REDUCE_TAG), NT_TAG
+        codes: List[ActionCode] = []
+        pos_nodes: List[Tree] = []
+        stack: List[Optional[Tree]] = [tree]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                codes.append(reduce_code)
+            elif len(node) == 1 and not isinstance(node[0], Tree):
+                codes.append(cls.encode_action_at_pos_node(node, word2id))
+                pos_nodes.append(node)
+            else:
+                nid = nonterm2id.setdefault(node.label(), len(nonterm2id))
+                codes.append(encode_action(nt_tag, nid))
+                # None marks where the REDUCE of this node goes
+                stack.append(None)
+                stack.extend(reversed(node))
+        return codes, pos_nodes
 
 
 class DiscOracle(Oracle):
@@ -80,9 +141,9 @@ class DiscOracle(Oracle):
         if len(pos_tags) != len(words):
             raise ValueError('number of POS tags should match number of words')
 
-        self._actions = actions
-        self._pos_tags = pos_tags
-        self._words = words
+        self._actions = tuple(actions)
+        self._pos_tags = tuple(pos_tags)
+        self._words = tuple(words)
 
     @property
     def actions(self) -> List[Action]:
@@ -96,11 +157,24 @@ class DiscOracle(Oracle):
     def words(self) -> List[Word]:
         return list(self._words)
 
+    @property
+    def actions_view(self) -> Sequence[Action]:
+        return self._actions
+
+    @property
+    def pos_tags_view(self) -> Sequence[POSTag]:
+        return self._pos_tags
+
+    @property
+    def words_view(self) -> Sequence[Word]:
+        return self._words
+
     @classmethod
     def from_tree(cls, tree: Tree) -> 'DiscOracle':
-        actions = cls.get_actions(tree)
-        words, pos_tags = zip(*tree.pos())
-        return cls(actions, list(pos_tags), list(words))
+        actions, pos_nodes = cls.traverse(tree)
+        pos_tags = [node.label() for node in pos_nodes]
+        words = [node[0] for node in pos_nodes]
+        return cls(actions, pos_tags, words)
 
     @classmethod
     def get_action_at_pos_node(cls, pos_node: Tree) -> Action:
@@ -108,6 +182,11 @@ class DiscOracle(Oracle):
             raise ValueError('input is not a valid POS node')
         return SHIFT
 
+    @classmethod
+    def encode_action_at_pos_node(cls, pos_node: Tree, word2id: Dict[Word, int]) -> ActionCode:
+        cls.get_action_at_pos_node(pos_node)
+        return encode_action(SHIFT_TAG)
+
 
 class GenOracle(Oracle):
     def __init__(self, actions: Sequence[Action], pos_tags: Sequence[POSTag]) -> None:
@@ -115,8 +194,9 @@ class GenOracle(Oracle):
         if len(pos_tags) != gen_cnt:
             raise ValueError('number of POS tags should match number of GEN actions')
 
-        self._actions = actions
-        self._pos_tags = pos_tags
+        self._actions = tuple(actions)
+        self._pos_tags = tuple(pos_tags)
+        self._words = tuple(get_word(a) for a in self._actions if is_gen(a))
 
     @property
     def actions(self) -> List[Action]:
@@ -128,16 +208,33 @@ class GenOracle(Oracle):
 
     @property
     def words(self) -> List[Word]:
-        return [get_word(a) for a in self.actions if is_gen(a)]
+        return list(self._words)
+
+    @property
+    def actions_view(self) -> Sequence[Action]:
+        return self._actions
+
+    @property
+    def pos_tags_view(self) -> Sequence[POSTag]:
+        return self._pos_tags
+
+    @property
+    def words_view(self) -> Sequence[Word]:
+        return self._words
 
     @classmethod
     def from_tree(cls, tree: Tree) -> 'GenOracle':
-        actions = cls.get_actions(tree)
-        _, pos_tags = zip(*tree.pos())
-        return cls(actions, list(pos_tags))
+        actions, pos_nodes = cls.traverse(tree)
+        return cls(actions, [node.label() for node in pos_nodes])
 
     @classmethod
     def get_action_at_pos_node(cls, pos_node: Tree) -> Action:
         if len(pos_node) != 1 or isinstance(pos_node[0], Tree):
             raise ValueError('input is not a valid POS node')
         return GEN(pos_node[0])
+
+    @classmethod
+    def encode_action_at_pos_node(cls, pos_node: Tree, word2id: Dict[Word, int]) -> ActionCode:
+        if len(pos_node) != 1 or isinstance(pos_node[0], Tree):
+            raise ValueError('input is not a valid POS node')
+        return encode_action(GEN_TAG, word2id.setdefault(pos_node[0], len(word2id)))
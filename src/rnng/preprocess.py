@@ -0,0 +1,136 @@
+from array import array
+from collections import deque
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, NamedTuple, Sequence, Tuple, TypeVar
+from typing import Deque, Dict  # noqa
+import multiprocessing
+import os
+
+from torchtext.data import Field
+import numpy as np
+
+from rnng.actions import NT_TAG, decode_action, encode_action, get_arg_id, get_tag
+from rnng.cache import get_cache_key
+from rnng.corpus import iter_sexprs, parse_tree
+from rnng.dataset import ArrayDataset
+from rnng.oracle import DiscOracle
+from rnng.typing import ActionCode, NTLabel, POSTag, Word
+
+
+T = TypeVar('T')
+
+
+def iter_chunks(iterable: Iterable[T], chunk_size: int) -> Iterator[List[T]]:
+    if chunk_size <= 0:
+        raise ValueError(f'nonpositive chunk size: {chunk_size}')
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class EncodedChunk(NamedTuple):
+    # Integer-encoded oracles of a chunk of trees, where the arguments of NT actions are
+    # ids in the nonterminal table of the chunk
+    codes: List[List[ActionCode]]
+    pos_tags: List[List[POSTag]]
+    words: List[List[Word]]
+    nonterms: List[NTLabel]
+
+
+def encode_trees(sexprs: Sequence[str]) -> EncodedChunk:
+    # Runs in the worker processes, so it must be picklable by reference
+    chunk = EncodedChunk([], [], [], [])
+    nonterm2id = {}  # type: Dict[NTLabel, int]
+    for sexpr in sexprs:
+        codes, pos_nodes = DiscOracle.encode(parse_tree(sexpr), nonterm2id, {})
+        chunk.codes.append(codes)
+        chunk.pos_tags.append([node.label() for node in pos_nodes])
+        chunk.words.append([node[0] for node in pos_nodes])
+    chunk.nonterms.extend(nonterm2id)
+    return chunk
+
+
+def read_chunks(corpus: str,
+                encoding: str = 'utf-8',
+                num_workers: int = 1,
+                chunk_size: int = 1000) -> Iterator[EncodedChunk]:
+    # Chunks are yielded in corpus order no matter how many workers encode them
+    if num_workers <= 0:
+        raise ValueError(f'nonpositive number of workers: {num_workers}')
+    with open(corpus, encoding=encoding) as f:
+        sexpr_chunks = iter_chunks(iter_sexprs(f), chunk_size)
+        if num_workers == 1:
+            yield from map(encode_trees, sexpr_chunks)
+            return
+
+        with multiprocessing.Pool(num_workers) as pool:
+            # Only a few chunks are in flight at any time, so the corpus is never held in
+            # memory as a whole, unlike with Pool.imap which consumes its input eagerly
+            pending = deque()  # type: Deque[multiprocessing.pool.AsyncResult]
+            for sexprs in sexpr_chunks:
+                pending.append(pool.apply_async(encode_trees, (sexprs, )))
+                if len(pending) >= 2 * num_workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+
+def build_dataset(chunks: Iterable[EncodedChunk],
+                  fields: Sequence[Tuple[str, Field]]) -> ArrayDataset:
+    # Same dataset as ArrayDataset.from_examples gives for the examples of the oracles, but
+    # actions stay integers and only the distinct ones are decoded at the end. The fields
+    # must be the ones of make_fields.
+    fields_dict = dict(fields)
+    symbol2id = {name: {} for name in fields_dict}  # type: Dict[str, Dict[Any, int]]
+    ids = {name: array('i') for name in fields_dict}
+    offsets = {name: array('q', [0]) for name in fields_dict}
+
+    def add(name: str, symbols: Sequence[Any]) -> None:
+        s2i = symbol2id[name]
+        ids[name].extend(s2i.setdefault(s, len(s2i)) for s in symbols)
+        offsets[name].append(offsets[name][-1] + len(symbols))
+
+    nonterm2id = symbol2id['nonterms']
+    for chunk in chunks:
+        # Ids in the whole dataset of the nonterminals of the chunk
+        nids = [nonterm2id.setdefault(label, len(nonterm2id)) for label in chunk.nonterms]
+        for codes, pos_tags, words in zip(chunk.codes, chunk.pos_tags, chunk.words):
+            codes = [
+                encode_action(NT_TAG, nids[get_arg_id(c)]) if get_tag(c) == NT_TAG else c
+                for c in codes
+            ]
+            add('actions', codes)
+            nonterm_ids = [get_arg_id(c) for c in codes if get_tag(c) == NT_TAG]
+            ids['nonterms'].extend(nonterm_ids)
+            offsets['nonterms'].append(offsets['nonterms'][-1] + len(nonterm_ids))
+            add('pos_tags', fields_dict['pos_tags'].preprocess(pos_tags))
+            add('words', fields_dict['words'].preprocess(words))
+
+    nonterms = list(nonterm2id)
+    symbols = {name: list(symbol2id[name]) for name in fields_dict}
+    symbols['actions'] = [decode_action(c, nonterms) for c in symbol2id['actions']]
+    return ArrayDataset(
+        list(fields_dict),
+        {name: np.array(ids[name], dtype=np.int32) for name in fields_dict},
+        {name: np.array(offsets[name], dtype=np.int64) for name in fields_dict},
+        symbols,
+    )
+
+
+def preprocess_corpus(corpus: str,
+                      fields: Sequence[Tuple[str, Field]],
+                      cache_dir: str,
+                      encoding: str = 'utf-8',
+                      num_workers: int = 1,
+                      chunk_size: int = 1000) -> str:
+    # Save the corpus as an array dataset where the trainer looks for it, returning its path
+    key = get_cache_key(corpus, fields, encoding=encoding)
+    cache_path = os.path.join(cache_dir, key)
+    if not os.path.isdir(cache_path):
+        chunks = read_chunks(
+            corpus, encoding=encoding, num_workers=num_workers, chunk_size=chunk_size)
+        build_dataset(chunks, fields).save(cache_path)
+    return cache_path
@@ -1,11 +1,13 @@
 import argparse
 
+import rnng.commands.preprocess as preprocess
 import rnng.commands.train as train
 
 
 def make_parser():
     parser = argparse.ArgumentParser(description='Command line interface to RNNG.')
     subparsers = parser.add_subparsers()
+    preprocess.make_parser(subparsers)
     train.make_parser(subparsers)
     return parser
 
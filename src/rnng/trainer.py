@@ -1,4 +1,6 @@
-from typing import Optional, Tuple
+from collections import Counter
+from typing import Iterator, Optional, Tuple, Union
+from typing import Dict  # noqa
 import json
 import logging
 import os
@@ -7,19 +9,23 @@ import re
 import subprocess
 import tarfile
 
-from nltk.corpus.reader import BracketParseCorpusReader
 from torch.autograd import Variable
-from torchtext.data import Dataset, Field
+from torchtext.data import Example
 import dill
 import torch
 import torch.optim as optim
 import torchnet as tnt
 
+from rnng.cache import get_cache_key
+from rnng.corpus import read_trees
+from rnng.dataset import ArrayDataset
+from rnng.evalb import EvalbParams, F1Meter
 from rnng.example import make_example
-from rnng.fields import ActionField
-from rnng.iterator import SimpleIterator
+from rnng.fields import make_fields
+from rnng.iterator import ArrayIterator, StreamingIterator
 from rnng.models import DiscRNNG
 from rnng.oracle import DiscOracle
+from rnng.preprocess import build_dataset, read_chunks
 from rnng.utils import add_dummy_pos, get_evalb_f1, id2parsetree
 
 
@@ -41,12 +47,17 @@ class Trainer(object):
                  num_layers: int = 2,
                  dropout: float = 0.5,
                  learning_rate: float = 0.001,
+                 batch_size: int = 1,
                  max_epochs: int = 20,
                  evalb: Optional[str] = None,
                  evalb_params: Optional[str] = None,
                  device: int = -1,
                  seed: int = 25122017,
                  log_interval: int = 10,
+                 train_f1_interval: int = 0,
+                 cache_dir: Optional[str] = None,
+                 streaming: bool = False,
+                 shuffle_buffer_size: int = 10000,
                  logger: Optional[logging.Logger] = None) -> None:
         if logger is None:
             logger = logging.getLogger(__name__)
@@ -56,8 +67,8 @@ class Trainer(object):
             formatter = logging.Formatter('%(levelname)s - %(name)s - %(message)s')
             handler.setFormatter(formatter)
             logger.addHandler(handler)
-        if evalb is None:
-            evalb = 'evalb'
+        if train_f1_interval < 0:
+            raise ValueError(f'negative train F1 interval: {train_f1_interval}')
 
         self.train_corpus = train_corpus
         self.save_to = save_to
@@ -75,22 +86,35 @@ class Trainer(object):
         self.num_layers = num_layers
         self.dropout = dropout
         self.learning_rate = learning_rate
+        self.batch_size = batch_size
         self.max_epochs = max_epochs
         self.evalb = evalb
         self.evalb_params = evalb_params
         self.device = device
         self.seed = seed
         self.log_interval = log_interval
+        self.train_f1_interval = train_f1_interval
+        self.cache_dir = cache_dir
+        self.streaming = streaming
+        self.shuffle_buffer_size = shuffle_buffer_size
         self.logger = logger
 
         self.loss_meter = tnt.meter.AverageValueMeter()
+        self.f1_meter = F1Meter(
+            None if evalb_params is None else EvalbParams.from_file(evalb_params))
         self.speed_meter = tnt.meter.AverageValueMeter()
         self.batch_timer = tnt.meter.TimeMeter(None)
         self.epoch_timer = tnt.meter.TimeMeter(None)
         self.train_timer = tnt.meter.TimeMeter(None)
+        # Training iterations so far in the current epoch
+        self.epoch_iterations = 0
         self.engine = tnt.engine.Engine()
+        # Reference trees of the current batch
+        self.batch_ref_trees = []  # type: ignore
+        # All trees so far, only kept if an evalb executable is given to score them
         self.ref_trees = []  # type: ignore
         self.hyp_trees = []  # type: ignore
+        self.decode_sample = False
 
     def set_random_seed(self) -> None:
         self.logger.info('Setting random seed to %d', self.seed)
@@ -106,32 +130,42 @@ class Trainer(object):
         self.artifacts_path = os.path.join(self.save_to, 'artifacts.tar.gz')
 
     def init_fields(self) -> None:
-        self.WORDS = Field(pad_token=None, lower=self.lower)
-        self.POS_TAGS = Field(pad_token=None)
-        self.NONTERMS = Field(pad_token=None)
-        self.ACTIONS = ActionField(self.NONTERMS)
-        self.fields = [
-            ('actions', self.ACTIONS), ('nonterms', self.NONTERMS),
-            ('pos_tags', self.POS_TAGS), ('words', self.WORDS),
-        ]
+        self.fields = make_fields(lower=self.lower)
+        fields_dict = dict(self.fields)
+        self.WORDS = fields_dict['words']
+        self.POS_TAGS = fields_dict['pos_tags']
+        self.NONTERMS = fields_dict['nonterms']
+        self.ACTIONS = fields_dict['actions']
 
     def process_corpora(self) -> None:
-        self.logger.info('Reading train corpus from %s', self.train_corpus)
-        self.train_dataset = self.make_dataset(self.train_corpus)
-        self.train_iterator = SimpleIterator(self.train_dataset, device=self.device)
+        self.train_dataset = None
         self.dev_dataset = None
         self.dev_iterator = None
+        if self.streaming:
+            # Corpora are read anew every epoch, without ever loading them as a whole
+            self.logger.info('Streaming train corpus from %s', self.train_corpus)
+            self.train_iterator = self.make_iterator(self.train_corpus, None)
+            if self.dev_corpus is not None:
+                self.logger.info('Streaming dev corpus from %s', self.dev_corpus)
+                self.dev_iterator = self.make_iterator(self.dev_corpus, None, train=False)
+            return
+
+        self.logger.info('Reading train corpus from %s', self.train_corpus)
+        self.train_dataset = self.make_dataset(self.train_corpus)
+        self.train_iterator = self.make_iterator(self.train_corpus, self.train_dataset)
         if self.dev_corpus is not None:
             self.logger.info('Reading dev corpus from %s', self.dev_corpus)
             self.dev_dataset = self.make_dataset(self.dev_corpus)
-            self.dev_iterator = SimpleIterator(
-                self.dev_dataset, train=False, device=self.device)
+            self.dev_iterator = self.make_iterator(
+                self.dev_corpus, self.dev_dataset, train=False)
 
     def build_vocabularies(self) -> None:
         self.logger.info('Building vocabularies')
-        self.WORDS.build_vocab(self.train_dataset, min_freq=self.min_freq)
-        self.POS_TAGS.build_vocab(self.train_dataset)
-        self.NONTERMS.build_vocab(self.train_dataset)
+        # Fields count the tokens of each source, which are the precomputed counts here
+        counts = self.count_tokens()
+        self.WORDS.build_vocab([counts['words']], min_freq=self.min_freq)
+        self.POS_TAGS.build_vocab([counts['pos_tags']])
+        self.NONTERMS.build_vocab([counts['nonterms']])
         self.ACTIONS.build_vocab()
 
         self.num_words = len(self.WORDS.vocab)
@@ -184,6 +218,7 @@ class Trainer(object):
         self.engine.hooks['on_start_epoch'] = self.on_start_epoch
         self.engine.hooks['on_sample'] = self.on_sample
         self.engine.hooks['on_forward'] = self.on_forward
+        self.engine.hooks['on_update'] = self.on_update
         self.engine.hooks['on_end_epoch'] = self.on_end_epoch
         self.engine.hooks['on_end'] = self.on_end
 
@@ -195,19 +230,34 @@ class Trainer(object):
             self.save_artifacts()
 
     def network(self, sample) -> Tuple[Variable, None]:
-        words = sample.words.squeeze(1)
-        pos_tags = sample.pos_tags.squeeze(1)
-        actions = sample.actions.squeeze(1)
-        llh = self.model(words, pos_tags, actions)
+        words, word_lengths = sample.words
+        actions, action_lengths = sample.actions
+        llh = self.model(
+            words, sample.pos_tags, actions, word_lengths=word_lengths,
+            action_lengths=action_lengths)
+        if self.decode_sample:
+            self.add_hyp_trees(words, sample.pos_tags, word_lengths)
+        return -llh.mean(), None
+
+    def add_hyp_trees(self,
+                      words: Variable,
+                      pos_tags: Variable,
+                      word_lengths: torch.LongTensor) -> None:
         training = self.model.training
         self.model.eval()
-        _, hyp_tree = self.model.decode(words, pos_tags)
+        hyp_trees = []
+        for _, hyp_tree in self.model.decode_batch(words, pos_tags, word_lengths.tolist()):
+            hyp_tree = id2parsetree(
+                hyp_tree, self.NONTERMS.vocab.itos, self.WORDS.vocab.itos)
+            hyp_trees.append(add_dummy_pos(hyp_tree))
         self.model.train(training)
-        hyp_tree = id2parsetree(
-            hyp_tree, self.NONTERMS.vocab.itos, self.WORDS.vocab.itos)
-        hyp_tree = add_dummy_pos(hyp_tree)
-        self.hyp_trees.append(self.squeeze_whitespaces(str(hyp_tree)))
-        return -llh, None
+
+        assert len(hyp_trees) == len(self.batch_ref_trees)
+        for ref_tree, hyp_tree in zip(self.batch_ref_trees, hyp_trees):
+            self.f1_meter.add(ref_tree, hyp_tree)
+        if self.evalb is not None:
+            self.ref_trees.extend(self.batch_ref_trees)
+            self.hyp_trees.extend(hyp_trees)
 
     def on_start(self, state: dict) -> None:
         if state['train']:
@@ -220,31 +270,67 @@ class Trainer(object):
         self.reset_meters()
         self.model.train()
         self.epoch_timer.reset()
+        self.epoch_iterations = 0
 
     def on_sample(self, state: dict) -> None:
         self.batch_timer.reset()
+        # Decoding is as expensive as the forward pass, so training batches are only
+        # decoded for the running F1 every train_f1_interval iterations, if at all
+        if state['train']:
+            self.decode_sample = self.train_f1_interval > 0 \
+                and (state['t'] + 1) % self.train_f1_interval == 0
+        else:
+            self.decode_sample = True
+        if not self.decode_sample:
+            return
+
         sample = state['sample']
-        actions = [self.ACTIONS.vocab.itos[x] for x in sample.actions.squeeze(1).data]
-        pos_tags = [self.POS_TAGS.vocab.itos[x] for x in sample.pos_tags.squeeze(1).data]
-        words = [self.WORDS.vocab.itos[x] for x in sample.words.squeeze(1).data]
-        tree = DiscOracle(actions, pos_tags, words).to_tree()
-        self.ref_trees.append(self.squeeze_whitespaces(str(tree)))
+        self.batch_ref_trees = []
+        words, word_lengths = sample.words
+        actions, action_lengths = sample.actions
+        lengths = zip(word_lengths.tolist(), action_lengths.tolist())
+        for i, (length, action_length) in enumerate(lengths):
+            action_strs = [
+                self.ACTIONS.vocab.itos[x] for x in actions[:action_length, i].data.tolist()]
+            pos_tag_strs = [
+                self.POS_TAGS.vocab.itos[x] for x in sample.pos_tags[:length, i].data.tolist()]
+            word_strs = [self.WORDS.vocab.itos[x] for x in words[:length, i].data.tolist()]
+            tree = DiscOracle(action_strs, pos_tag_strs, word_strs).to_tree()
+            self.batch_ref_trees.append(tree)
 
     def on_forward(self, state: dict) -> None:
         elapsed_time = self.batch_timer.value()
-        self.loss_meter.add(state['loss'].data[0])
-        self.speed_meter.add(state['sample'].words.size(1) / elapsed_time)
+        # The loss is a scalar, which is 0-dim or of size 1 depending on the torch version
+        self.loss_meter.add(float(state['loss'].data.sum()))
+        batch_size = state['sample'].words[0].size(1)
+        self.speed_meter.add(batch_size / elapsed_time)
+        if state['train']:
+            self.epoch_iterations += 1
         if state['train'] and (state['t'] + 1) % self.log_interval == 0:
-            f1_score = self.compute_f1()
-            epoch = (state['t'] + 1) / len(state['iterator'])
+            try:
+                progress = '%.4f' % ((state['t'] + 1) / len(state['iterator']))
+            except TypeError:
+                # The length of a streamed corpus is unknown during the first epoch, so
+                # report the iteration within the current epoch instead
+                progress = '%d, iter %d' % (state['epoch'] + 1, self.epoch_iterations)
             loss, _ = self.loss_meter.value()
             speed, _ = self.speed_meter.value()
-            self.logger.info(
-                'Epoch %.4f (%.4fs): %.2f samples/sec | loss %.4f | F1 %.2f',
-                epoch, elapsed_time, speed, loss, f1_score)
+            if self.f1_meter.counts['num_sentences']:
+                f1_score = self.compute_f1()
+                self.logger.info(
+                    'Epoch %s (%.4fs): %.2f samples/sec | loss %.4f | F1 %.2f',
+                    progress, elapsed_time, speed, loss, f1_score)
+            else:
+                self.logger.info(
+                    'Epoch %s (%.4fs): %.2f samples/sec | loss %.4f',
+                    progress, elapsed_time, speed, loss)
+
+    def on_update(self, state: dict) -> None:
+        # The optimizer step changed the parameters
+        self.model.clear_projection_cache()
 
     def on_end_epoch(self, state: dict) -> None:
-        iterator = SimpleIterator(self.train_dataset, train=False, device=self.device)
+        iterator = self.make_iterator(self.train_corpus, self.train_dataset, train=False)
         self.engine.test(self.network, iterator)
         f1_score = self.compute_f1()
         epoch = state['epoch']
@@ -269,18 +355,53 @@ class Trainer(object):
             self.logger.info('Training done in %.4fs', elapsed_time)
             self.save_artifacts()
 
-    def make_dataset(self, corpus: str) -> Dataset:
-        reader = BracketParseCorpusReader(
-            *os.path.split(corpus), encoding=self.encoding, detect_blocks='sexpr')
-        oracles = [DiscOracle.from_tree(t) for t in reader.parsed_sents()]
-        examples = [make_example(x, self.fields) for x in oracles]
-        return Dataset(examples, self.fields)
+    def make_dataset(self, corpus: str) -> ArrayDataset:
+        if self.cache_dir is None:
+            return build_dataset(read_chunks(corpus, encoding=self.encoding), self.fields)
+
+        key = get_cache_key(corpus, self.fields, encoding=self.encoding)
+        cache_path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(cache_path):
+            self.logger.info('Loading cached corpus from %s', cache_path)
+            return ArrayDataset.load(cache_path)
+        dataset = build_dataset(read_chunks(corpus, encoding=self.encoding), self.fields)
+        self.logger.info('Caching corpus to %s', cache_path)
+        dataset.save(cache_path)
+        return dataset
+
+    def make_iterator(self,
+                      corpus: str,
+                      dataset: Optional[ArrayDataset],
+                      train: bool = True) -> Union[ArrayIterator, StreamingIterator]:
+        # The corpus is streamed if there is no dataset of it
+        if dataset is None:
+            return StreamingIterator(
+                lambda: self.read_examples(corpus), self.fields, batch_size=self.batch_size,
+                train=train, device=self.device, buffer_size=self.shuffle_buffer_size)
+        return ArrayIterator(
+            dataset, self.fields, batch_size=self.batch_size, train=train, device=self.device)
+
+    def read_examples(self, corpus: str) -> Iterator[Example]:
+        # Trees are read and turned into examples lazily, one at a time
+        for tree in read_trees(corpus, encoding=self.encoding):
+            yield make_example(DiscOracle.from_tree(tree), self.fields)
+
+    def count_tokens(self) -> Dict[str, Counter]:
+        names = [name for name, _ in self.fields]
+        if self.train_dataset is not None:
+            return {name: self.train_dataset.count(name) for name in names}
+        counts = {name: Counter() for name in names}  # type: Dict[str, Counter]
+        for ex in self.read_examples(self.train_corpus):
+            for name in names:
+                counts[name].update(getattr(ex, name))
+        return counts
 
     def reset_meters(self) -> None:
         self.loss_meter.reset()
         self.speed_meter.reset()
         self.ref_trees = []
         self.hyp_trees = []
+        self.f1_meter.reset()
 
     def save_artifacts(self) -> None:
         self.logger.info('Saving training artifacts to %s', self.artifacts_path)
@@ -295,11 +416,14 @@ class Trainer(object):
         torch.save(self.model.state_dict(), self.model_params_path)
 
     def compute_f1(self) -> float:
+        if self.evalb is None:
+            return self.f1_meter.value()
+
         ref_fname = os.path.join(self.save_to, 'reference.bracket')
         hyp_fname = os.path.join(self.save_to, 'hypothesis.bracket')
         with open(ref_fname, 'w') as ref_file, open(hyp_fname, 'w') as hyp_file:
-            ref_file.write('\n'.join(self.ref_trees))
-            hyp_file.write('\n'.join(self.hyp_trees))
+            ref_file.write('\n'.join(self.squeeze_whitespaces(str(t)) for t in self.ref_trees))
+            hyp_file.write('\n'.join(self.squeeze_whitespaces(str(t)) for t in self.hyp_trees))
         if self.evalb_params is None:
             args = [self.evalb, ref_file.name, hyp_file.name]
         else:
@@ -6,3 +6,4 @@ WordId = int
 POSId = int
 NTId = int
 ActionId = int
+ActionCode = int
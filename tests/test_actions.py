@@ -1,6 +1,8 @@
 import pytest
 
-from rnng.actions import GEN, NT, REDUCE, SHIFT, get_nonterm, get_word, is_gen, is_nt
+from rnng.actions import (GEN, GEN_TAG, NT, NT_TAG, REDUCE, REDUCE_TAG, SHIFT, SHIFT_TAG,
+                          decode_action, encode_action, get_arg_id, get_nonterm, get_tag,
+                          get_word, is_gen, is_nt)
 
 
 def test_reduce_action():
@@ -53,3 +55,23 @@ def test_is_gen():
     assert not is_gen(REDUCE)
     assert not is_gen(SHIFT)
     assert not is_gen(NT('NP'))
+
+
+def test_encode_action():
+    tags = [REDUCE_TAG, SHIFT_TAG, NT_TAG, GEN_TAG]
+    assert len(set(tags)) == len(tags)
+    for tag in tags:
+        for arg_id in [0, 1, 1000]:
+            code = encode_action(tag, arg_id)
+            assert get_tag(code) == tag
+            assert get_arg_id(code) == arg_id
+
+
+def test_decode_action():
+    nonterms = ['S', 'NP']
+    words = ['John']
+
+    assert decode_action(encode_action(REDUCE_TAG)) == REDUCE
+    assert decode_action(encode_action(SHIFT_TAG)) == SHIFT
+    assert decode_action(encode_action(NT_TAG, 1), nonterms=nonterms) == NT('NP')
+    assert decode_action(encode_action(GEN_TAG, 0), words=words) == GEN('John')
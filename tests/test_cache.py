@@ -0,0 +1,22 @@
+from torchtext.data import Field
+
+from rnng.cache import get_cache_key
+
+
+class TestCache(object):
+    def make_corpus(self, tmpdir, content='(S (NP (NNP John)) (VP (VBZ runs)))'):
+        path = tmpdir.join('corpus.txt')
+        path.write(content)
+        return str(path)
+
+    def test_get_cache_key(self, tmpdir):
+        corpus = self.make_corpus(tmpdir)
+        fields = [('words', Field(lower=True)), ('pos_tags', Field())]
+
+        key = get_cache_key(corpus, fields)
+
+        assert key == get_cache_key(corpus, [('words', Field(lower=True)), ('pos_tags', Field())])
+        assert key != get_cache_key(corpus, [('words', Field()), ('pos_tags', Field())])
+        assert key != get_cache_key(corpus, fields, encoding='latin-1')
+        other_corpus = self.make_corpus(tmpdir.mkdir('other'), content='(S (NN x))')
+        assert key != get_cache_key(other_corpus, fields)
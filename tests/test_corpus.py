@@ -0,0 +1,85 @@
+import os
+import random
+
+from nltk.corpus.reader import BracketParseCorpusReader
+from nltk.tree import Tree
+import pytest
+
+from rnng.corpus import iter_sexprs, parse_tree, read_trees, shuffle_buffer
+
+
+CORPUS = """
+( (S (NP-SBJ (NNP John))
+     (VP (VBZ loves)
+       (NP (NNP Mary)))
+     (. .)))
+(S (NP (NNP Mary)) (VP (VBZ cries))) (S (NP (PRP It)) (VP (VBZ rains) (, ,) (ADVP (RB sadly))))
+"""
+
+
+def test_read_trees(tmpdir):
+    path = tmpdir.join('corpus.txt')
+    path.write(CORPUS)
+    reader = BracketParseCorpusReader(
+        *os.path.split(str(path)), encoding='utf-8', detect_blocks='sexpr')
+
+    trees = read_trees(str(path))
+
+    assert not isinstance(trees, list)
+    assert list(trees) == list(reader.parsed_sents())
+
+
+def test_iter_sexprs():
+    lines = ['(S (NP John)\n', '  (VP runs)) (S\n', '(NP Mary))\n']
+
+    assert list(iter_sexprs(lines)) == [
+        '(S (NP John)\n  (VP runs))', '(S\n(NP Mary))']
+
+
+def test_iter_sexprs_with_unbalanced_parentheses():
+    with pytest.raises(ValueError) as excinfo:
+        list(iter_sexprs(['(S (NP John)))\n']))
+    assert 'unbalanced closing parenthesis at line 1' in str(excinfo.value)
+    with pytest.raises(ValueError) as excinfo:
+        list(iter_sexprs(['(S (NP John)\n']))
+    assert 'unexpected end of file inside a tree' in str(excinfo.value)
+
+
+def test_parse_tree():
+    assert parse_tree('( (S (NP (NNP John)) (. .)))') == Tree.fromstring(
+        '(S (NP (NNP John)) (. .))')
+    assert parse_tree('(S (NP (NNP John)) (.))') == Tree.fromstring(
+        '(S (NP (NNP John)) (. .))')
+
+
+def test_shuffle_buffer():
+    items = list(range(100))
+    rng = random.Random(12345)
+
+    shuffled = list(shuffle_buffer(iter(items), 10, rng=rng))
+
+    assert sorted(shuffled) == items
+    assert shuffled != items
+
+
+def test_shuffle_buffer_is_bounded():
+    num_read = 0
+
+    def generate():
+        nonlocal num_read
+        for i in range(100):
+            num_read += 1
+            yield i
+
+    iterator = shuffle_buffer(generate(), 10, rng=random.Random(12345))
+
+    next(iterator)
+    assert num_read == 11
+    next(iterator)
+    assert num_read == 12
+
+
+def test_shuffle_buffer_with_nonpositive_size():
+    with pytest.raises(ValueError) as excinfo:
+        list(shuffle_buffer([1, 2], 0))
+    assert 'nonpositive buffer size: 0' in str(excinfo.value)
@@ -0,0 +1,89 @@
+import os
+
+from torchtext.data import Example, Field
+import numpy as np
+import pytest
+
+from rnng.dataset import ArrayDataset
+
+
+class TestArrayDataset(object):
+    names = ['words', 'pos_tags']
+    fields = [('words', Field()), ('pos_tags', Field())]
+    examples = [
+        Example.fromlist(['John loves Mary'.split(), 'NNP VBZ NNP'.split()], fields),
+        Example.fromlist(['Mary cries'.split(), 'NNP VBZ'.split()], fields),
+    ]
+
+    def make_dataset(self):
+        return ArrayDataset.from_examples(self.examples, self.names)
+
+    def test_from_examples(self):
+        dataset = self.make_dataset()
+
+        assert dataset.names == self.names
+        assert len(dataset) == len(self.examples)
+        assert dataset.arrays['words'].dtype == np.int32
+        assert dataset.arrays['words'].tolist() == [0, 1, 2, 2, 3]
+        assert dataset.offsets['words'].tolist() == [0, 3, 5]
+        assert dataset.symbols['words'] == 'John loves Mary cries'.split()
+
+    def test_get(self):
+        dataset = self.make_dataset()
+
+        assert dataset.get('words', 1).tolist() == [2, 3]
+        for i, ex in enumerate(self.examples):
+            assert dataset.get_symbols('words', i) == ex.words
+            assert dataset.get_symbols('pos_tags', i) == ex.pos_tags
+
+    def test_count(self):
+        dataset = self.make_dataset()
+
+        assert dataset.count('words') == {'John': 1, 'loves': 1, 'Mary': 2, 'cries': 1}
+        assert dataset.count('pos_tags') == {'NNP': 3, 'VBZ': 2}
+
+    def test_save_and_load(self, tmpdir):
+        path = str(tmpdir.join('dataset'))
+        dataset = self.make_dataset()
+
+        dataset.save(path)
+        loaded = ArrayDataset.load(path)
+
+        assert sorted(os.listdir(str(tmpdir))) == ['dataset']
+        assert loaded.names == dataset.names
+        assert isinstance(loaded.arrays['words'], np.memmap)
+        for i in range(len(dataset)):
+            assert loaded.get_symbols('words', i) == dataset.get_symbols('words', i)
+            assert loaded.get_symbols('pos_tags', i) == dataset.get_symbols('pos_tags', i)
+        assert not isinstance(ArrayDataset.load(path, mmap=False).arrays['words'], np.memmap)
+
+    def test_save_with_umask(self, tmpdir):
+        path = str(tmpdir.join('dataset'))
+        umask = os.umask(0o022)
+        try:
+            self.make_dataset().save(path)
+        finally:
+            os.umask(umask)
+
+        assert os.stat(path).st_mode & 0o777 == 0o755
+
+    def test_save_when_already_saved(self, tmpdir):
+        path = str(tmpdir.join('dataset'))
+        self.make_dataset().save(path)
+
+        ArrayDataset.from_examples(self.examples[:1], self.names).save(path)
+
+        assert len(ArrayDataset.load(path)) == len(self.examples)
+        assert sorted(os.listdir(str(tmpdir))) == ['dataset']
+
+    def test_init_with_mismatched_attributes(self):
+        dataset = self.make_dataset()
+        offsets = dict(dataset.offsets, pos_tags=dataset.offsets['pos_tags'][:-1])
+
+        with pytest.raises(ValueError) as excinfo:
+            ArrayDataset(dataset.names, dataset.arrays, offsets, dataset.symbols)
+        assert 'expected all attributes to have the same number of examples' in str(
+            excinfo.value)
+        with pytest.raises(ValueError) as excinfo:
+            ArrayDataset(['foo'], dataset.arrays, dataset.offsets, dataset.symbols)
+        assert 'missing arrays or symbols of foo' in str(excinfo.value)
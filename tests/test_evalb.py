@@ -0,0 +1,260 @@
+import pickle
+import textwrap
+
+from nltk.tree import Tree
+import pytest
+
+from rnng.evalb import EvalbError, EvalbParams, EvalbScorer, F1Meter, parse_sentence
+
+
+COLLINS_PRM = textwrap.dedent("""
+##------------------------------------------##
+## Debug mode                               ##
+##   0: No debugging                        ##
+##   1: print data for individual sentence  ##
+##------------------------------------------##
+DEBUG 0
+
+##------------------------------------------##
+## MAX error                                ##
+##    Number of error to stop the process.  ##
+##    This is useful if there could be      ##
+##    tokanization error.                   ##
+##    The process will stop when this number##
+##    of errors are accumulated.            ##
+##------------------------------------------##
+MAX_ERROR 10
+
+##------------------------------------------##
+## Cut-off length for statistics            ##
+##    At the end of evaluation, the         ##
+##    statistics for the senetnces of length##
+##    less than or equal to this number will##
+##    be shown, on top of the statistics    ##
+##    for all the sentences                 ##
+##------------------------------------------##
+CUTOFF_LEN 40
+
+##------------------------------------------##
+## unlabeled or labeled bracketing          ##
+##    0: unlabeled bracketing               ##
+##    1: labeled bracketing                 ##
+##------------------------------------------##
+LABELED 1
+
+##------------------------------------------##
+## Delete labels                            ##
+##    list of labels to be ignored.         ##
+##    If it is a pre-terminal label, delete ##
+##    the word along with the brackets.     ##
+##    If it is a non-terminal label, just   ##
+##    delete the brackets (don't delete     ##
+##    deildrens).                           ##
+##------------------------------------------##
+DELETE_LABEL TOP
+DELETE_LABEL -NONE-
+DELETE_LABEL ,
+DELETE_LABEL :
+DELETE_LABEL ``
+DELETE_LABEL ''
+DELETE_LABEL .
+DELETE_LABEL_FOR_LENGTH -NONE-
+EQ_LABEL ADVP PRT
+""")
+
+
+@pytest.fixture
+def collins_params(tmpdir):
+    path = tmpdir.join('COLLINS.prm')
+    path.write(COLLINS_PRM)
+    return EvalbParams.from_file(str(path))
+
+
+def test_params_from_file(collins_params):
+    assert collins_params.max_error == 10
+    assert collins_params.cutoff_len == 40
+    assert collins_params.labeled
+    assert collins_params.delete_labels == {'TOP', '-NONE-', ',', ':', '``', "''", '.'}
+    assert collins_params.delete_labels_for_length == {'-NONE-'}
+    assert collins_params.equal_labels == {'PRT': 'ADVP'}
+
+
+def test_params_are_immutable_and_picklable(collins_params):
+    with pytest.raises(TypeError):
+        collins_params.equal_labels['NP'] = 'VP'
+    with pytest.raises(TypeError):
+        EvalbParams().equal_labels['NP'] = 'VP'
+
+    assert pickle.loads(pickle.dumps(collins_params)) == collins_params
+
+
+def test_params_from_file_with_comments_and_unknown_parameter(tmpdir):
+    path = tmpdir.join('params.prm')
+    path.write('##----##\n## Comment ##\n\n# CUTOFF_LEN 10\nFOO 1\nCUTOFF_LEN 20\n')
+
+    params = EvalbParams.from_file(str(path))
+
+    assert params.cutoff_len == 20
+    assert params.max_error == 10
+
+
+def test_parse_sentence():
+    tree = Tree.fromstring('(TOP (S (NP-SBJ (NNP John)) (VP (VBZ loves) (NP (NNP Mary)))))')
+
+    sent = parse_sentence(tree, EvalbParams(delete_labels={'TOP'}))
+
+    assert sent.words == 'John loves Mary'.split()
+    assert sent.tags == 'NNP VBZ NNP'.split()
+    assert sorted(sent.brackets.elements()) == [
+        ('NP', 0, 1), ('NP', 2, 3), ('S', 0, 3), ('VP', 1, 3)]
+
+
+def test_parse_sentence_without_preterminals():
+    with pytest.raises(ValueError):
+        parse_sentence(Tree.fromstring('(S John (VP loves Mary))'))
+
+
+def test_score():
+    gold = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ loves) (NP (NNP Mary))) (. .))')
+    test = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ loves)) (NP (NNP Mary)) (. .))')
+    scorer = EvalbScorer()
+
+    scorer.add(gold, gold)
+    scorer.add(gold, test)
+
+    assert scorer.counts['num_sentences'] == 2
+    assert scorer.counts['num_matched'] == 7
+    assert scorer.counts['num_gold'] == 8
+    assert scorer.counts['num_test'] == 8
+    assert scorer.recall == pytest.approx(87.5)
+    assert scorer.precision == pytest.approx(87.5)
+    assert scorer.f1 == pytest.approx(87.5)
+    assert scorer.complete_match == pytest.approx(50.)
+    assert scorer.tagging_accuracy == pytest.approx(100.)
+
+
+def test_score_is_incremental():
+    gold = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ loves) (NP (NNP Mary))))')
+    test = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ loves)) (NP (NNP Mary)))')
+    scorer = EvalbScorer()
+
+    scorer.add(gold, gold)
+    assert scorer.f1 == pytest.approx(100.)
+    scorer.add(gold, test)
+    assert scorer.f1 == pytest.approx(87.5)
+    scorer.reset()
+    assert scorer.f1 == pytest.approx(0.)
+    scorer.add(gold, test)
+    assert scorer.f1 == pytest.approx(75.)
+
+
+def test_score_with_collins_params(collins_params):
+    gold = Tree.fromstring(
+        '(TOP (S (NP-SBJ (NNP John)) (, ,) (VP (VBZ runs) (PRT (RP away))) (. .)))')
+    test = Tree.fromstring(
+        '(TOP (S (NP (NNP John) (, ,)) (VP (VBZ runs) (ADVP (RB away))) (. .)))')
+    scorer = EvalbScorer(collins_params)
+
+    scorer.add(gold, test)
+
+    # S, NP, VP, and ADVP = PRT all match once punctuation is deleted
+    assert scorer.counts['num_matched'] == 4
+    assert scorer.counts['num_gold'] == 4
+    assert scorer.counts['num_test'] == 4
+    assert scorer.counts['num_words'] == 3
+    assert scorer.counts['num_correct_tags'] == 2
+    assert scorer.f1 == pytest.approx(100.)
+
+
+def test_score_unlabeled():
+    gold = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ runs)))')
+    test = Tree.fromstring('(S (VP (NNP John)) (NP (VBZ runs)))')
+
+    labeled = EvalbScorer()
+    labeled.add(gold, test)
+    unlabeled = EvalbScorer(EvalbParams(labeled=False))
+    unlabeled.add(gold, test)
+
+    assert labeled.f1 == pytest.approx(100. / 3)
+    assert unlabeled.f1 == pytest.approx(100.)
+
+
+def test_score_with_cutoff():
+    short = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ runs)))')
+    long = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ runs) (ADVP (RB fast))))')
+    long_test = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ runs)) (ADVP (RB fast)))')
+    scorer = EvalbScorer(EvalbParams(cutoff_len=2))
+
+    scorer.add(short, short)
+    scorer.add(long, long_test)
+
+    assert scorer.counts_cutoff['num_sentences'] == 1
+    assert scorer.f1_cutoff == pytest.approx(100.)
+    assert scorer.f1 < 100.
+
+
+def test_score_crossing():
+    gold = Tree.fromstring('(S (NP (DT the) (NN dog)) (VP (VBZ runs)))')
+    test = Tree.fromstring('(S (DT the) (X (NN dog) (VBZ runs)))')
+    scorer = EvalbScorer()
+
+    scorer.add(gold, test)
+
+    assert scorer.counts['num_crossing'] == 1
+    assert scorer.counts['num_no_crossing'] == 0
+
+
+def test_score_with_mismatched_words():
+    gold = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ runs)))')
+    test = Tree.fromstring('(S (NP (NNP Mary)) (VP (VBZ runs)))')
+    scorer = EvalbScorer(EvalbParams(max_error=1))
+
+    scorer.add(gold, test)
+    assert scorer.counts['num_errors'] == 1
+    assert scorer.counts['num_sentences'] == 0
+    with pytest.raises(EvalbError) as excinfo:
+        scorer.add(gold, test)
+    assert 'too many errors: 2' in str(excinfo.value)
+
+
+def test_add_brackets():
+    scorer = EvalbScorer()
+
+    scorer.add_brackets([('S', 0, 3), ('NP', 0, 1)], {('S', 0, 3), ('VP', 1, 3)})
+
+    assert scorer.counts['num_matched'] == 1
+    assert scorer.recall == pytest.approx(50.)
+    assert scorer.precision == pytest.approx(50.)
+
+
+class TestF1Meter(object):
+    gold = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ loves) (NP (NNP Mary))))')
+    test = Tree.fromstring('(S (NP (NNP John)) (VP (VBZ loves)) (NP (NNP Mary)))')
+
+    def test_value(self):
+        meter = F1Meter()
+        assert meter.value() == pytest.approx(0.)
+        meter.add(self.gold, self.test)
+        assert meter.value() == pytest.approx(75.)
+        meter.reset()
+        assert meter.value() == pytest.approx(0.)
+
+    def test_merge(self):
+        meter = F1Meter()
+        meter.add(self.gold, self.gold)
+        other = pickle.loads(pickle.dumps(F1Meter()))
+        other.add(self.gold, self.test)
+        expected = F1Meter()
+        expected.add(self.gold, self.gold)
+        expected.add(self.gold, self.test)
+
+        meter.merge(other)
+
+        assert meter.counts == expected.counts
+        assert meter.counts_cutoff == expected.counts_cutoff
+        assert meter.value() == pytest.approx(87.5)
+
+    def test_merge_with_different_params(self):
+        with pytest.raises(ValueError) as excinfo:
+            F1Meter().merge(F1Meter(EvalbParams(labeled=False)))
+        assert 'cannot merge scorers with different parameters' in str(excinfo.value)
@@ -65,3 +65,67 @@ class TestActionField(object):
         assert tensor.squeeze().data.tolist() == [
             field.vocab.stoi[NT(field.nonterm_field.unk_token)]
         ]
+
+    def test_numericalize_with_lengths(self):
+        nonterm_field = Field(pad_token=None)
+        field = ActionField(nonterm_field, include_lengths=True)
+        nonterms = 'S NP VP'.split()
+        field.nonterm_field.build_vocab([nonterms])
+        field.build_vocab()
+        arr = [
+            [NT('S'), SHIFT, REDUCE],
+            [NT('NP'), SHIFT],
+        ]
+
+        tensor, lengths = field.numericalize(field.pad(arr), device=-1)
+
+        assert tensor.size() == (3, 2)
+        assert lengths.tolist() == [3, 2]
+        assert tensor[:, 0].data.tolist() == [field.vocab.stoi[a] for a in arr[0]]
+        assert tensor[:2, 1].data.tolist() == [field.vocab.stoi[a] for a in arr[1]]
+
+    def test_numericalize_padded_batch_with_unknown_nt_actions(self):
+        nonterm_field = Field(pad_token=None)
+        field = ActionField(nonterm_field, include_lengths=True, batch_first=True)
+        field.nonterm_field.build_vocab([['S', 'NP']])
+        field.build_vocab()
+        arr = [
+            [NT('S'), NT('PP'), SHIFT, REDUCE],
+            [NT('VP'), SHIFT],
+        ]
+        unk_id = field.vocab.stoi[NT(field.nonterm_field.unk_token)]
+
+        tensor, lengths = field.numericalize(field.pad(arr), device=-1)
+
+        assert tensor.size() == (2, 4)
+        assert lengths.tolist() == [4, 2]
+        assert tensor.data.tolist() == [
+            [field.vocab.stoi[NT('S')], unk_id, DiscRNNG.SHIFT_ID, DiscRNNG.REDUCE_ID],
+            [unk_id, DiscRNNG.SHIFT_ID, unk_id, unk_id],
+        ]
+
+    def test_numericalize_with_postprocessing(self):
+        nonterm_field = Field(pad_token=None)
+        field = ActionField(
+            nonterm_field, postprocessing=lambda arr, _, __: [[x + 1 for x in ex] for ex in arr])
+        field.nonterm_field.build_vocab([['S']])
+        field.build_vocab()
+        arr = [NT('S'), SHIFT, REDUCE]
+
+        tensor = field.numericalize([arr], device=-1)
+
+        assert tensor.squeeze().data.tolist() == [field.vocab.stoi[a] + 1 for a in arr]
+        assert field.use_vocab
+
+    def test_numericalize_after_rebuilding_vocab(self):
+        field = self.make_action_field()
+        field.nonterm_field.build_vocab([['S']])
+        field.build_vocab()
+        field.numericalize([[NT('S')]], device=-1)
+        field.nonterm_field.build_vocab([['NP', 'S']])
+        field.build_vocab()
+
+        tensor = field.numericalize([[NT('NP'), NT('S')]], device=-1)
+
+        assert tensor.view(-1).data.tolist() == [
+            field.vocab.stoi[NT('NP')], field.vocab.stoi[NT('S')]]
@@ -2,8 +2,12 @@ import random
 
 from torch.autograd import Variable
 from torchtext.data import Dataset, Example, Field
+import pytest
 
-from rnng.iterator import SimpleIterator
+from rnng.actions import NT, REDUCE, SHIFT
+from rnng.dataset import ArrayDataset
+from rnng.fields import ActionField
+from rnng.iterator import ArrayIterator, SimpleIterator, StreamingIterator
 
 
 random.seed(12345)
@@ -44,3 +48,116 @@ class TestSimpleIterator(object):
 
         assert isinstance(sample.text, Variable)
         assert sample.text.size(1) == 1
+
+    def test_next_with_batch_size(self):
+        iterator = SimpleIterator(self.dataset, device=-1, batch_size=2)
+        sample = next(iter(iterator))
+
+        assert iterator.batch_size == 2
+        assert sample.text.size() == (3, 2)
+
+
+class TestArrayIterator(object):
+    WORDS = Field(pad_token='<pad>', include_lengths=True)
+    NONTERMS = Field(pad_token=None)
+    ACTIONS = ActionField(NONTERMS)
+    fields = [('words', WORDS), ('nonterms', NONTERMS), ('actions', ACTIONS)]
+    examples = [
+        Example.fromlist([
+            'John loves Mary'.split(), ['S'], [NT('S'), SHIFT, SHIFT, SHIFT, REDUCE]
+        ], fields),
+        Example.fromlist([
+            'Mary cries'.split(), ['S', 'NP'], [NT('S'), NT('NP'), SHIFT, REDUCE, SHIFT, REDUCE]
+        ], fields),
+        # Unknown word and nonterminal
+        Example.fromlist(['Bob'.split(), ['X'], [NT('X'), SHIFT, REDUCE]], fields),
+    ]
+    dataset = Dataset(examples[:2], fields)
+    WORDS.build_vocab(dataset)
+    NONTERMS.build_vocab(dataset)
+    ACTIONS.build_vocab()
+    array_dataset = ArrayDataset.from_examples(examples, [name for name, _ in fields])
+
+    def test_init(self):
+        iterator = ArrayIterator(self.array_dataset, self.fields, batch_size=2, device=-1)
+        assert iterator.dataset is self.array_dataset
+        assert iterator.batch_size == 2
+        assert iterator.train
+        assert iterator.device == -1
+        assert len(iterator) == 2
+
+    def test_init_with_unknown_attribute(self):
+        with pytest.raises(ValueError) as excinfo:
+            ArrayIterator(self.array_dataset, [('foo', self.WORDS)])
+        assert 'dataset has no attribute named foo' in str(excinfo.value)
+
+    def test_next_matches_simple_iterator(self):
+        iterator = ArrayIterator(self.array_dataset, self.fields, batch_size=3, train=False,
+                                 device=-1)
+        expected = next(iter(SimpleIterator(
+            Dataset(self.examples, self.fields), batch_size=3, train=False, device=-1)))
+
+        sample = next(iter(iterator))
+
+        assert sample.batch_size == 3
+        words, lengths = sample.words
+        expected_words, expected_lengths = expected.words
+        assert isinstance(words, Variable)
+        assert words.data.tolist() == expected_words.data.tolist()
+        assert lengths.tolist() == expected_lengths.tolist()
+        assert sample.actions.data.tolist() == expected.actions.data.tolist()
+        assert sample.nonterms.data.tolist() == expected.nonterms.data.tolist()
+
+    def test_iter_covers_dataset(self):
+        iterator = ArrayIterator(self.array_dataset, self.fields, batch_size=2, device=-1)
+
+        samples = list(iterator)
+
+        assert [s.batch_size for s in samples] == [2, 1]
+        lengths = sorted(x for s in samples for x in s.words[1].tolist())
+        assert lengths == [1, 2, 3]
+
+
+class TestStreamingIterator(object):
+    TEXT = Field(include_lengths=True)
+    fields = [('text', TEXT)]
+    examples = [
+        Example.fromlist(['John loves Mary'], fields),
+        Example.fromlist(['Mary cries'], fields),
+        Example.fromlist(['John runs'], fields),
+    ]
+    TEXT.build_vocab(Dataset(examples, fields))
+
+    def make_examples(self):
+        yield from self.examples
+
+    def test_init(self):
+        iterator = StreamingIterator(self.make_examples, self.fields, batch_size=2, device=-1)
+        assert iterator.batch_size == 2
+        assert iterator.train
+        assert iterator.device == -1
+        assert iterator.buffer_size == 10000
+        with pytest.raises(TypeError):
+            len(iterator)
+
+    def test_next_matches_simple_iterator(self):
+        iterator = StreamingIterator(
+            self.make_examples, self.fields, batch_size=2, train=False, device=-1)
+        expected = next(iter(SimpleIterator(
+            Dataset(self.examples, self.fields), batch_size=2, train=False, device=-1)))
+
+        samples = list(iterator)
+
+        assert len(samples) == len(iterator) == 2
+        assert samples[0].text[0].data.tolist() == expected.text[0].data.tolist()
+        assert samples[0].text[1].tolist() == expected.text[1].tolist()
+        assert samples[1].batch_size == 1
+
+    def test_iter_shuffles_when_training(self):
+        iterator = StreamingIterator(
+            self.make_examples, self.fields, batch_size=1, device=-1, buffer_size=2)
+
+        lengths = sorted(s.text[1].tolist()[0] for s in iterator)
+
+        assert lengths == [2, 2, 3]
+        assert len(iterator) == 3
@@ -1,11 +1,13 @@
 from nltk.tree import Tree
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence
 import pytest
 import torch
 import torch.nn as nn
 
 from rnng.actions import NT, REDUCE, SHIFT, get_nonterm
-from rnng.models import DiscRNNG, EmptyStackError, StackLSTM, log_softmax
+from rnng.models import BatchedStackLSTM, DiscRNNG, EmptyStackError, FusedLSTM, Hypothesis, \
+    PrecomputedStackLSTM, PreallocatedStackLSTM, StackLSTM, log_softmax
 
 
 torch.manual_seed(12345)
@@ -34,6 +36,61 @@ class MockLSTM(object):
                 Variable(torch.randn(self.num_layers, 1, self.hidden_size)))
 
 
+class TestFusedLSTM(object):
+    input_size = 6
+    hidden_size = 5
+    num_layers = 3
+
+    def assert_equal(self, x, y):
+        assert x.data.view(-1).tolist() == pytest.approx(y.data.view(-1).tolist(), abs=1e-6)
+
+    def test_init(self):
+        lstm = FusedLSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        assert lstm.weight_l0.size() == (4 * self.hidden_size, self.input_size + self.hidden_size)
+        assert lstm.weight_l2.size() == (4 * self.hidden_size, 2 * self.hidden_size)
+        assert lstm.bias_l2.size() == (4 * self.hidden_size,)
+
+    def test_init_with_nonpositive_input_size(self):
+        with pytest.raises(ValueError) as excinfo:
+            FusedLSTM(0, self.hidden_size)
+        assert 'nonpositive input size: 0' in str(excinfo.value)
+
+    @pytest.mark.parametrize('use_jit', [False, True])
+    def test_call_matches_lstm(self, use_jit):
+        lstm = nn.LSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        fused = FusedLSTM.from_lstm(lstm, use_jit=use_jit)
+        inputs = Variable(torch.randn(4, 3, self.input_size))
+        states = (Variable(torch.randn(self.num_layers, 3, self.hidden_size)),
+                  Variable(torch.randn(self.num_layers, 3, self.hidden_size)))
+
+        outputs, (h_n, c_n) = fused(inputs, states)
+        expected_outputs, (expected_h_n, expected_c_n) = lstm(inputs, states)
+
+        assert outputs.size() == (4, 3, self.hidden_size)
+        self.assert_equal(outputs, expected_outputs)
+        self.assert_equal(h_n, expected_h_n)
+        self.assert_equal(c_n, expected_c_n)
+
+    def test_call_with_packed_sequence(self):
+        lstm = nn.LSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        fused = FusedLSTM.from_lstm(lstm)
+        inputs = pack_padded_sequence(Variable(torch.randn(4, 3, self.input_size)), [4, 2, 1])
+
+        outputs, (h_n, c_n) = fused(inputs)
+        expected_outputs, (expected_h_n, expected_c_n) = lstm(inputs)
+
+        self.assert_equal(outputs.data, expected_outputs.data)
+        self.assert_equal(h_n, expected_h_n)
+        self.assert_equal(c_n, expected_c_n)
+
+    def test_stack_lstm(self):
+        lstm = StackLSTM(self.input_size, self.hidden_size, lstm_class=FusedLSTM)
+        inputs = Variable(torch.randn(2, self.input_size))
+        node = lstm.push_nodes([lstm.root_node()], inputs[:1], [None])[0]
+        lstm.push_nodes([node], inputs[1:], [None])[0].output.sum().backward()
+        assert lstm.lstm.weight_l0.grad is not None
+
+
 class TestStackLSTM(object):
     input_size = 10
     hidden_size = 5
@@ -170,6 +227,434 @@ class TestStackLSTM(object):
         with pytest.raises(EmptyStackError):
             lstm.pop()
 
+    def test_push_and_pop_beyond_initial_capacity(self):
+        inputs = Variable(torch.randn(40, self.input_size), requires_grad=True)
+        lstm = self.make_stack_lstm()
+        nodes = [lstm.root_node()]
+        for i in range(len(inputs)):
+            lstm.push(inputs[i])
+            nodes.append(lstm.push_nodes(nodes[-1:], inputs[i:i + 1], [None])[0])
+            if i % 3 == 2:
+                lstm.pop()
+                nodes.pop()
+            assert len(lstm) == nodes[-1].size
+            assert lstm.top.data.tolist() == pytest.approx(
+                nodes[-1].output.data.tolist(), abs=1e-6)
+
+        lstm.top.sum().backward()
+
+        assert inputs.grad is not None
+        assert lstm.h0.grad is not None
+
+    def test_push_sequence(self):
+        inputs = Variable(torch.randn(self.seq_len, self.input_size))
+        lstm = self.make_stack_lstm()
+        root = lstm.root_node()
+
+        nodes = lstm.push_sequence(root, inputs, list('abc'))
+
+        node = root
+        for i, expected in enumerate(nodes):
+            node = lstm.push_nodes([node], inputs[i:i + 1], [None])[0]
+            assert expected.value == 'abc'[i]
+            assert expected.size == i + 1
+            assert expected.parent is (root if i == 0 else nodes[i - 1])
+            assert expected.output.data.tolist() == pytest.approx(
+                node.output.data.tolist(), abs=1e-6)
+        assert nodes[-1].states[1].data.view(-1).tolist() == pytest.approx(
+            node.states[1].data.view(-1).tolist(), abs=1e-6)
+        assert all(node.states is None for node in nodes[:-1])
+
+    def test_push_onto_node_without_states(self):
+        inputs = Variable(torch.randn(2, self.input_size))
+        lstm = self.make_stack_lstm()
+        nodes = lstm.push_sequence(lstm.root_node(), inputs, [None, None])
+
+        with pytest.raises(ValueError) as excinfo:
+            lstm.push_nodes(nodes[:1], inputs[:1], [None])
+        assert 'cannot push onto a node without states' in str(excinfo.value)
+        with pytest.raises(ValueError) as excinfo:
+            lstm.push_sequence(nodes[0], inputs, [None, None])
+        assert 'cannot push onto a node without states' in str(excinfo.value)
+
+    def test_push_tree(self):
+        parents = [-1, 0, 1, 0, -1, 3]
+        inputs = Variable(torch.randn(len(parents), self.input_size))
+        lstm = self.make_stack_lstm()
+
+        outputs = lstm.push_tree(parents, inputs)
+
+        assert outputs.size() == (len(parents), self.hidden_size)
+        nodes = []
+        for i, p in enumerate(parents):
+            parent = lstm.root_node() if p < 0 else nodes[p]
+            nodes.append(lstm.push_nodes([parent], inputs[i:i + 1], [None])[0])
+            assert outputs[i].data.tolist() == pytest.approx(
+                nodes[-1].output.data.tolist(), abs=1e-6)
+
+    def test_push_tree_with_parent_after_child(self):
+        lstm = self.make_stack_lstm()
+        with pytest.raises(ValueError) as excinfo:
+            lstm.push_tree([-1, 2, 0], Variable(torch.randn(3, self.input_size)))
+        assert 'parents must come before their children' in str(excinfo.value)
+
+
+class TestPreallocatedStackLSTM(TestStackLSTM):
+    # All the tests of StackLSTM apply unchanged
+    def make_stack_lstm(self, lstm_class=None):
+        return PreallocatedStackLSTM(
+            self.input_size, self.hidden_size, num_layers=self.num_layers,
+            lstm_class=lstm_class
+        )
+
+    @pytest.mark.parametrize('training', [True, False])
+    def test_push_and_pop_equal_stack_lstm(self, training):
+        inputs = Variable(torch.randn(40, self.input_size), requires_grad=True)
+        reference = super().make_stack_lstm()
+        lstm = self.make_stack_lstm()
+        lstm.load_state_dict(reference.state_dict())
+        reference.train(training)
+        lstm.train(training)
+
+        for i in range(len(inputs)):
+            h, c = lstm.push(inputs[i])
+            expected_h, expected_c = reference.push(inputs[i])
+            assert h.data.view(-1).tolist() == pytest.approx(
+                expected_h.data.view(-1).tolist(), abs=1e-6)
+            assert c.data.view(-1).tolist() == pytest.approx(
+                expected_c.data.view(-1).tolist(), abs=1e-6)
+            if i % 3 == 2:
+                h, _ = lstm.pop()
+                expected_h, _ = reference.pop()
+                assert h.data.view(-1).tolist() == pytest.approx(
+                    expected_h.data.view(-1).tolist(), abs=1e-6)
+            assert len(lstm) == len(reference)
+            assert lstm.top.data.tolist() == pytest.approx(
+                reference.top.data.tolist(), abs=1e-6)
+
+        lstm.top.sum().backward()
+        grad = inputs.grad.data.clone()
+        inputs.grad.data.zero_()
+        reference.top.sum().backward()
+        assert grad.view(-1).tolist() == pytest.approx(
+            inputs.grad.data.view(-1).tolist(), abs=1e-6)
+
+    def test_popped_states_are_not_overwritten(self):
+        lstm = self.make_stack_lstm()
+        inputs = Variable(torch.randn(2, self.input_size))
+        lstm.push(inputs[0])
+
+        h, c = lstm.pop()
+        expected = h.data.clone()
+        lstm.push(inputs[1])
+
+        assert torch.equal(h.data, expected)
+
+
+class TestBatchedStackLSTM(object):
+    input_size = 10
+    hidden_size = 5
+    num_layers = 3
+    batch_size = 3
+
+    def make_stack_lstm(self):
+        lstm = BatchedStackLSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        lstm.reset(self.batch_size)
+        return lstm
+
+    def make_single_stack_lstms(self, batched):
+        lstms = []
+        for _ in range(batched.batch_size):
+            lstm = StackLSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+            lstm.load_state_dict(batched.state_dict())
+            lstms.append(lstm)
+        return lstms
+
+    def assert_tops_equal(self, batched, lstms):
+        for i, lstm in enumerate(lstms):
+            if lstm.top is None:
+                assert batched.top[i].data.abs().sum() == pytest.approx(0, abs=1e-7)
+            else:
+                assert batched.top[i].data.tolist() == pytest.approx(
+                    lstm.top.data.tolist(), abs=1e-6)
+
+    def test_init(self):
+        lstm = BatchedStackLSTM(
+            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=0.5)
+        assert lstm.input_size == self.input_size
+        assert lstm.hidden_size == self.hidden_size
+        assert lstm.num_layers == self.num_layers
+        assert lstm.dropout == pytest.approx(0.5)
+        assert isinstance(lstm.lstm, nn.LSTM)
+        assert lstm.h0.size() == (lstm.num_layers, 1, lstm.hidden_size)
+        assert lstm.c0.size() == (lstm.num_layers, 1, lstm.hidden_size)
+        assert lstm.batch_size == 0
+        assert lstm.top is None
+
+    def test_init_with_nonpositive_input_size(self):
+        with pytest.raises(ValueError) as excinfo:
+            BatchedStackLSTM(0, self.hidden_size)
+        assert 'nonpositive input size: 0' in str(excinfo.value)
+
+    def test_from_stack_lstm(self):
+        stack_lstm = StackLSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        rng_state = torch.get_rng_state()
+        lstm = BatchedStackLSTM.from_stack_lstm(stack_lstm)
+        assert lstm.lstm is stack_lstm.lstm
+        assert lstm.h0 is stack_lstm.h0
+        assert lstm.c0 is stack_lstm.c0
+        assert lstm.batch_size == 0
+        # No LSTM of its own is made and initialized
+        assert torch.equal(torch.get_rng_state(), rng_state)
+        assert {id(p) for p in lstm.parameters()} == {id(p) for p in stack_lstm.parameters()}
+
+    def test_reset(self):
+        lstm = self.make_stack_lstm()
+        assert lstm.batch_size == self.batch_size
+        assert lstm.lengths == [0] * self.batch_size
+        assert lstm.top.size() == (self.batch_size, self.hidden_size)
+
+    def test_reset_with_nonpositive_batch_size(self):
+        lstm = self.make_stack_lstm()
+        with pytest.raises(ValueError) as excinfo:
+            lstm.reset(0)
+        assert 'nonpositive batch size: 0' in str(excinfo.value)
+
+    def test_call_without_reset(self):
+        lstm = BatchedStackLSTM(self.input_size, self.hidden_size)
+        with pytest.raises(RuntimeError):
+            lstm(Variable(torch.randn(1, self.input_size)), [BatchedStackLSTM.PUSH])
+
+    def test_call_matches_single_stack_lstms(self):
+        push, pop, noop = BatchedStackLSTM.PUSH, BatchedStackLSTM.POP, BatchedStackLSTM.NOOP
+        steps = [
+            [push, push, push],
+            [push, noop, push],
+            [pop, push, push],
+            [push, pop, noop],
+            [noop, push, -3],
+            [push, push, push],
+        ]
+        lstm = self.make_stack_lstm()
+        single_lstms = self.make_single_stack_lstms(lstm)
+
+        for ops in steps:
+            inputs = Variable(torch.randn(self.batch_size, self.input_size))
+            top = lstm(inputs, ops)
+            for i, op in enumerate(ops):
+                if op == push:
+                    single_lstms[i].push(inputs[i])
+                for _ in range(-op):
+                    single_lstms[i].pop()
+            assert top.size() == (self.batch_size, self.hidden_size)
+            assert lstm.lengths == [len(x) for x in single_lstms]
+            self.assert_tops_equal(lstm, single_lstms)
+
+    def test_call_with_invalid_size(self):
+        lstm = self.make_stack_lstm()
+        with pytest.raises(ValueError) as excinfo:
+            lstm(Variable(torch.randn(2, 10)), [BatchedStackLSTM.PUSH] * 2)
+        assert f'expected input to have size ({self.batch_size}, {self.input_size}), ' \
+            'got (2, 10)' in str(excinfo.value)
+
+    def test_call_with_wrong_number_of_ops(self):
+        lstm = self.make_stack_lstm()
+        with pytest.raises(ValueError) as excinfo:
+            lstm(Variable(torch.randn(self.batch_size, self.input_size)), [1])
+        assert f'expected {self.batch_size} operations, got 1' in str(excinfo.value)
+
+    def test_pop(self):
+        lstm = self.make_stack_lstm()
+        single_lstms = self.make_single_stack_lstms(lstm)
+        for _ in range(3):
+            inputs = Variable(torch.randn(self.batch_size, self.input_size))
+            lstm(inputs, [BatchedStackLSTM.PUSH] * self.batch_size)
+            for i, single_lstm in enumerate(single_lstms):
+                single_lstm.push(inputs[i])
+
+        lstm.pop([0, 1, 3])
+        single_lstms[1].pop()
+        for _ in range(3):
+            single_lstms[2].pop()
+
+        assert lstm.lengths == [3, 2, 0]
+        self.assert_tops_equal(lstm, single_lstms)
+
+    def test_pop_when_empty(self):
+        lstm = self.make_stack_lstm()
+        with pytest.raises(EmptyStackError):
+            lstm.pop([0, 1, 0])
+        assert lstm.lengths == [0] * self.batch_size
+
+    def test_select(self):
+        lstm = self.make_stack_lstm()
+        single_lstms = self.make_single_stack_lstms(lstm)
+        for ops in [[1, 1, 1], [1, 0, 1], [1, 0, 0]]:
+            inputs = Variable(torch.randn(self.batch_size, self.input_size))
+            lstm(inputs, ops)
+            for i, op in enumerate(ops):
+                if op == BatchedStackLSTM.PUSH:
+                    single_lstms[i].push(inputs[i])
+
+        lstm.select([2, 0])
+        single_lstms = [single_lstms[2], single_lstms[0]]
+
+        assert lstm.batch_size == 2
+        assert lstm.lengths == [2, 3]
+        self.assert_tops_equal(lstm, single_lstms)
+        inputs = Variable(torch.randn(2, self.input_size))
+        lstm(inputs, [BatchedStackLSTM.PUSH, BatchedStackLSTM.POP])
+        single_lstms[0].push(inputs[0])
+        single_lstms[1].pop()
+        self.assert_tops_equal(lstm, single_lstms)
+
+    def test_select_nothing(self):
+        lstm = self.make_stack_lstm()
+        with pytest.raises(ValueError) as excinfo:
+            lstm.select([])
+        assert 'cannot select an empty set of stacks' in str(excinfo.value)
+
+    def test_backward(self):
+        lstm = self.make_stack_lstm()
+        inputs = Variable(torch.randn(self.batch_size, self.input_size), requires_grad=True)
+        lstm(inputs, [BatchedStackLSTM.PUSH] * self.batch_size)
+        lstm(inputs, [BatchedStackLSTM.PUSH, BatchedStackLSTM.NOOP, BatchedStackLSTM.POP])
+
+        lstm.top.sum().backward()
+
+        assert inputs.grad is not None
+        assert lstm.h0.grad is not None
+
+
+class TestPrecomputedStackLSTM(object):
+    input_size = 10
+    hidden_size = 5
+    num_layers = 3
+    seq_len = 4
+    lengths = [4, 0, 2]
+
+    def make_stack_lstms(self):
+        # A precomputed stack LSTM and a batched one where the same inputs are pushed
+        batched = BatchedStackLSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        batched.reset(len(self.lengths))
+        lstm = PrecomputedStackLSTM.from_stack_lstm(batched)
+        inputs = Variable(torch.randn(self.seq_len, len(self.lengths), self.input_size))
+        lstm.reset(inputs, self.lengths)
+        for j in range(self.seq_len):
+            ops = [BatchedStackLSTM.PUSH if j < n else BatchedStackLSTM.NOOP
+                   for n in self.lengths]
+            batched.push(inputs[j], ops)
+        return lstm, batched, inputs
+
+    def assert_tops_equal(self, lstm, batched):
+        assert lstm.lengths == batched.lengths
+        assert lstm.top.data.view(-1).tolist() == pytest.approx(
+            batched.top.data.view(-1).tolist(), abs=1e-6)
+
+    def test_init(self):
+        lstm = PrecomputedStackLSTM(
+            self.input_size, self.hidden_size, num_layers=self.num_layers, dropout=0.5)
+        assert lstm.input_size == self.input_size
+        assert lstm.hidden_size == self.hidden_size
+        assert lstm.num_layers == self.num_layers
+        assert lstm.dropout == pytest.approx(0.5)
+        assert lstm.batch_size == 0
+        assert lstm.top is None
+
+    def test_from_stack_lstm(self):
+        stack_lstm = StackLSTM(self.input_size, self.hidden_size, num_layers=self.num_layers)
+        rng_state = torch.get_rng_state()
+        lstm = PrecomputedStackLSTM.from_stack_lstm(stack_lstm)
+        assert lstm.lstm is stack_lstm.lstm
+        assert lstm.h0 is stack_lstm.h0
+        assert lstm.c0 is stack_lstm.c0
+        assert lstm.num_layers == self.num_layers
+        # No LSTM of its own is made and initialized
+        assert torch.equal(torch.get_rng_state(), rng_state)
+        assert {id(p) for p in lstm.parameters()} == {id(p) for p in stack_lstm.parameters()}
+
+    def test_reset_matches_batched_stack_lstm(self):
+        lstm, batched, _ = self.make_stack_lstms()
+        self.assert_tops_equal(lstm, batched)
+
+    def test_reset_with_invalid_lengths(self):
+        lstm = PrecomputedStackLSTM(self.input_size, self.hidden_size)
+        inputs = Variable(torch.randn(self.seq_len, 2, self.input_size))
+        with pytest.raises(ValueError) as excinfo:
+            lstm.reset(inputs, [1])
+        assert 'expected 2 lengths, got 1' in str(excinfo.value)
+        with pytest.raises(ValueError) as excinfo:
+            lstm.reset(inputs, [1, self.seq_len + 1])
+        assert f'lengths must be between 0 and {self.seq_len}' in str(excinfo.value)
+
+    def test_pop(self):
+        lstm, batched, _ = self.make_stack_lstms()
+        for num_pops in [[1, 0, 2], [0, 0, 0], [3, 0, 0]]:
+            lstm.pop(num_pops)
+            batched.pop(num_pops)
+            self.assert_tops_equal(lstm, batched)
+
+    def test_push(self):
+        lstm, batched, inputs = self.make_stack_lstms()
+        lstm.pop([2, 0, 0])
+        batched.pop([2, 0, 0])
+
+        lstm.push([1, 0, 1])
+        batched.push(inputs[2], [1, 0, 1])
+
+        self.assert_tops_equal(lstm, batched)
+
+    def test_get_tops(self):
+        lstm, batched, _ = self.make_stack_lstms()
+        expected = batched.top
+
+        batched.pop([1, 0, 2])
+        tops = lstm.get_tops([3, 4, 0, 2], [0, 0, 1, 2])
+
+        assert lstm.lengths == self.lengths
+        assert tops[1].data.tolist() == pytest.approx(expected[0].data.tolist(), abs=1e-6)
+        assert tops[3].data.tolist() == pytest.approx(expected[2].data.tolist(), abs=1e-6)
+        assert tops[0].data.tolist() == pytest.approx(batched.top[0].data.tolist(), abs=1e-6)
+        assert tops[2].data.abs().sum() == pytest.approx(0, abs=1e-7)
+
+    def test_push_past_the_end(self):
+        lstm, _, _ = self.make_stack_lstms()
+        with pytest.raises(ValueError) as excinfo:
+            lstm.push([0, 1, 3])
+        assert 'cannot push past the end of the inputs' in str(excinfo.value)
+        assert lstm.lengths == self.lengths
+
+    def test_pop_when_empty(self):
+        lstm, _, _ = self.make_stack_lstms()
+        with pytest.raises(EmptyStackError):
+            lstm.pop([0, 1, 0])
+        assert lstm.lengths == self.lengths
+
+    def test_select(self):
+        lstm, batched, _ = self.make_stack_lstms()
+        lstm.pop([1, 0, 1])
+        batched.pop([1, 0, 1])
+
+        lstm.select([2, 0])
+        batched.select([2, 0])
+
+        assert lstm.batch_size == 2
+        self.assert_tops_equal(lstm, batched)
+        lstm.pop([1, 2])
+        batched.pop([1, 2])
+        self.assert_tops_equal(lstm, batched)
+
+    def test_backward(self):
+        lstm = PrecomputedStackLSTM(self.input_size, self.hidden_size)
+        inputs = Variable(torch.randn(self.seq_len, 2, self.input_size), requires_grad=True)
+        lstm.reset(inputs, [self.seq_len, 1])
+        lstm.pop([1, 0])
+
+        lstm.top.sum().backward()
+
+        assert inputs.grad is not None
+        assert lstm.h0.grad is not None
+
 
 def test_log_softmax_without_restrictions():
     inputs = Variable(torch.randn(2, 5))
@@ -387,6 +872,22 @@ class TestDiscRNNG(object):
         llh.backward()
         assert parser.finished
 
+    def test_forward_equals_pushing_the_history_step_by_step(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        actions = self.make_actions()
+        parser = self.make_parser()
+
+        llh = parser(words, pos_tags, actions)
+
+        state = parser._start_state(words, pos_tags)
+        expected = 0.
+        for action_id in actions.data.tolist():
+            expected += parser._score_states([state]).data[0].tolist()[action_id]
+            state = parser._apply_actions([state], [action_id])[0]
+        assert llh.data.tolist()[0] == pytest.approx(expected, abs=1e-5)
+        assert parser._state.action_ids == state.action_ids
+
     def test_forward_with_shift_when_buffer_is_empty(self):
         words = self.make_words()
         pos_tags = self.make_pos_tags()
@@ -439,13 +940,13 @@ class TestDiscRNNG(object):
         assert llh.exp().data[0] == pytest.approx(0, abs=1e-7)
 
     def test_forward_with_bad_dimensions(self):
-        words = Variable(torch.randn(2, 3)).long()
+        words = Variable(torch.randn(2, 3, 4)).long()
         pos_tags = Variable(torch.randn(3)).long()
         actions = Variable(torch.randn(5)).long()
         parser = self.make_parser()
         with pytest.raises(ValueError) as excinfo:
             parser(words, pos_tags, actions)
-        assert 'expected words to have dimension of 1, got 2' in str(excinfo.value)
+        assert 'expected words to have dimension of 1 or 2, got 3' in str(excinfo.value)
 
         words = Variable(torch.randn(3)).long()
         pos_tags = Variable(torch.randn(2, 3)).long()
@@ -460,6 +961,295 @@ class TestDiscRNNG(object):
             parser(words, pos_tags, actions)
         assert 'expected actions to have dimension of 1, got 2' in str(excinfo.value)
 
+        words = Variable(torch.randn(3, 2)).long()
+        pos_tags = Variable(torch.randn(3, 2)).long()
+        actions = Variable(torch.randn(5, 3)).long()
+        with pytest.raises(ValueError) as excinfo:
+            parser(words, pos_tags, actions)
+        assert 'expected actions to have batch size equal to words' in str(excinfo.value)
+
+    def make_batch(self, sentences):
+        # sentences: list of (words, POS tags, actions) triples
+        batch_size = len(sentences)
+        max_len = max(len(x[0]) for x in sentences)
+        max_action_len = max(len(x[2]) for x in sentences)
+        words = torch.LongTensor(max_len, batch_size).zero_()
+        pos_tags = torch.LongTensor(max_len, batch_size).zero_()
+        actions = torch.LongTensor(max_action_len, batch_size).zero_()
+        for i, (ws, ps, acts) in enumerate(sentences):
+            words[:len(ws), i] = self.make_words(ws).data
+            pos_tags[:len(ps), i] = self.make_pos_tags(ps).data
+            actions[:len(acts), i] = self.make_actions(acts).data
+        word_lengths = [len(x[0]) for x in sentences]
+        action_lengths = [len(x[2]) for x in sentences]
+        return Variable(words), Variable(pos_tags), Variable(actions), word_lengths, \
+            action_lengths
+
+    def make_sentences(self):
+        return [
+            ('John loves Mary'.split(), 'NNP VBZ NNP'.split(), [
+                NT('S'), NT('NP'), SHIFT, REDUCE, NT('VP'), SHIFT, NT('NP'), SHIFT, REDUCE,
+                REDUCE, REDUCE,
+            ]),
+            ('John'.split(), 'NNP'.split(), [NT('S'), NT('NP'), SHIFT, REDUCE, REDUCE]),
+            ('Mary loves'.split(), 'NNP VBZ'.split(), [
+                NT('S'), NT('NP'), SHIFT, REDUCE, NT('VP'), SHIFT, REDUCE, REDUCE,
+            ]),
+        ]
+
+    def test_compose_batch(self):
+        parser = self.make_parser()
+        parser.eval()
+        table = Variable(torch.randn(6, parser.input_size))
+        open_nts = [0, 1, 2]
+        children = [[3], [5, 4, 3], [4, 5]]
+
+        composed = parser._compose_batch(table, open_nts, children)
+
+        assert composed.size() == (len(open_nts), parser.input_size)
+        for k in range(len(open_nts)):
+            expected = parser._compose_batch(table, open_nts[k:k + 1], children[k:k + 1])
+            assert composed[k].data.tolist() == pytest.approx(
+                expected[0].data.tolist(), abs=1e-6)
+        # The backward composer reads the children in reverse
+        fwd_input = torch.stack([table[1], table[5], table[4], table[3]]).unsqueeze(1)
+        bwd_input = torch.stack([table[1], table[3], table[4], table[5]]).unsqueeze(1)
+        fwd_output, _ = parser.fwd_composer(fwd_input)
+        bwd_output, _ = parser.bwd_composer(bwd_input)
+        expected = parser.fwdbwd2composed(
+            torch.cat([fwd_output[-1, 0], bwd_output[-1, 0]]).view(1, -1))
+        assert composed[1].data.tolist() == pytest.approx(
+            expected.view(-1).data.tolist(), abs=1e-6)
+
+    def test_legal_action_masks(self):
+        parser = self.make_parser()
+
+        masks = parser._get_legal_action_masks()
+
+        assert masks.size() == (8, parser.num_actions)
+        assert parser._get_legal_action_masks() is masks
+        for can_reduce in (False, True):
+            for can_shift in (False, True):
+                for can_push_nt in (False, True):
+                    row = masks[4 * can_reduce + 2 * can_shift + can_push_nt].tolist()
+                    expected = [can_reduce, can_shift] + [can_push_nt] * self.num_nt
+                    assert row == [0. if legal else -float('inf') for legal in expected]
+        parser.double()
+        assert parser._get_legal_action_masks() is not masks
+
+    def test_get_best_actions(self):
+        parser = self.make_parser()
+        # Every combination with at least one legal action
+        legal_actions = [(bool(i & 4), bool(i & 2), bool(i & 1)) for i in range(1, 8)]
+        concatenated = Variable(torch.randn(len(legal_actions), 3 * parser.hidden_size))
+
+        best_actions = parser._get_best_actions(concatenated, legal_actions)
+
+        log_probs = parser._score_actions(concatenated, legal_actions).data
+        masks = parser._get_legal_action_masks()
+        assert best_actions == torch.max(log_probs, dim=1)[1].view(-1).tolist()
+        for i, (action_id, legal) in enumerate(zip(best_actions, legal_actions)):
+            assert masks[4 * legal[0] + 2 * legal[1] + legal[2], action_id] == 0.
+            assert log_probs[i, action_id] > -float('inf')
+
+    def test_get_best_actions_with_forced_actions(self):
+        parser = self.make_parser()
+        legal_actions = [(False, True, False), (True, False, False), (False, True, False)]
+        concatenated = Variable(torch.randn(len(legal_actions), 3 * parser.hidden_size))
+
+        assert parser._get_best_actions(concatenated, legal_actions) == [
+            parser.SHIFT_ID, parser.REDUCE_ID, parser.SHIFT_ID]
+        assert parser._get_best_actions(concatenated[1:], legal_actions[1:]) == [
+            parser.REDUCE_ID, parser.SHIFT_ID]
+
+    def test_get_best_actions_with_many_runs_of_legal_actions(self):
+        parser = self.make_parser()
+        # More runs of equal legal actions than there are masks
+        legal_actions = [(False, True, False), (True, False, False)] * 5
+        concatenated = Variable(torch.randn(len(legal_actions), 3 * parser.hidden_size))
+
+        assert parser._get_best_actions(concatenated, legal_actions) == [
+            parser.SHIFT_ID, parser.REDUCE_ID] * 5
+
+    def test_get_top_candidates(self):
+        parser = self.make_parser()
+        hyps = [Hypothesis(None, -1.), Hypothesis(None, -2.)]
+        scores = torch.randn(len(hyps), parser.num_actions).double()
+
+        candidates = parser._get_top_candidates(hyps, scores, 5)
+
+        assert len(candidates) == 5
+        cand_scores = [score for score, _, _ in candidates]
+        assert cand_scores == sorted(cand_scores, reverse=True)
+        assert cand_scores[0] == scores.max()
+        for score, hyp, action_id in candidates:
+            assert score == scores[hyps.index(hyp), action_id]
+
+    def test_get_top_candidates_with_fewer_legal_actions_than_k(self):
+        parser = self.make_parser()
+        hyps = [Hypothesis(None, -1.), Hypothesis(None, -2.)]
+        scores = torch.randn(len(hyps), parser.num_actions).double()
+        scores[0, 1:] = -float('inf')
+        scores[1, :parser.num_actions - 2] = -float('inf')
+
+        candidates = parser._get_top_candidates(hyps, scores, 2 * parser.num_actions)
+
+        assert len(candidates) == 3
+        assert all(score > -float('inf') for score, _, _ in candidates)
+        assert sorted((hyps.index(hyp), action_id) for _, hyp, action_id in candidates) == [
+            (0, 0), (1, parser.num_actions - 2), (1, parser.num_actions - 1)]
+
+    def test_projections_are_cached_when_evaluating(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+        parser.eval()
+
+        parser.decode(words, pos_tags)
+        nt_emb, action_emb = parser._batch_nt_emb, parser._batch_action_emb
+        parser.decode(words, pos_tags)
+
+        assert parser._batch_nt_emb is nt_emb
+        assert parser._batch_action_emb is action_emb
+        optimizer = torch.optim.SGD(parser.parameters(), lr=1.)
+        parser.train()
+        parser(words, pos_tags, self.make_actions()).backward()
+        optimizer.step()
+        parser.eval()
+        parser.decode(words, pos_tags)
+        assert parser._batch_nt_emb is not nt_emb
+        assert not torch.equal(parser._batch_nt_emb.data, nt_emb.data)
+
+    def test_projections_are_recomputed_after_clearing_the_cache(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+        optimizer = torch.optim.SGD(parser.parameters(), lr=1.)
+        parser(words, pos_tags, self.make_actions()).backward()
+        parser.eval()
+
+        parser.decode(words, pos_tags)
+        nt_emb = parser._batch_nt_emb
+        optimizer.step()
+        parser.clear_projection_cache()
+        parser.decode(words, pos_tags)
+
+        assert parser._batch_nt_emb is not nt_emb
+        assert not torch.equal(parser._batch_nt_emb.data, nt_emb.data)
+
+    def test_projections_are_kept_when_mode_is_unchanged(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+        parser.eval()
+
+        parser.decode(words, pos_tags)
+        nt_emb = parser._batch_nt_emb
+        parser.eval()
+        parser.train(False)
+        parser.decode(words, pos_tags)
+
+        assert parser._batch_nt_emb is nt_emb
+
+    def test_projections_are_not_cached_when_training(self):
+        parser = self.make_parser()
+
+        parser(self.make_words(), self.make_pos_tags(), self.make_actions())
+        nt_emb = parser._batch_nt_emb
+        parser(self.make_words(), self.make_pos_tags(), self.make_actions())
+
+        assert parser._batch_nt_emb is not nt_emb
+        assert parser._projection_cache is None
+
+    def test_forward_batch(self):
+        sentences = self.make_sentences()
+        words, pos_tags, actions, word_lengths, action_lengths = self.make_batch(sentences)
+        parser = self.make_parser()
+
+        llh = parser(
+            words, pos_tags, actions, word_lengths=word_lengths, action_lengths=action_lengths)
+
+        assert isinstance(llh, Variable)
+        assert llh.size() == (len(sentences),)
+        llh.sum().backward()
+        assert parser.stack_encoder.lstm.weight_ih_l0.grad is not None
+        assert parser.fwd_composer.weight_ih_l0.grad is not None
+        assert parser.history_guard.grad is not None
+
+    def test_forward_with_preallocated_stack_lstm(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        actions = self.make_actions()
+        reference = self.make_parser()
+        parser = DiscRNNG(
+            self.num_words, self.num_pos, self.num_nt, stack_lstm_class=PreallocatedStackLSTM)
+        parser.load_state_dict(reference.state_dict())
+
+        llh = parser(words, pos_tags, actions)
+
+        assert isinstance(parser.stack_encoder, PreallocatedStackLSTM)
+        assert llh.data.tolist() == pytest.approx(
+            reference(words, pos_tags, actions).data.tolist(), abs=1e-5)
+
+    def test_forward_batch_with_fused_lstm(self):
+        sentences = self.make_sentences()
+        words, pos_tags, actions, word_lengths, action_lengths = self.make_batch(sentences)
+        parser = DiscRNNG(self.num_words, self.num_pos, self.num_nt, lstm_class=FusedLSTM)
+
+        llh = parser(
+            words, pos_tags, actions, word_lengths=word_lengths, action_lengths=action_lengths)
+
+        for i, (ws, ps, acts) in enumerate(sentences):
+            expected = parser(self.make_words(ws), self.make_pos_tags(ps), self.make_actions(acts))
+            assert llh.data.tolist()[i] == pytest.approx(expected.data.tolist()[0], abs=1e-5)
+        llh.sum().backward()
+        assert parser.fwd_composer.weight_l0.grad is not None
+
+    def test_forward_batch_equals_forward_per_sentence(self):
+        sentences = self.make_sentences()
+        words, pos_tags, actions, word_lengths, action_lengths = self.make_batch(sentences)
+        parser = self.make_parser()
+
+        llh = parser(
+            words, pos_tags, actions, word_lengths=word_lengths, action_lengths=action_lengths)
+
+        for i, (ws, ps, acts) in enumerate(sentences):
+            expected = parser(self.make_words(ws), self.make_pos_tags(ps), self.make_actions(acts))
+            assert llh.data.tolist()[i] == pytest.approx(expected.data.tolist()[0], abs=1e-5)
+
+    def test_forward_batch_without_lengths(self):
+        sentences = self.make_sentences()[:1] * 2
+        words, pos_tags, actions, _, _ = self.make_batch(sentences)
+        parser = self.make_parser()
+
+        llh = parser(words, pos_tags, actions)
+
+        assert llh.data.tolist()[0] == pytest.approx(llh.data.tolist()[1], abs=1e-5)
+
+    def test_forward_batch_with_illegal_action(self):
+        sentences = self.make_sentences()
+        parser = self.make_parser()
+        words, pos_tags, actions, word_lengths, action_lengths = self.make_batch(sentences)
+        expected = parser(
+            words, pos_tags, actions, word_lengths=word_lengths, action_lengths=action_lengths)
+        sentences[1] = ('John'.split(), 'NNP'.split(), [NT('S'), SHIFT, SHIFT])
+        words, pos_tags, actions, word_lengths, action_lengths = self.make_batch(sentences)
+
+        llh = parser(
+            words, pos_tags, actions, word_lengths=word_lengths, action_lengths=action_lengths)
+
+        assert llh.exp().data.tolist()[1] == pytest.approx(0, abs=1e-7)
+        for i in (0, 2):
+            assert llh.data.tolist()[i] == pytest.approx(expected.data.tolist()[i], abs=1e-5)
+
+    def test_forward_batch_with_invalid_lengths(self):
+        sentences = self.make_sentences()
+        words, pos_tags, actions, word_lengths, action_lengths = self.make_batch(sentences)
+        parser = self.make_parser()
+        with pytest.raises(ValueError) as excinfo:
+            parser(words, pos_tags, actions, word_lengths=word_lengths[:2])
+        assert f'expected {len(sentences)} lengths, got 2' in str(excinfo.value)
+
     def test_decode(self):
         words = self.make_words()
         pos_tags = self.make_pos_tags()
@@ -470,3 +1260,107 @@ class TestDiscRNNG(object):
         assert isinstance(best_action_ids, list)
         assert isinstance(parse_tree, Tree)
         assert parser.finished
+
+    def test_repeated_words_get_their_own_embeddings(self):
+        words = self.make_words('John loves John'.split())
+        pos_tags = self.make_pos_tags('NNP VBZ VBZ'.split())
+        parser = self.make_parser()
+
+        state = parser._start_state(words, pos_tags)
+
+        first = state.buffer.value
+        last = state.buffer.parent.parent.value
+        assert first.subtree == last.subtree
+        assert not torch.equal(first.emb.data, last.emb.data)
+
+    def test_parser_state_is_persistent(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+        nt_id = self.action2id(NT('S'))
+
+        state = parser._start_state(words, pos_tags)
+        state = parser._apply_actions([state], [nt_id])[0]
+        forks = parser._apply_actions([state, state], [parser.SHIFT_ID, nt_id])
+
+        assert state.action_ids == [nt_id]
+        assert state.buffer.size == len(words) + 1
+        assert state.num_open_nt == 1
+        assert forks[0].action_ids == [nt_id, parser.SHIFT_ID]
+        assert forks[0].buffer.size == len(words)
+        assert forks[0].stack.parent is state.stack
+        assert forks[1].action_ids == [nt_id, nt_id]
+        assert forks[1].num_open_nt == 2
+        assert forks[1].history.parent is state.history
+
+    def test_decode_batch(self):
+        sentences = self.make_sentences()
+        words, pos_tags, _, word_lengths, _ = self.make_batch(sentences)
+        parser = self.make_parser()
+        parser.eval()
+
+        results = parser.decode_batch(words, pos_tags, lengths=word_lengths)
+
+        assert len(results) == len(sentences)
+        for (ws, ps, _), (action_ids, tree) in zip(sentences, results):
+            expected_action_ids, expected_tree = parser.decode(
+                self.make_words(ws), self.make_pos_tags(ps))
+            assert action_ids == expected_action_ids
+            assert tree == expected_tree
+            assert len(tree.leaves()) == len(ws)
+
+    def test_decode_batch_with_bad_dimensions(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+        with pytest.raises(ValueError) as excinfo:
+            parser.decode_batch(words, pos_tags)
+        assert 'expected words to have dimension of 2, got 1' in str(excinfo.value)
+
+    def test_decode_beam(self):
+        sentences = self.make_sentences()
+        words, pos_tags, _, word_lengths, _ = self.make_batch(sentences)
+        parser = self.make_parser()
+        parser.eval()
+
+        greedy = parser.decode_batch(words, pos_tags, lengths=word_lengths)
+
+        for (ws, ps, _), (greedy_action_ids, greedy_tree) in zip(sentences, greedy):
+            action_ids, tree = parser.decode_beam(
+                self.make_words(ws), self.make_pos_tags(ps), beam_size=1)
+            assert action_ids == greedy_action_ids
+            assert tree == greedy_tree
+
+            action_ids, tree = parser.decode_beam(
+                self.make_words(ws), self.make_pos_tags(ps), beam_size=5)
+            assert len(tree.leaves()) == len(ws)
+            assert action_ids.count(parser.SHIFT_ID) == len(ws)
+
+    def test_decode_beam_word_synchronous(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+        parser.eval()
+
+        action_ids, tree = parser.decode_beam(words, pos_tags, beam_size=5, word_beam_size=2)
+
+        assert tree.leaves() == words.data.tolist()
+        assert action_ids.count(parser.SHIFT_ID) == len(words)
+        num_nt = len(action_ids) - action_ids.count(parser.SHIFT_ID) - \
+            action_ids.count(parser.REDUCE_ID)
+        assert action_ids.count(parser.REDUCE_ID) == num_nt
+
+    def test_decode_beam_with_bad_arguments(self):
+        words = self.make_words()
+        pos_tags = self.make_pos_tags()
+        parser = self.make_parser()
+
+        with pytest.raises(ValueError) as excinfo:
+            parser.decode_beam(words.view(1, -1), pos_tags.view(1, -1))
+        assert 'expected words to have dimension of 1, got 2' in str(excinfo.value)
+        with pytest.raises(ValueError) as excinfo:
+            parser.decode_beam(words, pos_tags, beam_size=0)
+        assert 'nonpositive beam size: 0' in str(excinfo.value)
+        with pytest.raises(ValueError) as excinfo:
+            parser.decode_beam(words, pos_tags, word_beam_size=0)
+        assert 'nonpositive word beam size: 0' in str(excinfo.value)
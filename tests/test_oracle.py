@@ -1,7 +1,7 @@
 from nltk.tree import Tree
 import pytest
 
-from rnng.actions import GEN, NT, REDUCE, SHIFT
+from rnng.actions import GEN, NT, REDUCE, SHIFT, decode_action
 from rnng.oracle import DiscOracle, GenOracle
 
 
@@ -80,6 +80,52 @@ class TestDiscOracle:
 
         assert str(oracle.to_tree()) == s
 
+    def test_to_tree_with_invalid_reduce(self):
+        oracle = DiscOracle([NT('S'), REDUCE], [], [])
+        with pytest.raises(ValueError) as excinfo:
+            oracle.to_tree()
+        assert f'invalid {REDUCE} action' in str(excinfo.value)
+
+    def test_to_tree_with_unfinished_actions(self):
+        oracle = DiscOracle([NT('S'), NT('NP'), SHIFT, REDUCE], ['NNP'], ['John'])
+        with pytest.raises(ValueError) as excinfo:
+            oracle.to_tree()
+        assert 'actions do not produce a single parse tree' in str(excinfo.value)
+
+    def test_views(self):
+        actions = [NT('S'), SHIFT, REDUCE]
+        oracle = DiscOracle(actions, ['NNP'], ['John'])
+
+        assert list(oracle.actions_view) == actions
+        assert oracle.actions_view is oracle.actions_view
+        assert list(oracle.pos_tags_view) == ['NNP']
+        assert list(oracle.words_view) == ['John']
+        actions.append(REDUCE)
+        assert list(oracle.actions_view) == [NT('S'), SHIFT, REDUCE]
+
+    def test_encode(self):
+        s = '(S (NP (NNP John)) (VP (VBZ loves) (NP (NNP Mary))))'
+        tree = Tree.fromstring(s)
+        nonterm2id = {'VP': 0}
+
+        codes, pos_nodes = DiscOracle.encode(tree, nonterm2id, {})
+
+        assert nonterm2id == {'VP': 0, 'S': 1, 'NP': 2}
+        assert [decode_action(c, list(nonterm2id)) for c in codes] == DiscOracle.get_actions(
+            tree)
+        assert [node.label() for node in pos_nodes] == ['NNP', 'VBZ', 'NNP']
+
+    def test_from_deep_tree(self):
+        depth = 5000
+        s = '(X ' * depth + '(NN a)' + ')' * depth
+        tree = Tree.fromstring(s)
+
+        oracle = DiscOracle.from_tree(tree)
+
+        assert oracle.actions == [NT('X')] * depth + [SHIFT] + [REDUCE] * depth
+        assert oracle.words == ['a']
+        assert DiscOracle.from_tree(oracle.to_tree()).actions == oracle.actions
+
 
 class TestGenOracle:
     def test_init_with_unequal_gen_count_and_number_of_pos_tags(self):
@@ -108,8 +154,12 @@ class TestGenOracle:
         expected_pos_tags = ['NNP', 'VBZ', 'NNP']
 
         oracle = GenOracle.from_tree(Tree.fromstring(s))
+        word2id = {}
+        codes, _ = GenOracle.encode(Tree.fromstring(s), {}, word2id)
 
         assert isinstance(oracle, GenOracle)
+        assert word2id == {'John': 0, 'loves': 1, 'Mary': 2}
+        assert len(codes) == len(expected_actions)
         assert oracle.actions == expected_actions
         assert oracle.words == expected_words
         assert oracle.pos_tags == expected_pos_tags
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from rnng.corpus import read_trees
+from rnng.dataset import ArrayDataset
+from rnng.example import make_example
+from rnng.fields import make_fields
+from rnng.oracle import DiscOracle
+from rnng.preprocess import build_dataset, iter_chunks, preprocess_corpus, read_chunks
+
+
+CORPUS = """
+(S (NP (NNP John)) (VP (VBZ loves) (NP (NNP Mary))) (. .))
+(S (NP (NNP Mary)) (VP (VBZ cries)))
+(S (NP (PRP It)) (VP (VBZ rains) (, ,) (ADVP (RB sadly))))
+(S (NP (NNP John)) (VP (VBZ runs)))
+(S (NP (PRP It)) (VP (VBZ snows)))
+"""
+
+
+@pytest.fixture
+def corpus(tmpdir):
+    path = tmpdir.join('corpus.txt')
+    path.write(CORPUS)
+    return str(path)
+
+
+def test_iter_chunks():
+    assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_chunks([], 2)) == []
+    with pytest.raises(ValueError) as excinfo:
+        list(iter_chunks(range(5), 0))
+    assert 'nonpositive chunk size: 0' in str(excinfo.value)
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_build_dataset(corpus, num_workers):
+    fields = make_fields()
+    names = [name for name, _ in fields]
+    examples = [make_example(DiscOracle.from_tree(tree), fields) for tree in read_trees(corpus)]
+    expected = ArrayDataset.from_examples(examples, names)
+
+    chunks = read_chunks(corpus, num_workers=num_workers, chunk_size=2)
+    dataset = build_dataset(chunks, fields)
+
+    assert dataset.names == names
+    for name in names:
+        assert dataset.symbols[name] == expected.symbols[name]
+        assert dataset.arrays[name].tolist() == expected.arrays[name].tolist()
+        assert dataset.offsets[name].tolist() == expected.offsets[name].tolist()
+
+
+def test_read_chunks_with_nonpositive_workers(corpus):
+    with pytest.raises(ValueError) as excinfo:
+        list(read_chunks(corpus, num_workers=0))
+    assert 'nonpositive number of workers: 0' in str(excinfo.value)
+
+
+def test_preprocess_corpus(corpus, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    fields = make_fields()
+
+    path = preprocess_corpus(corpus, fields, cache_dir, num_workers=2, chunk_size=2)
+    dataset = ArrayDataset.load(path)
+
+    assert os.listdir(cache_dir) == [os.path.basename(path)]
+    assert preprocess_corpus(corpus, make_fields(), cache_dir) == path
+    assert len(dataset) == 5
+    assert dataset.get_symbols('words', 0) == 'john loves mary .'.split()
+    assert dataset.get_symbols('pos_tags', 4) == 'PRP VBZ'.split()